@@ -2,7 +2,15 @@ from django.contrib import admin
 
 # Register your models here.
 
-from .models import User, Listing, Category, Bid, Comment, Watchlist
+from .models import (
+    User,
+    Listing,
+    Category,
+    Bid,
+    Comment,
+    Watchlist,
+    GeneratedDescription,
+)
 
 admin.site.register(User)
 admin.site.register(Listing)
@@ -10,3 +18,4 @@ admin.site.register(Category)
 admin.site.register(Bid)
 admin.site.register(Comment)
 admin.site.register(Watchlist)
+admin.site.register(GeneratedDescription)
@@ -0,0 +1,52 @@
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from rest_framework.views import APIView
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView whose handlers may be coroutines. Under ASGI (bidster.asgi) an
+    async handler waiting on the database or an upstream service does not
+    hold a worker thread, so one worker serves many such requests at once.
+
+    Authentication, permissions and throttling still run the synchronous
+    DRF code, in a thread. Sync handlers are allowed too and run in a thread
+    as well, so a view can make only its hot methods async.
+    """
+
+    # Django calls dispatch as a coroutine, whichever handlers the view has
+    view_is_async = True
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(
+                    self, request.method.lower(), self.http_method_not_allowed
+                )
+            else:
+                handler = self.http_method_not_allowed
+            if iscoroutinefunction(handler):
+                response = await handler(request, *args, **kwargs)
+            else:
+                response = await sync_to_async(handler)(
+                    request, *args, **kwargs
+                )
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(
+            request, response, *args, **kwargs
+        )
+        return self.response
+
+
+async def get_serializer_data(serializer):
+    """
+    Returns the data of serializer, serialized in a thread since the
+    serializers may read the viewer context and listings from the database
+    """
+    return await sync_to_async(lambda: serializer.data)()
@@ -0,0 +1,94 @@
+import copy
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .lru import LRUCache
+
+# Number of tokens kept in the in-process cache of each worker
+DEFAULT_TOKEN_CACHE_SIZE = 1024
+
+# Number of seconds a token is trusted without checking the database
+DEFAULT_TOKEN_CACHE_TIMEOUT = 60
+
+token_cache = LRUCache(
+    getattr(settings, "AUTH_TOKEN_CACHE_SIZE", DEFAULT_TOKEN_CACHE_SIZE),
+    getattr(settings, "AUTH_TOKEN_CACHE_TIMEOUT", DEFAULT_TOKEN_CACHE_TIMEOUT),
+)
+
+
+def get_shared_cache():
+    """
+    Returns the Django cache shared by the workers for tokens, or None when
+    only the in-process cache is used
+    """
+    alias = getattr(settings, "AUTH_TOKEN_SHARED_CACHE", None)
+    return caches[alias] if alias else None
+
+
+def get_shared_cache_key(key):
+    """
+    Returns the shared cache key of a token
+    """
+    return f"auth_token:{key}"
+
+
+def get_token(key):
+    """
+    Returns the token with key and its user, from the in-process cache, the
+    shared cache or the database, or None when no such token exists. A copy
+    is returned, so that a request changing its user does not change the
+    cached one.
+    """
+    token = token_cache.get(key)
+    shared_cache = get_shared_cache()
+    if token is None and shared_cache is not None:
+        token = shared_cache.get(get_shared_cache_key(key))
+        if token is not None:
+            token_cache.set(key, token)
+    if token is None:
+        try:
+            token = Token.objects.select_related("user").get(key=key)
+        except Token.DoesNotExist:
+            return None
+        token_cache.set(key, token)
+        if shared_cache is not None:
+            shared_cache.set(
+                get_shared_cache_key(key), token, token_cache.timeout
+            )
+    token = copy.copy(token)
+    token.user = copy.copy(token.user)
+    return token
+
+
+def revoke_tokens(keys):
+    """
+    Removes tokens from the in-process cache and the shared cache. Other
+    workers keep their in-process copy until it expires.
+    """
+    shared_cache = get_shared_cache()
+    for key in keys:
+        token_cache.delete(key)
+    if shared_cache is not None and keys:
+        shared_cache.delete_many([get_shared_cache_key(key) for key in keys])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication that looks tokens up in a cache before the
+    database, so that an authenticated request does not cost a query
+    """
+
+    def authenticate_credentials(self, key):
+        token = get_token(key)
+        if token is None:
+            raise exceptions.AuthenticationFailed(_("Invalid token."))
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(
+                _("User inactive or deleted.")
+            )
+        return (token.user, token)
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import uuid
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Category, Listing
+from .routers import use_primary
+from .serializers import CategorySerializer
+
+# Cache key holding the current version of the category catalog
+CATALOG_VERSION_KEY = "category_catalog:version"
+
+# Number of seconds a version of the catalog is cached for
+CATALOG_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def get_catalog():
+    """
+    Returns the serialized categories and their ETag, from the cache when
+    the current version has been built already, otherwise built from the
+    primary
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # A new random version, so that entries cached under an evicted
+        # version are never read again
+        cache.add(CATALOG_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    key = f"category_catalog:{version}"
+    catalog = cache.get(key)
+    if catalog is None:
+        with use_primary():
+            data = CategorySerializer(Category.objects.all(), many=True).data
+        content = json.dumps(data, sort_keys=True).encode()
+        catalog = {
+            "data": data,
+            "etag": f'"{hashlib.md5(content).hexdigest()}"',
+        }
+        cache.set(key, catalog, CATALOG_CACHE_TIMEOUT)
+    return catalog
+
+
+def invalidate_catalog():
+    """
+    Moves the catalog to a new version once the current transaction
+    commits, so the next request rebuilds it from the committed data
+    """
+    transaction.on_commit(
+        lambda: cache.set(CATALOG_VERSION_KEY, uuid.uuid4().hex, None)
+    )
+
+
+def update_active_counts(deltas):
+    """
+    Applies a category id to change mapping to the active listing counts
+    """
+    for category_id, delta in deltas.items():
+        if delta:
+            Category.objects.filter(pk=category_id).update(
+                active_count=F("active_count") + delta
+            )
+    if any(deltas.values()):
+        invalidate_catalog()
+
+
+def reconcile_active_counts(
+    category_model=Category, listing_model=Listing, shards=None
+):
+    """
+    Recomputes the active listing count of every category and returns the
+    number of categories updated. The listings are counted in every shard
+    of shards when given, otherwise in the database of the listing model.
+    Migrations pass their historical models.
+    """
+    if shards:
+        counts = Counter()
+        for alias in shards:
+            counts.update(
+                dict(
+                    listing_model.objects.using(alias)
+                    .filter(active=True)
+                    .order_by()
+                    .values("category")
+                    .annotate(c=Count("pk"))
+                    .values_list("category", "c")
+                )
+            )
+        with transaction.atomic(using=router.db_for_write(category_model)):
+            updated = category_model.objects.exclude(
+                pk__in=list(counts)
+            ).update(active_count=0)
+            for category_id, count in counts.items():
+                updated += category_model.objects.filter(
+                    pk=category_id
+                ).update(active_count=count)
+        invalidate_catalog()
+        return updated
+    counts = (
+        listing_model.objects.filter(category=OuterRef("pk"), active=True)
+        .order_by()
+        .values("category")
+        .annotate(c=Count("pk"))
+        .values("c")
+    )
+    updated = category_model.objects.update(
+        active_count=Coalesce(Subquery(counts), 0)
+    )
+    invalidate_catalog()
+    return updated
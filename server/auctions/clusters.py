@@ -0,0 +1,284 @@
+import itertools
+import json
+import math
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import F, Q
+
+from .database import immediate_atomic
+from .models import Listing, MapCluster
+
+# Highest zoom level served as clusters; closer zooms get individual markers
+CLUSTER_MAX_ZOOM = 10
+
+# Number of grid cells along each side of a 256px map tile
+CELLS_PER_TILE = 4
+
+# Number of listing ids kept as a sample on each cluster
+CLUSTER_SAMPLE_SIZE = 5
+
+
+def get_cell_size(zoom):
+    """
+    Returns the width of a grid cell in degrees at the zoom level
+    """
+    return 360 / (2**zoom * CELLS_PER_TILE)
+
+
+def get_cell(zoom, latitude, longitude):
+    """
+    Returns the grid column and row containing the coordinates
+    """
+    size = get_cell_size(zoom)
+    return (
+        math.floor((longitude + 180) / size),
+        math.floor((latitude + 90) / size),
+    )
+
+
+def add_to_clusters(listing_id, position):
+    """
+    Adds a listing at the position to its cluster on every zoom level
+    """
+    latitude, longitude = position
+    cells = {
+        zoom: get_cell(zoom, latitude, longitude)
+        for zoom in range(CLUSTER_MAX_ZOOM + 1)
+    }
+    existing = {
+        cluster.zoom: cluster
+        for cluster in MapCluster.objects.filter(
+            get_cells_filter(cells)
+        ).select_for_update()
+    }
+    for zoom, (cell_x, cell_y) in cells.items():
+        cluster = existing.get(zoom)
+        if cluster is None:
+            MapCluster.objects.create(
+                zoom=zoom,
+                cell_x=cell_x,
+                cell_y=cell_y,
+                count=1,
+                latitude_sum=latitude,
+                longitude_sum=longitude,
+                min_latitude=latitude,
+                max_latitude=latitude,
+                min_longitude=longitude,
+                max_longitude=longitude,
+                listing_ids=[listing_id],
+            )
+            continue
+        listing_ids = cluster.listing_ids
+        if len(listing_ids) < CLUSTER_SAMPLE_SIZE:
+            listing_ids = listing_ids + [listing_id]
+        MapCluster.objects.filter(pk=cluster.pk).update(
+            count=F("count") + 1,
+            latitude_sum=F("latitude_sum") + latitude,
+            longitude_sum=F("longitude_sum") + longitude,
+            min_latitude=min(cluster.min_latitude, latitude),
+            max_latitude=max(cluster.max_latitude, latitude),
+            min_longitude=min(cluster.min_longitude, longitude),
+            max_longitude=max(cluster.max_longitude, longitude),
+            listing_ids=listing_ids,
+        )
+
+
+def remove_from_clusters(listing_id, position):
+    """
+    Removes a listing at the position from its cluster on every zoom level.
+    Bounding boxes are not shrunk, so they stay conservative until the
+    clusters are rebuilt.
+    """
+    latitude, longitude = position
+    cells = {
+        zoom: get_cell(zoom, latitude, longitude)
+        for zoom in range(CLUSTER_MAX_ZOOM + 1)
+    }
+    clusters = MapCluster.objects.filter(
+        get_cells_filter(cells)
+    ).select_for_update()
+    for cluster in clusters:
+        if cluster.count <= 1:
+            cluster.delete()
+            continue
+        MapCluster.objects.filter(pk=cluster.pk).update(
+            count=F("count") - 1,
+            latitude_sum=F("latitude_sum") - latitude,
+            longitude_sum=F("longitude_sum") - longitude,
+            listing_ids=[i for i in cluster.listing_ids if i != listing_id],
+        )
+
+
+def remove_many_from_clusters(positions):
+    """
+    Removes listings given as an id to position mapping from their clusters
+    on every zoom level, with a few statements per zoom level however many
+    clusters are affected
+    """
+    changes = defaultdict(
+        lambda: {
+            "count": 0,
+            "latitude_sum": 0.0,
+            "longitude_sum": 0.0,
+            "listing_ids": set(),
+        }
+    )
+    for listing_id, (latitude, longitude) in positions.items():
+        for zoom in range(CLUSTER_MAX_ZOOM + 1):
+            change = changes[(zoom, *get_cell(zoom, latitude, longitude))]
+            change["count"] += 1
+            change["latitude_sum"] += latitude
+            change["longitude_sum"] += longitude
+            change["listing_ids"].add(listing_id)
+    updates = []
+    empty = []
+    with immediate_atomic():
+        for zoom in range(CLUSTER_MAX_ZOOM + 1):
+            # Read the columns of the affected cells, and skip the other
+            # cells read along with them
+            columns = {x for z, x, _ in changes if z == zoom}
+            clusters = (
+                MapCluster.objects.filter(zoom=zoom, cell_x__in=columns)
+                .select_for_update()
+                .values_list("id", "cell_x", "cell_y", "count", "listing_ids")
+            )
+            for pk, cell_x, cell_y, count, listing_ids in clusters:
+                change = changes.get((zoom, cell_x, cell_y))
+                if change is None:
+                    continue
+                if count <= change["count"]:
+                    empty.append(pk)
+                    continue
+                listing_ids = [
+                    i for i in listing_ids if i not in change["listing_ids"]
+                ]
+                updates.append(
+                    (
+                        change["count"],
+                        change["latitude_sum"],
+                        change["longitude_sum"],
+                        json.dumps(listing_ids),
+                        pk,
+                    )
+                )
+        # A single prepared statement run for every cluster, which is much
+        # cheaper than compiling an UPDATE per cluster
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"""
+                UPDATE {MapCluster._meta.db_table}
+                SET count = count - %s,
+                    latitude_sum = latitude_sum - %s,
+                    longitude_sum = longitude_sum - %s,
+                    listing_ids = %s
+                WHERE id = %s
+                """,
+                updates,
+            )
+        MapCluster.objects.filter(pk__in=empty).delete()
+
+
+def update_clusters(listing_id, old_position, new_position):
+    """
+    Moves a listing between clusters when it is created, moved, opened or
+    closed
+    """
+    if old_position == new_position:
+        return
+    with immediate_atomic():
+        if old_position is not None:
+            remove_from_clusters(listing_id, old_position)
+        if new_position is not None:
+            add_to_clusters(listing_id, new_position)
+
+
+def get_cells_filter(cells):
+    """
+    Returns a filter matching the cells given as a zoom to (x, y) mapping
+    """
+    query = Q()
+    for zoom, (cell_x, cell_y) in cells.items():
+        query |= Q(zoom=zoom, cell_x=cell_x, cell_y=cell_y)
+    return query
+
+
+def rebuild_clusters(
+    listing_model=Listing, cluster_model=MapCluster, shards=None
+):
+    """
+    Recomputes every cluster from the active listings and returns the
+    number of clusters created. The listings are read from every shard of
+    shards when given, otherwise from the database of the listing model.
+    Migrations pass their historical models.
+    """
+    clusters = defaultdict(
+        lambda: {
+            "count": 0,
+            "latitude_sum": 0.0,
+            "longitude_sum": 0.0,
+            "min_latitude": 90.0,
+            "max_latitude": -90.0,
+            "min_longitude": 180.0,
+            "max_longitude": -180.0,
+            "listing_ids": [],
+        }
+    )
+    listings = (
+        listing_model.objects.filter(
+            active=True,
+            public_latitude__isnull=False,
+            public_longitude__isnull=False,
+        )
+        .order_by()
+        .values_list("id", "public_latitude", "public_longitude")
+    )
+    querysets = (
+        [listings.using(alias) for alias in shards] if shards else [listings]
+    )
+    rows = itertools.chain.from_iterable(
+        queryset.iterator(chunk_size=5000) for queryset in querysets
+    )
+    for listing_id, latitude, longitude in rows:
+        latitude, longitude = float(latitude), float(longitude)
+        for zoom in range(CLUSTER_MAX_ZOOM + 1):
+            cluster = clusters[(zoom, *get_cell(zoom, latitude, longitude))]
+            cluster["count"] += 1
+            cluster["latitude_sum"] += latitude
+            cluster["longitude_sum"] += longitude
+            cluster["min_latitude"] = min(cluster["min_latitude"], latitude)
+            cluster["max_latitude"] = max(cluster["max_latitude"], latitude)
+            cluster["min_longitude"] = min(cluster["min_longitude"], longitude)
+            cluster["max_longitude"] = max(cluster["max_longitude"], longitude)
+            if len(cluster["listing_ids"]) < CLUSTER_SAMPLE_SIZE:
+                cluster["listing_ids"].append(listing_id)
+    with transaction.atomic():
+        cluster_model.objects.all().delete()
+        cluster_model.objects.bulk_create(
+            [
+                cluster_model(
+                    zoom=zoom, cell_x=cell_x, cell_y=cell_y, **values
+                )
+                for (zoom, cell_x, cell_y), values in clusters.items()
+            ],
+            batch_size=1000,
+        )
+    return len(clusters)
+
+
+def get_clusters(zoom, bbox=None):
+    """
+    Returns the clusters at the zoom level, limited to the cells overlapping
+    the (minLng, minLat, maxLng, maxLat) bounding box if given
+    """
+    clusters = MapCluster.objects.filter(zoom=zoom)
+    if bbox is None:
+        return clusters
+    min_lng, min_lat, max_lng, max_lat = bbox
+    min_x, min_y = get_cell(zoom, min_lat, min_lng)
+    max_x, max_y = get_cell(zoom, max_lat, max_lng)
+    clusters = clusters.filter(cell_y__gte=min_y, cell_y__lte=max_y)
+    if min_lng <= max_lng:
+        return clusters.filter(cell_x__gte=min_x, cell_x__lte=max_x)
+    # The bounding box crosses the antimeridian
+    return clusters.filter(Q(cell_x__gte=min_x) | Q(cell_x__lte=max_x))
@@ -0,0 +1,147 @@
+from collections import defaultdict
+
+from django.db.models import Count, F, Window
+from django.db.models.functions import RowNumber
+
+from .models import Comment, Rating
+from .shards import alist
+
+# Number of replies returned per comment unless the request asks otherwise
+DEFAULT_REPLY_LIMIT = 10
+
+# Largest number of replies returned per comment
+MAX_REPLY_LIMIT = 50
+
+# Largest number of replies loaded per thread for the comment list, the
+# oldest ones, so that their parents are loaded as well. Replies further
+# down are fetched from the replies endpoint of their parent.
+MAX_THREAD_REPLIES = 200
+
+
+def parse_reply_limit(value):
+    """
+    Returns the reply limit given as a query parameter, between 0 and
+    MAX_REPLY_LIMIT, or DEFAULT_REPLY_LIMIT if it is missing or not an
+    integer
+    """
+    try:
+        reply_limit = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_REPLY_LIMIT
+    return min(max(reply_limit, 0), MAX_REPLY_LIMIT)
+
+
+def get_author_ratings(listing, comments):
+    """
+    Returns the (user_id, rating) rows of the ratings the authors of the
+    comments gave the listing
+    """
+    return Rating.objects.filter(
+        listing=listing,
+        user_id__in={comment.user_id for comment in comments},
+    ).values_list("user_id", "rating")
+
+
+def build_tree_context(comments, ratings, reply_limit, reply_counts=None):
+    """
+    Returns the serializer context mapping each comment id to its replies
+    and each author to their rating on the listing. reply_counts maps each
+    comment id to its number of replies, when comments are not all of them.
+    """
+    replies = defaultdict(list)
+    for comment in comments:
+        if comment.parent_id is not None:
+            replies[comment.parent_id].append(comment)
+    if reply_counts is None:
+        reply_counts = {
+            comment_id: len(children)
+            for comment_id, children in replies.items()
+        }
+    return {
+        "replies": replies,
+        "reply_counts": reply_counts,
+        "ratings": ratings,
+        "reply_limit": reply_limit,
+    }
+
+
+def get_shown_replies(roots, reply_limit):
+    """
+    Returns the replies below the top level comments that the comment list
+    can show: the first reply_limit replies of each comment, in the order
+    they are shown, and of those at most MAX_THREAD_REPLIES per thread
+    """
+    ordering = [F("created_at").desc(), F("id").desc()]
+    shown = (
+        Comment.objects.filter(thread__in=roots)
+        .alias(
+            position=Window(
+                RowNumber(), partition_by="parent", order_by=ordering
+            )
+        )
+        .filter(position__lte=reply_limit)
+    )
+    return (
+        Comment.objects.filter(pk__in=shown.values("pk"))
+        .alias(
+            thread_position=Window(
+                RowNumber(),
+                partition_by="thread",
+                order_by=[F("created_at").asc(), F("id").asc()],
+            )
+        )
+        .filter(thread_position__lte=MAX_THREAD_REPLIES)
+        .order_by(*ordering)
+        .select_related("user")
+    )
+
+
+def get_reply_counts(comments):
+    """
+    Returns the (parent_id, count) rows of the number of replies of each
+    comment
+    """
+    return (
+        Comment.objects.filter(parent__in=comments)
+        .values("parent")
+        .annotate(count=Count("id"))
+        .values_list("parent", "count")
+        .order_by()
+    )
+
+
+async def aload_comment_tree(listing, roots, reply_limit=DEFAULT_REPLY_LIMIT):
+    """
+    Loads the replies shown below the top level comments with one query
+    using their thread, see get_shown_replies, the number of replies of
+    each comment with another and the ratings of their authors with a
+    third, with the async ORM, and returns the serializer context for the
+    tree
+    """
+    roots = list(roots)
+    comments = roots
+    if reply_limit:
+        comments = roots + await alist(get_shown_replies(roots, reply_limit))
+    reply_counts = {
+        parent_id: count
+        async for parent_id, count in get_reply_counts(comments)
+    }
+    ratings = {
+        user_id: rating
+        async for user_id, rating in get_author_ratings(listing, comments)
+    }
+    return build_tree_context(comments, ratings, reply_limit, reply_counts)
+
+
+def load_thread(listing, comment, reply_limit=DEFAULT_REPLY_LIMIT):
+    """
+    Loads every comment in the thread a comment belongs to with one query,
+    and returns the serializer context for the replies below it
+    """
+    comments = list(
+        Comment.objects.filter(
+            thread_id=comment.thread_id or comment.id
+        ).select_related("user")
+    )
+    ratings = dict(get_author_ratings(listing, comments))
+    return build_tree_context(comments, ratings, reply_limit)
@@ -0,0 +1,61 @@
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+
+
+def apply_sqlite_pragmas(connection, pragmas=None):
+    """
+    Applies pragmas, by default the SQLITE_PRAGMAS setting, to an SQLite
+    connection. Other databases are left alone.
+    """
+    if connection.vendor != "sqlite":
+        return
+    if pragmas is None:
+        pragmas = getattr(settings, "SQLITE_PRAGMAS", {})
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+def get_sqlite_pragma(connection, name):
+    """
+    Returns the current value of a pragma of an SQLite connection
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"PRAGMA {name}")
+        return cursor.fetchone()[0]
+
+
+@contextmanager
+def immediate_atomic(using=None):
+    """
+    Like transaction.atomic, but on SQLite the outermost block begins with
+    BEGIN IMMEDIATE, taking the write lock before the first read. A deferred
+    transaction that reads and then writes fails at once with "database is
+    locked" when another connection committed in between, without waiting
+    for busy_timeout; an immediate one waits for the lock up front instead.
+    Inside another atomic block it is a savepoint like transaction.atomic.
+    """
+    connection = transaction.get_connection(using)
+    if connection.vendor != "sqlite" or connection.in_atomic_block:
+        with transaction.atomic(using=using):
+            yield
+        return
+    # atomic begins the transaction with this method of the connection
+    connection._start_transaction_under_autocommit = lambda: (
+        connection.cursor().execute("BEGIN IMMEDIATE")
+    )
+    try:
+        with transaction.atomic(using=using):
+            del connection._start_transaction_under_autocommit
+            yield
+    finally:
+        connection.__dict__.pop("_start_transaction_under_autocommit", None)
+
+
+def is_database_locked(error):
+    """
+    Returns if an OperationalError is SQLite failing to get a lock
+    """
+    return "locked" in str(error)
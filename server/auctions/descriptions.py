@@ -0,0 +1,238 @@
+import asyncio
+import concurrent.futures
+import re
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from functools import lru_cache
+
+import openai
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .lru import LRUCache
+from .models import GeneratedDescription
+
+# Client used when the DESCRIPTION_CLIENT setting is not set
+DEFAULT_DESCRIPTION_CLIENT = "auctions.descriptions.OpenAIClient"
+
+# Number of descriptions kept in the in-process cache of each worker
+DEFAULT_DESCRIPTION_CACHE_SIZE = 1024
+
+# Number of seconds a description is kept in the in-process cache
+DEFAULT_DESCRIPTION_CACHE_TIMEOUT = 60 * 60
+
+# OpenAI model descriptions are generated with
+DESCRIPTION_MODEL = "gpt-3.5-turbo"
+
+
+class DescriptionError(Exception):
+    """
+    Raised when a description could not be generated
+    """
+
+
+class DescriptionTimeout(DescriptionError):
+    """
+    Raised when generating a description took too long
+    """
+
+
+class DescriptionClient(ABC):
+    """
+    Generates the description for a prompt. complete() returns the
+    description, the model that generated it and the prompt and completion
+    tokens it cost, and raises DescriptionError when it fails.
+    """
+
+    @abstractmethod
+    async def complete(self, prompt):
+        """
+        Returns a dict with the description, model, prompt_tokens and
+        completion_tokens generated for the prompt
+        """
+
+
+class OpenAIClient(DescriptionClient):
+    """
+    Generates descriptions with the OpenAI chat completion API, giving up
+    after the OPENAI_REQUEST_TIMEOUT setting
+    """
+
+    def __init__(self, model=DESCRIPTION_MODEL):
+        self.model = model
+
+    async def complete(self, prompt):
+        openai.api_key = settings.OPENAI_API_KEY
+        try:
+            response = await openai.ChatCompletion.acreate(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                request_timeout=settings.OPENAI_REQUEST_TIMEOUT,
+            )
+        except openai.error.Timeout as e:
+            raise DescriptionTimeout(str(e)) from e
+        except openai.error.OpenAIError as e:
+            raise DescriptionError(str(e)) from e
+        usage = response.get("usage", {})
+        return {
+            "description": response["choices"][0]["message"]["content"],
+            "model": response.get("model", self.model),
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+        }
+
+
+class StubClient(DescriptionClient):
+    """
+    Answers every prompt with the same description after a delay, without
+    calling OpenAI, for development and tests. Counts the prompts it got.
+    """
+
+    def __init__(self, description="A great item in good condition.", delay=0):
+        self.description = description
+        self.delay = delay
+        self.calls = 0
+
+    async def complete(self, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return {
+            "description": self.description,
+            "model": "stub",
+            "prompt_tokens": len(prompt.split()),
+            "completion_tokens": len(self.description.split()),
+        }
+
+
+@lru_cache(maxsize=None)
+def get_description_client():
+    """
+    Returns the client configured by the DESCRIPTION_CLIENT setting,
+    created with the DESCRIPTION_CLIENT_OPTIONS setting as arguments
+    """
+    client_class = import_string(
+        getattr(settings, "DESCRIPTION_CLIENT", DEFAULT_DESCRIPTION_CLIENT)
+    )
+    return client_class(**getattr(settings, "DESCRIPTION_CLIENT_OPTIONS", {}))
+
+
+description_cache = LRUCache(
+    getattr(
+        settings, "DESCRIPTION_CACHE_SIZE", DEFAULT_DESCRIPTION_CACHE_SIZE
+    ),
+    getattr(
+        settings,
+        "DESCRIPTION_CACHE_TIMEOUT",
+        DEFAULT_DESCRIPTION_CACHE_TIMEOUT,
+    ),
+)
+
+# Generations in progress by cache key, shared by every event loop of the
+# process, since under WSGI each request runs on its own loop
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+
+def normalize_title(title):
+    """
+    Returns title lowercased, with punctuation and repeated whitespace
+    removed, so that near-identical titles share a description
+    """
+    title = unicodedata.normalize("NFKC", title).casefold()
+    return " ".join(re.sub(r"[^\w\s]", " ", title).split())
+
+
+def get_description_key(normalized_title, category_id):
+    """
+    Returns the in-process cache key of a description
+    """
+    return f"{category_id or ''}:{normalized_title}"
+
+
+def get_prompt(title, category=None):
+    """
+    Returns the prompt asking for the description of title
+    """
+    prompt = "I want to sell a " + title
+    if category is not None:
+        prompt += f" in the {category.category} category"
+    return (
+        prompt + ". What should I write in the description with in 50 words?"
+    )
+
+
+async def coalesce(key, generate):
+    """
+    Returns the result of generate() for the first caller with key, and
+    makes the callers with the same key that arrive in the meantime wait
+    for that result instead of calling generate() again
+    """
+    with in_flight_lock:
+        future = in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = concurrent.futures.Future()
+            in_flight[key] = future
+    if not leader:
+        return await asyncio.wrap_future(future)
+    try:
+        result = await generate()
+    except BaseException as e:
+        # A cancelled request must not cancel the requests waiting on it
+        future.set_exception(
+            e
+            if isinstance(e, Exception)
+            else DescriptionError("The generation was cancelled")
+        )
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with in_flight_lock:
+            del in_flight[key]
+
+
+async def generate_description(title, category, normalized_title):
+    """
+    Generates the description of title with the description client and
+    stores it with its latency and token cost
+    """
+    start = time.monotonic()
+    completion = await get_description_client().complete(
+        get_prompt(title, category)
+    )
+    latency = time.monotonic() - start
+    # Another worker may have stored the same title in the meantime
+    generated, _ = await GeneratedDescription.objects.aget_or_create(
+        normalized_title=normalized_title,
+        category=category,
+        defaults={**completion, "latency": latency},
+    )
+    return generated
+
+
+async def get_generated_description(title, category=None):
+    """
+    Returns the GeneratedDescription of title in category (or without a
+    category): from the in-process cache, from the database, or generated
+    once for all the concurrent requests of this process
+    """
+    normalized_title = normalize_title(title)
+    category_id = category.pk if category is not None else None
+    key = get_description_key(normalized_title, category_id)
+    generated = description_cache.get(key)
+    if generated is not None:
+        return generated
+    generated = await GeneratedDescription.objects.filter(
+        normalized_title=normalized_title, category_id=category_id
+    ).afirst()
+    if generated is None:
+        generated = await coalesce(
+            key,
+            lambda: generate_description(title, category, normalized_title),
+        )
+    description_cache.set(key, generated)
+    return generated
@@ -0,0 +1,224 @@
+import asyncio
+import json
+import threading
+from abc import ABC, abstractmethod
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+# Broker used when the AUCTION_EVENT_BROKER setting is not set
+DEFAULT_BROKER = "auctions.events.InMemoryBroker"
+
+# Number of undelivered events kept for a slow subscriber before the oldest
+# ones are dropped
+SUBSCRIBER_BUFFER_SIZE = 100
+
+
+class Broker(ABC):
+    """
+    Fans listing events out to the clients streaming that listing.
+
+    Events are published from request threads and consumed from the event
+    loop serving the streams, so publish() must be thread-safe.
+    """
+
+    @abstractmethod
+    def publish(self, listing_id, event):
+        """
+        Sends an event to the current subscribers of the listing
+        """
+
+    @abstractmethod
+    async def subscribe(self, listing_id):
+        """
+        Returns a subscription with an async get(timeout) method returning
+        the next event or None on timeout, and an async close() method
+        """
+
+
+class InMemorySubscription:
+    def __init__(self, broker, listing_id):
+        self.broker = broker
+        self.listing_id = listing_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(SUBSCRIBER_BUFFER_SIZE)
+
+    def put(self, event):
+        # Runs on the subscriber's event loop
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InMemoryBroker(Broker):
+    """
+    Delivers events to the streams served by this process only. Use a
+    shared broker such as RedisBroker when running several workers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def publish(self, listing_id, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(listing_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # The subscriber's event loop has already been closed
+                self.unsubscribe(subscription)
+
+    async def subscribe(self, listing_id):
+        subscription = InMemorySubscription(self, listing_id)
+        with self.lock:
+            self.subscriptions.setdefault(listing_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.listing_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.listing_id]
+
+
+class RedisSubscription:
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    async def get(self, timeout):
+        message = await self.pubsub.get_message(
+            ignore_subscribe_messages=True, timeout=timeout
+        )
+        if message is None:
+            return None
+        return json.loads(message["data"])
+
+    async def close(self):
+        await self.pubsub.reset()
+
+
+class RedisBroker(Broker):
+    """
+    Delivers events through Redis pub/sub, so that every worker receives
+    the events published by the others. Requires the redis package.
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="bidster"):
+        try:
+            import redis
+            import redis.asyncio
+        except ImportError:
+            raise ImproperlyConfigured(
+                "RedisBroker requires the redis package"
+            )
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+        self.async_client = redis.asyncio.Redis.from_url(url)
+
+    def get_channel(self, listing_id):
+        return f"{self.prefix}:listings:{listing_id}"
+
+    def publish(self, listing_id, event):
+        self.client.publish(self.get_channel(listing_id), json.dumps(event))
+
+    async def subscribe(self, listing_id):
+        pubsub = self.async_client.pubsub()
+        await pubsub.subscribe(self.get_channel(listing_id))
+        return RedisSubscription(pubsub)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    """
+    Returns the broker configured by the AUCTION_EVENT_BROKER setting,
+    created with the AUCTION_EVENT_BROKER_OPTIONS setting as arguments
+    """
+    broker_class = import_string(
+        getattr(settings, "AUCTION_EVENT_BROKER", DEFAULT_BROKER)
+    )
+    return broker_class(
+        **getattr(settings, "AUCTION_EVENT_BROKER_OPTIONS", {})
+    )
+
+
+def publish_listing_event(listing_id, event, using=None):
+    """
+    Publishes an event to the listing's streams once the current
+    transaction of the database using commits, so clients never see a write
+    that rolled back
+    """
+    transaction.on_commit(
+        lambda: get_broker().publish(listing_id, event), using=using
+    )
+
+
+def get_bid_event(listing, bid):
+    """
+    Returns the event sent when a bid is placed on a listing
+    """
+    return {
+        "type": "bid",
+        "listing_id": listing.id,
+        "current_bid": listing.current_bid,
+        "bid_count": listing.bid_count,
+        "bid": {
+            "id": bid.id,
+            "user_id": bid.user_id,
+            "bid": bid.bid,
+            "created_at": bid.created_at.isoformat(),
+        },
+    }
+
+
+def get_close_event(listing):
+    """
+    Returns the event sent when a listing is closed
+    """
+    winner_bid = listing.winner_bid
+    return {
+        "type": "close",
+        "listing_id": listing.id,
+        "winner_id": winner_bid.user_id if winner_bid else None,
+        "winning_bid": winner_bid.bid if winner_bid else None,
+    }
+
+
+def get_comment_event(comment):
+    """
+    Returns the event sent when a comment is posted on a listing
+    """
+    return {
+        "type": "comment",
+        "listing_id": comment.listing_id,
+        "comment": {
+            "id": comment.id,
+            "parent_id": comment.parent_id,
+            "thread_id": comment.thread_id,
+            "user_id": comment.user_id,
+            "comment": comment.comment,
+            "created_at": comment.created_at.isoformat(),
+        },
+    }
+
+
+def format_event(event):
+    """
+    Formats an event as a Server-Sent Events message
+    """
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
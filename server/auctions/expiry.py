@@ -0,0 +1,120 @@
+from collections import Counter
+
+from django.db import router
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from .catalog import update_active_counts
+from .clusters import remove_many_from_clusters
+from .database import immediate_atomic
+from .events import get_close_event, publish_listing_event
+from .models import Bid, Listing
+from .shards import get_shards, use_shard
+from .viewers import invalidate_viewer_contexts
+
+# Number of expired listings closed per transaction
+EXPIRY_BATCH_SIZE = 500
+
+
+class ExpiryConflict(Exception):
+    """
+    Raised inside a batch when another worker closed some of its listings
+    after they were read, to roll the batch back and read it again
+    """
+
+
+def close_expired_batch(now, batch_size=EXPIRY_BATCH_SIZE):
+    """
+    Closes up to batch_size listings that ended by now and returns the
+    number closed. The winners are set by a few set-based UPDATEs for the
+    whole batch instead of saving each listing. When listings are sharded,
+    this closes the listings of the shard chosen with use_shard.
+
+    Workers may overlap: listings locked by another worker are skipped
+    where the database supports it, and since SQLite does not, the batch is
+    closed by an UPDATE that re-checks each listing is still open. If it
+    closes fewer listings than were read, another worker got to some of
+    them first, so the batch is rolled back and read again rather than
+    counted twice.
+    """
+    while True:
+        try:
+            return close_batch(now, batch_size)
+        except ExpiryConflict:
+            continue
+
+
+def close_batch(now, batch_size):
+    """
+    Closes one batch for close_expired_batch, raising ExpiryConflict if
+    another worker closed some of its listings in the meantime
+    """
+    using = router.db_for_write(Listing)
+    with immediate_atomic(using=using):
+        expired = list(
+            Listing.objects.filter(active=True, ends_at__lte=now)
+            .order_by("ends_at")
+            .select_for_update(skip_locked=True)
+            .values_list(
+                "id", "category_id", "public_latitude", "public_longitude"
+            )[:batch_size]
+        )
+        if not expired:
+            return 0
+        ids = [listing_id for listing_id, _, _, _ in expired]
+        highest_bid = (
+            Bid.objects.filter(listing=OuterRef("pk"))
+            .order_by("-bid")
+            .values("pk")[:1]
+        )
+        closed = Listing.objects.filter(
+            pk__in=ids, active=True, ends_at__lte=now
+        ).update(
+            active=False, winner_bid=Subquery(highest_bid), updated_at=now
+        )
+        if closed != len(ids):
+            raise ExpiryConflict
+        winning_bids = Bid.objects.filter(
+            pk__in=Listing.objects.filter(pk__in=ids).values("winner_bid")
+        )
+        winning_bids.update(winner=True, updated_at=now)
+        invalidate_viewer_contexts(
+            winning_bids.values_list("user_id", flat=True), using=using
+        )
+        # The UPDATEs bypass the post_save signal, so take the listings off
+        # the map clusters and the category counts here
+        remove_many_from_clusters(
+            {
+                listing_id: (float(latitude), float(longitude))
+                for listing_id, _, latitude, longitude in expired
+                if latitude is not None and longitude is not None
+            }
+        )
+        deltas = Counter()
+        for _, category_id, _, _ in expired:
+            deltas[category_id] -= 1
+        update_active_counts(deltas)
+        for listing in Listing.objects.filter(pk__in=ids).select_related(
+            "winner_bid"
+        ):
+            publish_listing_event(
+                listing.pk, get_close_event(listing), using=using
+            )
+    return len(ids)
+
+
+def close_expired_listings(now=None, batch_size=EXPIRY_BATCH_SIZE):
+    """
+    Closes every listing that ended by now, in batches and shard by shard,
+    and returns the number closed
+    """
+    now = now or timezone.now()
+    closed = 0
+    for alias in get_shards() or [None]:
+        with use_shard(alias):
+            while True:
+                count = close_expired_batch(now, batch_size)
+                closed += count
+                if count < batch_size:
+                    break
+    return closed
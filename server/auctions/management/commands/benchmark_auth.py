@@ -0,0 +1,101 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from rest_framework.views import APIView
+
+from auctions.authentication import CachedTokenAuthentication, token_cache
+from auctions.models import Category, Listing, User
+
+
+class Command(BaseCommand):
+    """
+    Requests every authenticated GET endpoint with the database token
+    authentication and with the cached one, and reports the queries and the
+    time per request of each.
+
+    Everything it creates is deleted at the end.
+    """
+
+    help = "Benchmark for the cached token authentication"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=200,
+            help="Number of requests per endpoint (default: 200)",
+        )
+
+    def handle(self, *args, **options):
+        user = User.objects.create(username="benchmark_auth")
+        category = Category.objects.create(category="benchmark_auth")
+        listing = Listing.objects.create(
+            user=user,
+            category=category,
+            title="Benchmark auth",
+            description="Benchmark auth",
+            starting_bid=1,
+        )
+        token = Token.objects.create(user=user)
+        urls = [
+            reverse("listings"),
+            reverse("listing", args=[listing.pk]),
+            reverse("categories"),
+            reverse("category_listings", args=[category.pk]),
+            reverse("me"),
+            reverse("watchlist"),
+            reverse("comments", args=[listing.pk]),
+            reverse("user_listings", args=[user.pk]),
+        ]
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        authentication_classes = APIView.authentication_classes
+        try:
+            self.stdout.write(
+                f"{'endpoint':<32} {'queries':^16} {'ms/request':^18}"
+            )
+            for url in urls:
+                results = [
+                    self.run(client, url, auth, options["requests"])
+                    for auth in (
+                        TokenAuthentication,
+                        CachedTokenAuthentication,
+                    )
+                ]
+                (queries, elapsed), (cached_queries, cached_elapsed) = results
+                self.stdout.write(
+                    f"{url:<32} {queries:>7.1f} -> {cached_queries:<6.1f} "
+                    f"{elapsed:>8.2f} -> {cached_elapsed:<6.2f}"
+                )
+        finally:
+            APIView.authentication_classes = authentication_classes
+            token_cache.clear()
+            listing.delete()
+            category.delete()
+            user.delete()
+
+    def run(self, client, url, authentication_class, requests):
+        """
+        Requests url with authentication_class and returns the queries and
+        milliseconds per request
+        """
+        APIView.authentication_classes = [authentication_class]
+        token_cache.clear()
+        # Warm up, so the cached authentication is measured with its cache
+        # filled
+        client.get(url)
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            for _ in range(requests):
+                client.get(url)
+            elapsed = time.perf_counter() - start
+        return (
+            len(context.captured_queries) / requests,
+            elapsed * 1000 / requests,
+        )
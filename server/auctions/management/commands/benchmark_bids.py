@@ -0,0 +1,130 @@
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+
+from auctions.models import Bid, Category, Listing, User
+
+
+class Command(BaseCommand):
+    """
+    Fires bids at a single listing from many threads at once, then checks
+    that no bid was lost or accepted out of order and reports bids/sec.
+
+    The threads need their own database connections, so this runs against
+    the configured database (not an in-memory one). Everything it creates
+    is deleted at the end.
+    """
+
+    help = "Concurrency test and benchmark for bid placement"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--bids",
+            type=int,
+            default=2000,
+            help="Total number of bids to place (default: 2000)",
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=16,
+            help="Number of concurrent bidders (default: 16)",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            raise CommandError("An on-disk database is required")
+        seller = User.objects.create(username="benchmark_bids_seller")
+        category = Category.objects.create(category="benchmark_bids")
+        bidders = [
+            User.objects.create(username=f"benchmark_bids_{i}")
+            for i in range(options["threads"])
+        ]
+        listing = Listing.objects.create(
+            user=seller,
+            category=category,
+            title="Benchmark bids",
+            description="Benchmark bids",
+            starting_bid=1,
+        )
+        try:
+            self.run(listing, bidders, options["bids"])
+        finally:
+            listing.delete()
+            category.delete()
+            for user in [seller, *bidders]:
+                user.delete()
+
+    def run(self, listing, bidders, total):
+        """
+        Places the bids from one thread per bidder and checks the result
+        """
+        per_thread = total // len(bidders)
+        accepted = []
+        errors = []
+        lock = threading.Lock()
+
+        def bid(bidder):
+            rng = random.Random(bidder.id)
+            try:
+                for _ in range(per_thread):
+                    # Bid a little over the last known price, so bidders
+                    # keep colliding on the same amounts
+                    current = (
+                        Listing.objects.filter(pk=listing.pk)
+                        .values_list("current_bid", flat=True)
+                        .get()
+                    )
+                    amount = current + rng.randint(1, 3)
+                    try:
+                        placed = listing.place_bid(bidder, amount)
+                    except OperationalError as e:
+                        with lock:
+                            errors.append(e)
+                        continue
+                    if placed is not None:
+                        with lock:
+                            accepted.append(placed)
+            finally:
+                connections.close_all()
+
+        threads = [
+            threading.Thread(target=bid, args=(bidder,)) for bidder in bidders
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        attempted = per_thread * len(bidders)
+        bids = list(
+            Bid.objects.filter(listing=listing)
+            .order_by("id")
+            .values_list("bid", flat=True)
+        )
+        listing.refresh_from_db()
+        self.stdout.write(
+            f"{attempted} bids from {len(bidders)} threads in {elapsed:.2f}s "
+            f"({attempted / elapsed:.0f} bids/sec): {len(accepted)} accepted, "
+            f"{attempted - len(accepted) - len(errors)} outbid, "
+            f"{len(errors)} database errors"
+        )
+        # Every accepted bid is stored, in strictly increasing order, and
+        # the listing aggregates agree with the bid rows
+        problems = []
+        if len(bids) != len(accepted):
+            problems.append(f"{len(accepted)} accepted but {len(bids)} stored")
+        if any(a >= b for a, b in zip(bids, bids[1:])):
+            problems.append("stored bids are not strictly increasing")
+        if listing.bid_count != len(bids):
+            problems.append(f"bid_count is {listing.bid_count}")
+        if bids and listing.current_bid != bids[-1]:
+            problems.append(f"current_bid is {listing.current_bid}")
+        if problems:
+            raise CommandError("; ".join(problems))
+        self.stdout.write(self.style.SUCCESS("No lost or out of order bids"))
@@ -0,0 +1,304 @@
+import asyncio
+import json
+import multiprocessing
+import random
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import AsyncClient, Client
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+
+from auctions.models import Category, GeneratedDescription, Listing, User
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the OpenAI chat completion endpoint, answering every
+    request after the delay of the server
+    """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.delay)
+        body = json.dumps(
+            {
+                "id": "benchmark",
+                "object": "chat.completion",
+                "model": "gpt-3.5-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": "A benchmark description.",
+                        },
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 20,
+                    "completion_tokens": 5,
+                    "total_tokens": 25,
+                },
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_request(rng, ai_share, listing_id):
+    """
+    Returns the kind, method, path and body of the next request of a client
+    """
+    if rng.random() < ai_share:
+        return (
+            "ai",
+            "post",
+            reverse("generate_description"),
+            # A new title every time, so no description comes from the cache
+            {"title": f"Benchmark concurrency {rng.getrandbits(32)}"},
+        )
+    path = rng.choice(
+        [
+            reverse("listings"),
+            reverse("listing", args=[listing_id]),
+            reverse("categories"),
+        ]
+    )
+    return "browse", "get", path, None
+
+
+def serve_sync(clients, options, token, listing_id):
+    """
+    Runs clients against one sync worker, which serves a single request at
+    a time like a WSGI worker, and returns (kind, seconds, status) of every
+    request
+    """
+    worker = threading.Lock()
+    results = []
+    deadline = time.monotonic() + options["seconds"]
+
+    def run(seed):
+        rng = random.Random(seed)
+        client = Client()
+        try:
+            while time.monotonic() < deadline:
+                kind, method, path, data = get_request(
+                    rng, options["ai_share"], listing_id
+                )
+                start = time.monotonic()
+                with worker:
+                    response = getattr(client, method)(
+                        path,
+                        data,
+                        content_type="application/json",
+                        headers={"authorization": f"Token {token}"},
+                    )
+                results.append(
+                    (kind, time.monotonic() - start, response.status_code)
+                )
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+async def serve_async(clients, options, token, listing_id):
+    """
+    Runs clients against one async worker, which serves every request on
+    its event loop like an ASGI worker, and returns (kind, seconds, status)
+    of every request
+    """
+    results = []
+    deadline = time.monotonic() + options["seconds"]
+
+    async def run(seed):
+        rng = random.Random(seed)
+        client = AsyncClient()
+        while time.monotonic() < deadline:
+            kind, method, path, data = get_request(
+                rng, options["ai_share"], listing_id
+            )
+            start = time.monotonic()
+            response = await getattr(client, method)(
+                path,
+                data,
+                content_type="application/json",
+                headers={"authorization": f"Token {token}"},
+            )
+            results.append(
+                (kind, time.monotonic() - start, response.status_code)
+            )
+
+    await asyncio.gather(*(run(i) for i in clients))
+    await sync_to_async(connections.close_all)()
+    return results
+
+
+def serve(mode, clients, options, token, listing_id, queue):
+    """
+    Entry point of a worker process
+    """
+    if mode == "WSGI":
+        results = serve_sync(clients, options, token, listing_id)
+    else:
+        results = asyncio.run(serve_async(clients, options, token, listing_id))
+    queue.put(results)
+
+
+class Command(BaseCommand):
+    """
+    Compares how many requests the same number of WSGI and ASGI workers
+    serve when some of the requests wait on a slow upstream, as the AI
+    description does on OpenAI.
+
+    Each worker is a process. A WSGI worker serves one request at a time;
+    an ASGI worker serves all of its clients on one event loop. The clients
+    browse (listing feed, listing, categories) and generate descriptions
+    against a local stand-in for OpenAI that answers after --upstream-delay
+    seconds. The requests go through Django's handlers in-process, so this
+    measures the concurrency of the two models rather than a web server.
+    Everything it creates is deleted at the end.
+    """
+
+    help = "Load test of WSGI vs ASGI workers with a slow upstream"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=2,
+            help="Number of worker processes (default: 2)",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=32,
+            help="Number of concurrent clients (default: 32)",
+        )
+        parser.add_argument(
+            "--seconds",
+            type=float,
+            default=5,
+            help="Duration of each run (default: 5)",
+        )
+        parser.add_argument(
+            "--upstream-delay",
+            type=float,
+            default=1,
+            help="Seconds the upstream takes to answer (default: 1)",
+        )
+        parser.add_argument(
+            "--ai-share",
+            type=float,
+            default=0.2,
+            help="Share of the requests generating a description "
+            "(default: 0.2)",
+        )
+
+    def handle(self, *args, **options):
+        upstream = ThreadingHTTPServer(("127.0.0.1", 0), UpstreamHandler)
+        upstream.delay = options["upstream_delay"]
+        upstream.daemon_threads = True
+        threading.Thread(target=upstream.serve_forever, daemon=True).start()
+        api_base = openai.api_base
+        openai.api_base = f"http://127.0.0.1:{upstream.server_port}/v1"
+        user = User.objects.create(username="benchmark_concurrency")
+        category = Category.objects.create(category="benchmark_concurrency")
+        listing = Listing.objects.create(
+            user=user,
+            category=category,
+            title="Benchmark concurrency",
+            description="Benchmark concurrency",
+            starting_bid=1,
+        )
+        token = Token.objects.create(user=user)
+        try:
+            self.stdout.write(
+                f"{'':<6} {'requests/sec':>12} {'browse p50/p95 ms':>20} "
+                f"{'ai p50/p95 ms':>18} {'errors':>7}"
+            )
+            for mode in ("WSGI", "ASGI"):
+                results = self.run(mode, options, token.key, listing.pk)
+                self.report(mode, results, options["seconds"])
+        finally:
+            openai.api_base = api_base
+            upstream.shutdown()
+            GeneratedDescription.objects.filter(
+                normalized_title__startswith="benchmark concurrency "
+            ).delete()
+            token.delete()
+            listing.delete()
+            category.delete()
+            user.delete()
+
+    def run(self, mode, options, token, listing_id):
+        """
+        Runs the clients spread over the worker processes and returns the
+        results of all of them
+        """
+        # The workers are forked, so they must not share a connection
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        processes = [
+            context.Process(
+                target=serve,
+                args=(
+                    mode,
+                    range(i, options["concurrency"], options["workers"]),
+                    options,
+                    token,
+                    listing_id,
+                    queue,
+                ),
+            )
+            for i in range(options["workers"])
+        ]
+        for process in processes:
+            process.start()
+        results = [result for _ in processes for result in queue.get()]
+        for process in processes:
+            process.join()
+        return results
+
+    def report(self, mode, results, seconds):
+        """
+        Writes the throughput, latencies and errors of a run
+        """
+
+        def percentiles(kind):
+            latencies = [
+                elapsed * 1000
+                for result_kind, elapsed, _ in results
+                if result_kind == kind
+            ]
+            if len(latencies) < 2:
+                return "-"
+            cuts = statistics.quantiles(latencies, n=20)
+            return f"{cuts[9]:.0f}/{cuts[18]:.0f}"
+
+        errors = sum(1 for _, _, status in results if status >= 400)
+        self.stdout.write(
+            f"{mode:<6} {len(results) / seconds:>12.1f} "
+            f"{percentiles('browse'):>20} {percentiles('ai'):>18} "
+            f"{errors:>7}"
+        )
@@ -0,0 +1,187 @@
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test.utils import override_settings
+
+from auctions.models import Category, Listing, ProxyBid, User
+from auctions.proxies import resolve_proxy_bids
+
+# SQLite defaults, as the database ran before SQLITE_PRAGMAS: rollback
+# journal, full sync on every commit and the 5 second lock timeout of the
+# Python sqlite3 module
+DEFAULT_PRAGMAS = {
+    "journal_mode": "delete",
+    "synchronous": "full",
+    "busy_timeout": 5000,
+    "mmap_size": 0,
+    "cache_size": -2000,
+    "temp_store": "default",
+}
+
+
+class Command(BaseCommand):
+    """
+    Runs a mixed read and write load against the database, first with the
+    SQLite defaults and then with the SQLITE_PRAGMAS setting, and reports
+    the reads, bids and "database is locked" errors per second of each.
+
+    Readers load a page of the listing feed and a listing; writers place
+    bids, which two maximum bids on every listing answer through proxy
+    resolution, as a bid request does. Every thread has its own connection, so this runs against the
+    configured database (not an in-memory one). Everything it creates is
+    deleted at the end, and the database is left with SQLITE_PRAGMAS.
+    """
+
+    help = "Mixed read/write benchmark of the SQLite settings"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--seconds",
+            type=float,
+            default=5,
+            help="Duration of each run (default: 5)",
+        )
+        parser.add_argument(
+            "--readers",
+            type=int,
+            default=8,
+            help="Number of reading threads (default: 8)",
+        )
+        parser.add_argument(
+            "--writers",
+            type=int,
+            default=4,
+            help="Number of bidding threads (default: 4)",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite" or connection.is_in_memory_db():
+            raise CommandError("An on-disk SQLite database is required")
+        seller = User.objects.create(username="benchmark_database_seller")
+        category = Category.objects.create(category="benchmark_database")
+        bidders = [
+            User.objects.create(username=f"benchmark_database_{i}")
+            for i in range(options["writers"])
+        ]
+        listings = [
+            Listing.objects.create(
+                user=seller,
+                category=category,
+                title=f"Benchmark database {i}",
+                description="Benchmark database",
+                starting_bid=1,
+            )
+            for i in range(50)
+        ]
+        proxies = [
+            User.objects.create(username=f"benchmark_database_proxy_{i}")
+            for i in range(2)
+        ]
+        ProxyBid.objects.bulk_create(
+            [
+                ProxyBid(listing=listing, user=user, max_bid=10**9 + i)
+                for listing in listings
+                for i, user in enumerate(proxies)
+            ]
+        )
+        profiles = [
+            ("defaults", DEFAULT_PRAGMAS),
+            ("SQLITE_PRAGMAS", settings.SQLITE_PRAGMAS),
+        ]
+        try:
+            for name, pragmas in profiles:
+                reads, bids, errors = self.run(
+                    listings, bidders, pragmas, options
+                )
+                seconds = options["seconds"]
+                self.stdout.write(
+                    f"{name:<16} {reads / seconds:>8.0f} reads/sec "
+                    f"{bids / seconds:>8.0f} bids/sec "
+                    f"{errors / seconds:>6.1f} errors/sec"
+                )
+        finally:
+            connections.close_all()
+            for listing in listings:
+                listing.delete()
+            category.delete()
+            for user in [seller, *bidders, *proxies]:
+                user.delete()
+
+    def run(self, listings, bidders, pragmas, options):
+        """
+        Runs the readers and writers for the given number of seconds with
+        pragmas applied to every connection, and returns the numbers of
+        reads, bids and errors
+        """
+        counts = {"reads": 0, "bids": 0, "errors": 0}
+        lock = threading.Lock()
+        deadline = None
+
+        def count(key):
+            with lock:
+                counts[key] += 1
+
+        def read(seed):
+            rng = random.Random(seed)
+            try:
+                while time.monotonic() < deadline:
+                    try:
+                        list(
+                            Listing.objects.filter(active=True)
+                            .with_details()
+                            .order_by("-created_at")[:8]
+                        )
+                        Listing.objects.with_details().get(
+                            pk=rng.choice(listings).pk
+                        )
+                    except OperationalError:
+                        count("errors")
+                        continue
+                    count("reads")
+            finally:
+                connections.close_all()
+
+        def write(bidder):
+            rng = random.Random(bidder.pk)
+            try:
+                while time.monotonic() < deadline:
+                    listing = rng.choice(listings)
+                    try:
+                        current = (
+                            Listing.objects.filter(pk=listing.pk)
+                            .values_list("current_bid", flat=True)
+                            .get()
+                        )
+                        if listing.place_bid(bidder, current + 1):
+                            resolve_proxy_bids(listing)
+                    except OperationalError:
+                        count("errors")
+                        continue
+                    count("bids")
+            finally:
+                connections.close_all()
+
+        with override_settings(SQLITE_PRAGMAS=pragmas):
+            # The journal mode is stored in the database file, so switch it
+            # from a single connection before the threads connect
+            connections.close_all()
+            connection.ensure_connection()
+            connection.close()
+            threads = [
+                threading.Thread(target=read, args=(i,))
+                for i in range(options["readers"])
+            ] + [
+                threading.Thread(target=write, args=(bidder,))
+                for bidder in bidders
+            ]
+            deadline = time.monotonic() + options["seconds"]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        connection.ensure_connection()
+        return counts["reads"], counts["bids"], counts["errors"]
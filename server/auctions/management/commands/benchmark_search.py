@@ -0,0 +1,148 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from auctions.models import Category, Listing, User
+from auctions.search import search_listings
+
+WORDS = [
+    "vintage",
+    "leather",
+    "jacket",
+    "camera",
+    "lens",
+    "guitar",
+    "amplifier",
+    "bicycle",
+    "helmet",
+    "watch",
+    "ceramic",
+    "vase",
+    "desk",
+    "lamp",
+    "chair",
+    "record",
+    "player",
+    "vinyl",
+    "novel",
+    "paperback",
+    "hardcover",
+    "poster",
+    "sneakers",
+    "boots",
+    "wool",
+    "scarf",
+    "kettle",
+    "espresso",
+    "grinder",
+    "monitor",
+    "keyboard",
+    "mouse",
+    "tablet",
+    "phone",
+    "charger",
+    "speaker",
+    "headphones",
+    "backpack",
+    "tent",
+    "stove",
+    "kayak",
+    "paddle",
+    "skates",
+]
+QUERIES = ["camera", "vint", "leather jacket", "espresso grinder", "zzz"]
+
+
+class Command(BaseCommand):
+    """
+    Measures listing search latency with and without the full-text index.
+
+    The listings are generated inside a transaction that is rolled back at
+    the end, so the database is left unchanged.
+    """
+
+    help = "Benchmark listing search latency on generated listings"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--listings",
+            type=int,
+            default=100000,
+            help="Number of listings to generate (default: 100000)",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Number of times each query is timed (default: 5)",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.generate(options["listings"])
+            self.stdout.write(
+                f"{'query':<20}{'icontains':>12}{'fts':>12}{'fts+rank':>12}"
+            )
+            for query in QUERIES:
+                substring = self.time(
+                    lambda: Listing.objects.filter(title__icontains=query),
+                    options["repeat"],
+                )
+                fts = self.time(
+                    lambda: search_listings(Listing.objects.all(), query),
+                    options["repeat"],
+                )
+                ranked = self.time(
+                    lambda: search_listings(
+                        Listing.objects.all(), query, rank=True
+                    ).order_by("search_rank"),
+                    options["repeat"],
+                )
+                self.stdout.write(
+                    f"{query:<20}{substring:>10.2f}ms{fts:>10.2f}ms"
+                    f"{ranked:>10.2f}ms"
+                )
+            transaction.set_rollback(True)
+
+    def generate(self, count):
+        """
+        Creates the given number of listings with random titles
+        """
+        user = User.objects.create(username="benchmark_search_user")
+        category = Category.objects.create(category="benchmark_search")
+        rng = random.Random(0)
+        # Mix the query words into a larger vocabulary of made up words
+        vocabulary = WORDS + [
+            "".join(rng.choices("abcdefghijklmnopqrstuvwxy", k=7))
+            for _ in range(5000)
+        ]
+        batch = []
+        for _ in range(count):
+            batch.append(
+                Listing(
+                    user=user,
+                    category=category,
+                    title=" ".join(rng.sample(vocabulary, 3)),
+                    description=" ".join(rng.choices(vocabulary, k=30)),
+                    starting_bid=1,
+                    current_bid=1,
+                )
+            )
+            if len(batch) == 5000:
+                Listing.objects.bulk_create(batch)
+                batch = []
+        Listing.objects.bulk_create(batch)
+
+    def time(self, build_queryset, repeat):
+        """
+        Returns the median time in milliseconds to fetch the first page
+        """
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(build_queryset()[:8])
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
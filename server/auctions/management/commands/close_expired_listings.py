@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from auctions.expiry import EXPIRY_BATCH_SIZE, close_expired_listings
+
+
+class Command(BaseCommand):
+    """
+    Closes the listings whose end time has passed and sets their winners.
+
+    Run it once from a scheduler such as cron, or with --interval to keep
+    it running as a worker that checks for expired listings every few
+    seconds. Several workers can run at once; each batch skips the listings
+    another worker is closing.
+    """
+
+    help = "Close the listings that reached their end time"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=EXPIRY_BATCH_SIZE,
+            help="Number of listings closed per transaction "
+            f"(default: {EXPIRY_BATCH_SIZE})",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=None,
+            help="Keep running and check every given number of seconds",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.perf_counter()
+            count = close_expired_listings(batch_size=options["batch_size"])
+            if count or options["interval"] is None:
+                elapsed = time.perf_counter() - start
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"Closed {count} expired listings in {elapsed:.2f}s"
+                    )
+                )
+            if options["interval"] is None:
+                return
+            close_old_connections()
+            time.sleep(options["interval"])
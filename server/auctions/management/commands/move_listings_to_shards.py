@@ -0,0 +1,159 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+
+from auctions.catalog import reconcile_active_counts
+from auctions.clusters import rebuild_clusters
+from auctions.models import Bid, Comment, Listing, ProxyBid, Rating, Watchlist
+from auctions.shards import (
+    get_category_shard,
+    get_listing_shard,
+    get_next_listing_id,
+    get_shards,
+    mirror_references,
+)
+from auctions.viewers import invalidate_viewer_contexts
+
+# Models stored with a listing that are copied along with it, in an order
+# that copies the rows others refer to first
+LISTING_ROW_MODELS = [Bid, ProxyBid, Rating, Watchlist, Comment]
+
+
+class Command(BaseCommand):
+    """
+    Moves the listings still stored in the default database into the shards
+    of their categories, with their bids, maximum bids, ratings, watches
+    and comments. Run it once after adding LISTING_SHARDS to a database
+    that already has listings, with the site stopped: a listing is copied
+    into its shard before it is deleted from the default database, so a
+    run that is interrupted leaves a listing in both, never in neither.
+
+    The id of a listing encodes its shard, so a listing whose id maps to
+    another shard than its category's gets a new id, and its old URL stops
+    working. The rows stored with it get new ids in the shard as well.
+    Afterwards the category counts and map clusters are recomputed from
+    the shards.
+    """
+
+    help = "Move the listings of the default database into their shards"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many listings would be moved",
+        )
+
+    def handle(self, *args, **options):
+        if not get_shards():
+            raise CommandError("LISTING_SHARDS is not set")
+        listings = (
+            Listing.objects.using(DEFAULT_DB_ALIAS)
+            .order_by("id")
+            .values_list("id", "category_id")
+        )
+        moves = [
+            (listing_id, get_category_shard(category_id))
+            for listing_id, category_id in listings.iterator()
+            if not self.is_in_shard(listing_id, category_id)
+        ]
+        if options["dry_run"]:
+            self.stdout.write(f"{len(moves)} listings would be moved")
+            return
+        renumbered = 0
+        for listing_id, alias in moves:
+            new_id = self.move(listing_id, alias)
+            renumbered += new_id != listing_id
+        categories = reconcile_active_counts(shards=get_shards())
+        clusters = rebuild_clusters(shards=get_shards())
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Moved {len(moves)} listings ({renumbered} with a new id), "
+                f"reconciled {categories} categories and rebuilt "
+                f"{clusters} map clusters"
+            )
+        )
+
+    def is_in_shard(self, listing_id, category_id):
+        """
+        Returns if a listing of the default database is where the routing
+        looks for it: the default database is its category's shard and the
+        shard its id maps to
+        """
+        return (
+            get_category_shard(category_id) == DEFAULT_DB_ALIAS
+            and get_listing_shard(listing_id) == DEFAULT_DB_ALIAS
+        )
+
+    def move(self, listing_id, alias):
+        """
+        Copies a listing and its rows from the default database into the
+        shard alias, deletes it from the default database and returns its
+        id in the shard
+        """
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            with transaction.atomic(using=alias):
+                listing = Listing.objects.using(DEFAULT_DB_ALIAS).get(
+                    pk=listing_id
+                )
+                new_id = listing_id
+                if (
+                    get_listing_shard(listing_id) != alias
+                    or Listing.objects.using(alias)
+                    .filter(pk=listing_id)
+                    .exists()
+                ):
+                    new_id = get_next_listing_id(Listing.objects, alias)
+                winner_bid_id = listing.winner_bid_id
+                listing.pk = new_id
+                listing.winner_bid = None
+                self.copy(listing, alias)
+                ids = {Listing: {listing_id: new_id}}
+                users = set()
+                for model in LISTING_ROW_MODELS:
+                    ids[model] = {}
+                    rows = (
+                        model.objects.using(DEFAULT_DB_ALIAS)
+                        .filter(listing_id=listing_id)
+                        .order_by("id")
+                    )
+                    for row in rows:
+                        old_id = row.pk
+                        users.add(row.user_id)
+                        row.pk = None
+                        self.remap(row, ids)
+                        self.copy(row, alias)
+                        ids[model][old_id] = row.pk
+                if winner_bid_id is not None:
+                    Listing.objects.using(alias).filter(pk=new_id).update(
+                        winner_bid_id=ids[Bid][winner_bid_id]
+                    )
+            # Deleted once the copy committed
+            Listing.objects.using(DEFAULT_DB_ALIAS).filter(
+                pk=listing_id
+            ).delete()
+            invalidate_viewer_contexts(users, using=DEFAULT_DB_ALIAS)
+        return new_id
+
+    def remap(self, row, ids):
+        """
+        Points the foreign keys of a row copied along with a listing at the
+        copies of the rows they referred to
+        """
+        for field in row._meta.concrete_fields:
+            if not isinstance(field, models.ForeignKey):
+                continue
+            value = getattr(row, field.attname)
+            if value is not None and field.related_model in ids:
+                setattr(row, field.attname, ids[field.related_model][value])
+
+    def copy(self, instance, alias):
+        """
+        Inserts instance into the shard alias as it is, without the auto
+        timestamps or the signals a normal save would apply, after copying
+        the user and category it refers to
+        """
+        mirror_references(instance, alias)
+        instance._state.adding = True
+        models.Model.save_base(
+            instance, using=alias, raw=True, force_insert=True
+        )
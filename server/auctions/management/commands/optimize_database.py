@@ -0,0 +1,97 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from auctions.database import get_sqlite_pragma
+from auctions.shards import get_shards
+
+# SQLite auto_vacuum mode in which free pages are returned on request
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class Command(BaseCommand):
+    """
+    Keeps the SQLite database fast: refreshes the statistics the query
+    planner chooses indexes with, returns free pages to the file system and
+    truncates the write-ahead log.
+
+    Run it from a scheduler such as cron, for example daily. PRAGMA
+    optimize only analyzes the tables whose statistics are out of date, so
+    it is cheap enough to run often; --analyze analyzes every table. The
+    default database and every listing shard are optimized in turn.
+    """
+
+    help = "Analyze, vacuum and checkpoint the SQLite database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--analyze",
+            action="store_true",
+            help="Run a full ANALYZE instead of PRAGMA optimize",
+        )
+        parser.add_argument(
+            "--vacuum",
+            action="store_true",
+            help="Rebuild the database once so that free pages can be "
+            "returned incrementally from then on",
+        )
+        parser.add_argument(
+            "--pages",
+            type=int,
+            default=0,
+            help="Maximum number of free pages returned (default: all)",
+        )
+
+    def handle(self, *args, **options):
+        aliases = [DEFAULT_DB_ALIAS]
+        aliases += [alias for alias in get_shards() if alias not in aliases]
+        for alias in aliases:
+            if connections[alias].vendor != "sqlite":
+                raise CommandError(
+                    f"Only SQLite databases are supported, not {alias}"
+                )
+        for alias in aliases:
+            self.optimize(alias, options)
+
+    def optimize(self, alias, options):
+        """
+        Optimizes the database alias
+        """
+        connection = connections[alias]
+        start = time.perf_counter()
+        with connection.cursor() as cursor:
+            if options["analyze"]:
+                cursor.execute("ANALYZE")
+            else:
+                cursor.execute("PRAGMA optimize")
+            free_pages = get_sqlite_pragma(connection, "freelist_count")
+            auto_vacuum = get_sqlite_pragma(connection, "auto_vacuum")
+            if options["vacuum"] and auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+                # Changing auto_vacuum only takes effect after a VACUUM,
+                # which rewrites the whole file
+                cursor.execute(
+                    f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}"
+                )
+                cursor.execute("VACUUM")
+            elif auto_vacuum == AUTO_VACUUM_INCREMENTAL:
+                # Each step of the statement frees one page, and only
+                # executescript steps it to the end
+                connection.connection.executescript(
+                    f"PRAGMA incremental_vacuum({options['pages']});"
+                )
+            elif free_pages:
+                self.stdout.write(
+                    f"{free_pages} free pages kept in {alias}, run with "
+                    "--vacuum to return them"
+                )
+            if get_sqlite_pragma(connection, "journal_mode") == "wal":
+                cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        returned = free_pages - get_sqlite_pragma(connection, "freelist_count")
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Optimized {alias} in {elapsed:.2f}s, returned "
+                f"{returned} free pages"
+            )
+        )
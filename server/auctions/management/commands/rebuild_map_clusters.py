@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from auctions.clusters import rebuild_clusters
+from auctions.models import Listing
+from auctions.shards import get_shards, use_shard
+
+
+class Command(BaseCommand):
+    """
+    Recomputes the map clusters from the active listings.
+
+    Clusters are maintained incrementally as listings are created, moved
+    and closed; this command is needed after bulk loads that bypass that
+    (such as loaddata) and shrinks cluster bounding boxes back to fit.
+    Listings loaded without obfuscated coordinates get them first. When
+    listings are sharded, the clusters cover the listings of every shard.
+    """
+
+    help = "Rebuild the precomputed map clusters"
+
+    def handle(self, *args, **options):
+        for alias in get_shards() or [None]:
+            with use_shard(alias):
+                self.set_public_coordinates()
+        count = rebuild_clusters(shards=get_shards())
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} map clusters"))
+
+    def set_public_coordinates(self):
+        """
+        Obfuscates the coordinates of the listings of the current shard
+        that have none
+        """
+        listings = Listing.objects.filter(
+            latitude__isnull=False,
+            longitude__isnull=False,
+            public_latitude__isnull=True,
+        )
+        for listing in listings.iterator():
+            listing.set_public_coordinates()
+            Listing.objects.filter(pk=listing.pk).update(
+                public_latitude=listing.public_latitude,
+                public_longitude=listing.public_longitude,
+            )
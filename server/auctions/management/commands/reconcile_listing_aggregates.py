@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+
+from auctions.catalog import reconcile_active_counts
+from auctions.models import Listing
+from auctions.shards import get_shards, use_shard
+
+
+class Command(BaseCommand):
+    """
+    Recomputes the stored bid, rating and watchlist aggregates on listings,
+    and the active listing counts of the categories.
+
+    Listings are processed in primary key chunks, each in its own
+    transaction, so the command can backfill or repair a large table
+    without holding a long write lock. When listings are sharded, every
+    shard is processed in turn and the category counts add up the listings
+    of all of them.
+    """
+
+    help = "Backfill or reconcile the stored aggregates on listings"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of listings updated per transaction (default: 1000)",
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        for alias in get_shards() or [None]:
+            with use_shard(alias):
+                total += self.reconcile(options["chunk_size"])
+        categories = reconcile_active_counts(shards=get_shards())
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Reconciled aggregates on {total} listings and "
+                f"{categories} categories"
+            )
+        )
+
+    def reconcile(self, chunk_size):
+        """
+        Reconciles the listings of the current shard and returns the number
+        of listings updated
+        """
+        using = router.db_for_write(Listing)
+        last_id = 0
+        total = 0
+        while True:
+            # Get the ids of the next chunk of listings
+            ids = list(
+                Listing.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", flat=True)[:chunk_size]
+            )
+            if not ids:
+                break
+            with transaction.atomic(using=using):
+                total += Listing.objects.filter(
+                    id__gte=ids[0], id__lte=ids[-1]
+                ).reconcile_aggregates()
+            last_id = ids[-1]
+        return total
@@ -0,0 +1,90 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:47
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def backfill_aggregates(apps, schema_editor):
+    Listing = apps.get_model("auctions", "Listing")
+    Bid = apps.get_model("auctions", "Bid")
+    Rating = apps.get_model("auctions", "Rating")
+    Watchlist = apps.get_model("auctions", "Watchlist")
+    bids = Bid.objects.filter(listing=OuterRef("pk")).order_by()
+    ratings = Rating.objects.filter(listing=OuterRef("pk")).order_by()
+    watchlists = Watchlist.objects.filter(listing=OuterRef("pk")).order_by()
+    Listing.objects.update(
+        current_bid=Coalesce(
+            Subquery(bids.values("listing").annotate(m=Max("bid")).values("m")),
+            "starting_bid",
+        ),
+        bid_count=Coalesce(
+            Subquery(bids.values("listing").annotate(c=Count("pk")).values("c")),
+            0,
+        ),
+        rating_sum=Coalesce(
+            Subquery(ratings.values("listing").annotate(s=Sum("rating")).values("s")),
+            0,
+        ),
+        rating_count=Coalesce(
+            Subquery(ratings.values("listing").annotate(c=Count("pk")).values("c")),
+            0,
+        ),
+        watch_count=Coalesce(
+            Subquery(watchlists.values("listing").annotate(c=Count("pk")).values("c")),
+            0,
+        ),
+        winner_bid=Subquery(bids.filter(winner=True).order_by("-bid").values("pk")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auctions", "0004_comment_parent"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="comment",
+            options={"ordering": ["-created_at"]},
+        ),
+        migrations.AddField(
+            model_name="listing",
+            name="bid_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="listing",
+            name="current_bid",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="listing",
+            name="rating_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="listing",
+            name="rating_sum",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="listing",
+            name="watch_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="listing",
+            name="winner_bid",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="auctions.bid",
+            ),
+        ),
+        migrations.RunPython(backfill_aggregates, migrations.RunPython.noop),
+    ]
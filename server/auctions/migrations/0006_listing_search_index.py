@@ -0,0 +1,56 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:55
+
+import auctions.search
+from django.db import migrations, models
+import django.db.models.deletion
+
+from auctions.search import SEARCH_TABLE, install_search_index
+
+
+def create_search_index(apps, schema_editor):
+    install_search_index(schema_editor.connection, rebuild=True)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for trigger in ("insert", "delete", "update"):
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {SEARCH_TABLE}_{trigger}")
+    schema_editor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0005_listing_aggregates"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.CreateModel(
+            name="ListingSearch",
+            fields=[
+                (
+                    "listing",
+                    models.OneToOneField(
+                        db_column="rowid",
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        primary_key=True,
+                        related_name="search",
+                        serialize=False,
+                        to="auctions.listing",
+                    ),
+                ),
+                ("title", models.TextField()),
+                ("description", models.TextField()),
+                (
+                    "document",
+                    auctions.search.SearchField(db_column="auctions_listing_fts"),
+                ),
+                ("rank", models.FloatField()),
+            ],
+            options={
+                "db_table": "auctions_listing_fts",
+                "managed": False,
+            },
+        ),
+    ]
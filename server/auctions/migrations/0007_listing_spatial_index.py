@@ -0,0 +1,104 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+SPATIAL_TABLE = "auctions_listing_rtree"
+
+SPATIAL_INDEX_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SPATIAL_TABLE} USING rtree(
+        id,
+        min_latitude,
+        max_latitude,
+        min_longitude,
+        max_longitude
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SPATIAL_TABLE}_insert
+    AFTER INSERT ON auctions_listing
+    WHEN new.active AND new.latitude IS NOT NULL
+        AND new.longitude IS NOT NULL
+    BEGIN
+        INSERT INTO {SPATIAL_TABLE}
+        VALUES (
+            new.id, new.latitude, new.latitude,
+            new.longitude, new.longitude
+        );
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SPATIAL_TABLE}_delete
+    AFTER DELETE ON auctions_listing BEGIN
+        DELETE FROM {SPATIAL_TABLE} WHERE id = old.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SPATIAL_TABLE}_update
+    AFTER UPDATE OF active, latitude, longitude ON auctions_listing BEGIN
+        DELETE FROM {SPATIAL_TABLE} WHERE id = old.id;
+        INSERT INTO {SPATIAL_TABLE}
+        SELECT
+            new.id, new.latitude, new.latitude,
+            new.longitude, new.longitude
+        WHERE new.active AND new.latitude IS NOT NULL
+            AND new.longitude IS NOT NULL;
+    END
+    """,
+]
+
+
+def create_spatial_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for statement in SPATIAL_INDEX_SQL:
+        schema_editor.execute(statement)
+    schema_editor.execute(f"""
+        INSERT INTO {SPATIAL_TABLE}
+        SELECT id, latitude, latitude, longitude, longitude
+        FROM auctions_listing
+        WHERE active AND latitude IS NOT NULL AND longitude IS NOT NULL
+        """)
+
+
+def drop_spatial_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for trigger in ("insert", "delete", "update"):
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {SPATIAL_TABLE}_{trigger}")
+    schema_editor.execute(f"DROP TABLE IF EXISTS {SPATIAL_TABLE}")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0006_listing_search_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_spatial_index, drop_spatial_index),
+        migrations.CreateModel(
+            name="ListingLocation",
+            fields=[
+                (
+                    "listing",
+                    models.OneToOneField(
+                        db_column="id",
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        primary_key=True,
+                        related_name="location",
+                        serialize=False,
+                        to="auctions.listing",
+                    ),
+                ),
+                ("min_latitude", models.FloatField()),
+                ("max_latitude", models.FloatField()),
+                ("min_longitude", models.FloatField()),
+                ("max_longitude", models.FloatField()),
+            ],
+            options={
+                "db_table": "auctions_listing_rtree",
+                "managed": False,
+            },
+        ),
+    ]
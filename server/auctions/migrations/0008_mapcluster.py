@@ -0,0 +1,44 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0007_listing_spatial_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MapCluster",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("zoom", models.IntegerField()),
+                ("cell_x", models.IntegerField()),
+                ("cell_y", models.IntegerField()),
+                ("count", models.IntegerField(default=0)),
+                ("latitude_sum", models.FloatField(default=0)),
+                ("longitude_sum", models.FloatField(default=0)),
+                ("min_latitude", models.FloatField()),
+                ("max_latitude", models.FloatField()),
+                ("min_longitude", models.FloatField()),
+                ("max_longitude", models.FloatField()),
+                ("listing_ids", models.JSONField(default=list)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="mapcluster",
+            constraint=models.UniqueConstraint(
+                fields=("zoom", "cell_x", "cell_y"), name="unique_map_cell"
+            ),
+        ),
+    ]
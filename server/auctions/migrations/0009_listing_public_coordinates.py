@@ -0,0 +1,68 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:00
+
+import importlib
+
+from django.db import migrations, models
+
+from auctions.clusters import rebuild_clusters
+from auctions.spatial import SPATIAL_TABLE, install_spatial_index
+from auctions.utils import get_map_coordinates_delta
+
+
+def set_public_coordinates(apps, schema_editor):
+    Listing = apps.get_model("auctions", "Listing")
+    listings = Listing.objects.filter(latitude__isnull=False, longitude__isnull=False)
+    for listing in listings.iterator():
+        listing.public_latitude = listing.latitude + get_map_coordinates_delta()
+        listing.public_longitude = listing.longitude + get_map_coordinates_delta()
+        listing.save(update_fields=["public_latitude", "public_longitude"])
+
+
+def index_public_coordinates(apps, schema_editor):
+    # Re-create the spatial index triggers on the public coordinates
+    if schema_editor.connection.vendor == "sqlite":
+        for trigger in ("insert", "delete", "update"):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {SPATIAL_TABLE}_{trigger}")
+        install_spatial_index(schema_editor.connection, rebuild=True)
+    rebuild_clusters(
+        apps.get_model("auctions", "Listing"),
+        apps.get_model("auctions", "MapCluster"),
+    )
+
+
+def index_precise_coordinates(apps, schema_editor):
+    # Restore the spatial index triggers on the precise coordinates
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for trigger in ("insert", "delete", "update"):
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {SPATIAL_TABLE}_{trigger}")
+    schema_editor.execute(f"DELETE FROM {SPATIAL_TABLE}")
+    spatial_index = importlib.import_module(
+        "auctions.migrations.0007_listing_spatial_index"
+    )
+    spatial_index.create_spatial_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0008_mapcluster"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="listing",
+            name="public_latitude",
+            field=models.DecimalField(
+                blank=True, decimal_places=17, max_digits=20, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="listing",
+            name="public_longitude",
+            field=models.DecimalField(
+                blank=True, decimal_places=17, max_digits=20, null=True
+            ),
+        ),
+        migrations.RunPython(set_public_coordinates, migrations.RunPython.noop),
+        migrations.RunPython(index_public_coordinates, index_precise_coordinates),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def set_comment_threads(apps, schema_editor):
+    Comment = apps.get_model("auctions", "Comment")
+    parents = dict(Comment.objects.values_list("id", "parent_id"))
+    replies = []
+    for comment in Comment.objects.filter(parent__isnull=False):
+        # Walk up to the top level comment of the thread
+        thread_id = comment.parent_id
+        while parents[thread_id] is not None:
+            thread_id = parents[thread_id]
+        comment.thread_id = thread_id
+        replies.append(comment)
+    Comment.objects.bulk_update(replies, ["thread"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0009_listing_public_coordinates"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="thread",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="thread_replies",
+                to="auctions.comment",
+            ),
+        ),
+        migrations.RunPython(set_comment_threads, migrations.RunPython.noop),
+    ]
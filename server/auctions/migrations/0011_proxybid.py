@@ -0,0 +1,63 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:11
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0010_comment_thread"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProxyBid",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("max_bid", models.IntegerField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "listing",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="proxy_bids",
+                        to="auctions.listing",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="proxy_bids",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        models.F("listing"),
+                        models.OrderBy(models.F("max_bid"), descending=True),
+                        models.F("updated_at"),
+                        name="proxy_bid_rank",
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="proxybid",
+            constraint=models.UniqueConstraint(
+                fields=("listing", "user"), name="unique_proxy_bid"
+            ),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0011_proxybid"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="listing",
+            name="ends_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="bid",
+            index=models.Index(
+                models.F("listing"),
+                models.OrderBy(models.F("bid"), descending=True),
+                name="bid_listing_rank",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="listing",
+            index=models.Index(
+                condition=models.Q(("active", True)),
+                fields=["ends_at"],
+                name="listing_expiry",
+            ),
+        ),
+    ]
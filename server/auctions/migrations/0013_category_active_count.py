@@ -0,0 +1,27 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+from auctions.catalog import reconcile_active_counts
+
+
+def backfill_active_counts(apps, schema_editor):
+    reconcile_active_counts(
+        category_model=apps.get_model("auctions", "Category"),
+        listing_model=apps.get_model("auctions", "Listing"),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0012_listing_ends_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="category",
+            name="active_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_active_counts, migrations.RunPython.noop),
+    ]
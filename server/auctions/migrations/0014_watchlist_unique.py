@@ -0,0 +1,30 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:37
+
+from django.db import migrations, models
+
+from auctions.watchlists import recount_watches, remove_duplicate_watches
+
+
+def remove_duplicates(apps, schema_editor):
+    watchlist_model = apps.get_model("auctions", "Watchlist")
+    if remove_duplicate_watches(watchlist_model=watchlist_model):
+        recount_watches(
+            listing_model=apps.get_model("auctions", "Listing"),
+            watchlist_model=watchlist_model,
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0013_category_active_count"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="watchlist",
+            constraint=models.UniqueConstraint(
+                fields=("user", "listing"), name="unique_watchlist"
+            ),
+        ),
+    ]
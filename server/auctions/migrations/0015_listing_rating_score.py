@@ -0,0 +1,39 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+from auctions.models import get_rating_score
+
+
+def backfill_rating_scores(apps, schema_editor):
+    listing_model = apps.get_model("auctions", "Listing")
+    listing_model.objects.update(
+        rating_score=get_rating_score(
+            models.F("rating_sum"), models.F("rating_count")
+        )
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0014_watchlist_unique"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="listing",
+            name="rating_score",
+            field=models.FloatField(default=3),
+        ),
+        migrations.AddIndex(
+            model_name="listing",
+            index=models.Index(
+                models.OrderBy(models.F("rating_score"), descending=True),
+                models.OrderBy(models.F("created_at"), descending=True),
+                name="listing_rating_rank",
+            ),
+        ),
+        migrations.RunPython(
+            backfill_rating_scores, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0015_listing_rating_score"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="bid",
+            index=models.Index(
+                condition=models.Q(("winner", True)),
+                fields=["user"],
+                name="bid_user_wins",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["listing", "parent", "created_at"],
+                name="comment_listing_roots",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="listing",
+            index=models.Index(fields=["created_at"], name="listing_recent"),
+        ),
+        migrations.AddIndex(
+            model_name="listing",
+            index=models.Index(
+                condition=models.Q(("active", True)),
+                fields=["created_at"],
+                name="listing_active_recent",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="listing",
+            index=models.Index(
+                condition=models.Q(("active", False)),
+                fields=["created_at"],
+                name="listing_closed_recent",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="listing",
+            index=models.Index(
+                condition=models.Q(("active", True)),
+                fields=["category", "created_at"],
+                name="listing_category_recent",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="listing",
+            index=models.Index(
+                fields=["user", "created_at"], name="listing_user_recent"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="rating",
+            index=models.Index(
+                fields=["listing", "user"], name="rating_listing_user"
+            ),
+        ),
+    ]
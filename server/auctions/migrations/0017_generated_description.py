@@ -0,0 +1,59 @@
+# Generated by Django 4.2.2 on 2026-10-18 13:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0016_hot_path_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GeneratedDescription",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("normalized_title", models.CharField(max_length=64)),
+                ("description", models.TextField()),
+                ("model", models.CharField(max_length=64)),
+                ("latency", models.FloatField()),
+                ("prompt_tokens", models.IntegerField(default=0)),
+                ("completion_tokens", models.IntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "category",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="generated_descriptions",
+                        to="auctions.category",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="generateddescription",
+            constraint=models.UniqueConstraint(
+                fields=("normalized_title", "category"),
+                name="unique_generated_description",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="generateddescription",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("category__isnull", True)),
+                fields=("normalized_title",),
+                name="unique_uncategorized_description",
+            ),
+        ),
+    ]
@@ -1,8 +1,39 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import (
+    Count,
+    ExpressionWrapper,
+    F,
+    Max,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+)
+from django.db.models.functions import Coalesce
 from datetime import datetime
 from django.utils import timezone
-from .utils import get_time_ago
+from .database import immediate_atomic
+from .events import (
+    get_bid_event,
+    get_close_event,
+    get_comment_event,
+    publish_listing_event,
+)
+from .search import SEARCH_TABLE, SearchField
+from .shards import (
+    get_category_shard,
+    get_next_listing_id,
+    get_shards,
+    use_shard,
+)
+from .spatial import SPATIAL_TABLE
+from .utils import (
+    get_map_coordinates_delta,
+    get_time_ago,
+    invalidate_listing_collections,
+    to_decimal,
+)
 
 
 # User model
@@ -30,6 +61,9 @@ class User(AbstractUser):
 # Category model
 class Category(models.Model):
     category = models.CharField(max_length=64, unique=True)  # Category name
+    active_count = models.IntegerField(
+        default=0
+    )  # Number of active listings in the category
     created_at = models.DateTimeField(
         auto_now_add=True
     )  # Category created timestamp
@@ -40,9 +74,9 @@ class Category(models.Model):
     def __str__(self):
         return f"{self.category}"
 
-    # Returns the number of listings in the category
+    # Returns the number of active listings in the category
     def active_listing_count(self):
-        return self.listings.filter(active=True).count()
+        return self.active_count
 
 
 # Rating model
@@ -64,6 +98,132 @@ class Rating(models.Model):
     def __str__(self):
         return f"{self.rating}"
 
+    class Meta:
+        # Finds the rating of a user on a listing, and the ratings of the
+        # commenters of a listing
+        indexes = [
+            models.Index(
+                fields=["listing", "user"], name="rating_listing_user"
+            )
+        ]
+
+
+# Prior of the Bayesian rating score. A listing is scored as if it also had
+# RATING_PRIOR_WEIGHT ratings of RATING_PRIOR_MEAN, so a few high ratings do
+# not outrank many good ones.
+RATING_PRIOR_MEAN = 3
+RATING_PRIOR_WEIGHT = 5
+
+
+# Returns the expression of the Bayesian rating score of listings with the
+# given rating sum and count
+def get_rating_score(rating_sum, rating_count):
+    return ExpressionWrapper(
+        (rating_sum + RATING_PRIOR_MEAN * RATING_PRIOR_WEIGHT)
+        * 1.0
+        / (rating_count + RATING_PRIOR_WEIGHT),
+        output_field=models.FloatField(),
+    )
+
+
+# Number of times creating a listing in a shard is retried when a concurrent
+# one took the same id
+MAX_LISTING_ID_ATTEMPTS = 5
+
+
+# Queryset for listings
+class ListingQuerySet(models.QuerySet):
+    # Updates the listings and moves the listing collections to a new
+    # version, since an UPDATE skips the signals that do it on save
+    def update(self, **kwargs):
+        updated = super().update(**kwargs)
+        if updated:
+            invalidate_listing_collections(using=self.db)
+        return updated
+
+    # Selects the winning bid together with its user
+    def with_winner(self):
+        return self.select_related("winner_bid__user")
+
+    # Selects everything ListingSerializer needs so a page of listings is
+    # serialized with a constant number of queries. The fields that depend
+    # on the viewer come from the viewer context instead.
+    def with_details(self):
+        return self.select_related("user", "category").with_winner()
+
+    # Creates a listing in the shard of its category when listings are
+    # sharded, otherwise in the default database
+    def create_in_shard(self, **fields):
+        if not get_shards():
+            return self.create(**fields)
+        alias = get_category_shard(fields["category"].id)
+        with use_shard(alias):
+            for attempt in range(MAX_LISTING_ID_ATTEMPTS):
+                try:
+                    with immediate_atomic(using=alias):
+                        return self.create(
+                            id=get_next_listing_id(self, alias), **fields
+                        )
+                except IntegrityError:
+                    # A concurrent request took the id first
+                    if attempt == MAX_LISTING_ID_ATTEMPTS - 1:
+                        raise
+
+    # Recomputes the stored aggregates from the bid, rating and watchlist
+    # tables and returns the number of listings updated
+    def reconcile_aggregates(self):
+        bids = Bid.objects.filter(listing=OuterRef("pk")).order_by()
+        ratings = Rating.objects.filter(listing=OuterRef("pk")).order_by()
+        watchlists = Watchlist.objects.filter(
+            listing=OuterRef("pk")
+        ).order_by()
+        updated = self.order_by().update(
+            current_bid=Coalesce(
+                Subquery(
+                    bids.values("listing").annotate(m=Max("bid")).values("m")
+                ),
+                "starting_bid",
+            ),
+            bid_count=Coalesce(
+                Subquery(
+                    bids.values("listing").annotate(c=Count("pk")).values("c")
+                ),
+                0,
+            ),
+            rating_sum=Coalesce(
+                Subquery(
+                    ratings.values("listing")
+                    .annotate(s=Sum("rating"))
+                    .values("s")
+                ),
+                0,
+            ),
+            rating_count=Coalesce(
+                Subquery(
+                    ratings.values("listing")
+                    .annotate(c=Count("pk"))
+                    .values("c")
+                ),
+                0,
+            ),
+            watch_count=Coalesce(
+                Subquery(
+                    watchlists.values("listing")
+                    .annotate(c=Count("pk"))
+                    .values("c")
+                ),
+                0,
+            ),
+            winner_bid=Subquery(
+                bids.filter(winner=True).order_by("-bid").values("pk")[:1]
+            ),
+            updated_at=timezone.now(),
+        )
+        self.order_by().update(
+            rating_score=get_rating_score(F("rating_sum"), F("rating_count"))
+        )
+        return updated
+
 
 # Listing model
 class Listing(models.Model):
@@ -84,6 +244,34 @@ class Listing(models.Model):
     longitude = models.DecimalField(
         max_digits=20, decimal_places=17, blank=True, null=True
     )  # Listing longitude
+    public_latitude = models.DecimalField(
+        max_digits=20, decimal_places=17, blank=True, null=True
+    )  # Obfuscated latitude shown to other users
+    public_longitude = models.DecimalField(
+        max_digits=20, decimal_places=17, blank=True, null=True
+    )  # Obfuscated longitude shown to other users
+    current_bid = models.IntegerField(
+        default=0
+    )  # Highest bid, or the starting bid if there are no bids
+    bid_count = models.IntegerField(default=0)  # Number of bids
+    rating_sum = models.IntegerField(default=0)  # Sum of all ratings
+    rating_count = models.IntegerField(default=0)  # Number of ratings
+    rating_score = models.FloatField(
+        default=RATING_PRIOR_MEAN
+    )  # Bayesian average of the ratings, for ranking
+    watch_count = models.IntegerField(
+        default=0
+    )  # Number of users watching the listing
+    winner_bid = models.ForeignKey(
+        "Bid",
+        on_delete=models.SET_NULL,
+        related_name="+",
+        blank=True,
+        null=True,
+    )  # Winning bid, set when the listing is closed
+    ends_at = models.DateTimeField(
+        blank=True, null=True
+    )  # Auction end timestamp, empty if only closed by the owner
     created_at = models.DateTimeField(
         auto_now_add=True
     )  # Listing created timestamp
@@ -91,60 +279,243 @@ class Listing(models.Model):
         auto_now=True
     )  # Listing updated timestamp
 
+    objects = ListingQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.title}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        listing = super().from_db(db, field_names, values)
+        # Remember the location the listing was loaded with, so saving it
+        # can tell whether it moved
+        if {"latitude", "longitude"} <= set(field_names):
+            listing._coordinates = (listing.latitude, listing.longitude)
+        if {"active", "public_latitude", "public_longitude"} <= set(
+            field_names
+        ):
+            listing._map_position = listing.map_position()
+        if {"active", "category_id"} <= set(field_names):
+            listing._counted_category = listing.counted_category()
+        return listing
+
+    def save(self, *args, **kwargs):
+        # A new listing starts at its starting bid
+        if self._state.adding and not self.bid_count:
+            self.current_bid = int(self.starting_bid)
+        # Obfuscate the location once per move, so it stays stable across
+        # requests instead of averaging out to the real location
+        coordinates = (
+            to_decimal(self.latitude),
+            to_decimal(self.longitude),
+        )
+        if coordinates != getattr(self, "_coordinates", None):
+            self.set_public_coordinates()
+            self._coordinates = coordinates
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {
+                    *kwargs["update_fields"],
+                    "public_latitude",
+                    "public_longitude",
+                }
+        super().save(*args, **kwargs)
+
+    # Sets the obfuscated coordinates shown to users other than the owner
+    # and winner
+    def set_public_coordinates(self):
+        if self.latitude is None or self.longitude is None:
+            self.public_latitude = None
+            self.public_longitude = None
+        else:
+            self.public_latitude = (
+                to_decimal(self.latitude) + get_map_coordinates_delta()
+            )
+            self.public_longitude = (
+                to_decimal(self.longitude) + get_map_coordinates_delta()
+            )
+
     # Returns the time ago the listing was posted
     def posted_time_ago(self):
         return get_time_ago(self.created_at)
 
-    # Returns the highest bid on the listing
-    def get_highest_bid(self):
-        return self.bids.order_by("-bid").first()
+    # Returns the public (latitude, longitude) the listing is shown at on
+    # the map, or None if it is not shown
+    def map_position(self):
+        if (
+            not self.active
+            or self.public_latitude is None
+            or self.public_longitude is None
+        ):
+            return None
+        return float(self.public_latitude), float(self.public_longitude)
+
+    # Returns the category whose active count includes the listing, or None
+    # if it is not counted
+    def counted_category(self):
+        return self.category_id if self.active else None
+
+    # Returns if the auction has reached its end time
+    def has_ended(self):
+        return self.ends_at is not None and self.ends_at <= timezone.now()
 
     # Function to close the listing and set the highest bid as the winner
     def close_listing(self):
-        self.active = False
-        self.save()
-        highest_bid = self.bids.order_by("-bid").first()
-        if highest_bid:
-            highest_bid.winner = True
-            highest_bid.save()
-
-    # Returns the number of comments on the listing
-    def get_watchlist_count(self):
-        return self.watchlists.count()
-
-    # Returns the users who have the listing in their watchlist
-    def get_watchlist_users(self):
-        return self.watchlists.all().values_list("user", flat=True)
+        using = router.db_for_write(Listing, instance=self)
+        with immediate_atomic(using=using):
+            highest_bid = self.bids.order_by("-bid").first()
+            self.active = False
+            self.winner_bid = highest_bid
+            self.save(update_fields=["active", "winner_bid", "updated_at"])
+            if highest_bid:
+                Bid.objects.filter(pk=highest_bid.pk).update(
+                    winner=True, updated_at=timezone.now()
+                )
+            publish_listing_event(
+                self.pk, get_close_event(self), using=using
+            )
 
     # Returns the winner of the listing
     def winner(self):
-        return self.bids.filter(winner=True).first()
-
-    # Returns the current bid on the listing
-    def current_bid(self):
-        try:
-            # Return the highest bid if it exists
-            return self.bids.order_by("-bid").first().bid
-        except AttributeError:
-            # Return the starting bid if no bids exist
-            return self.starting_bid
-
-    # Returns the number of bids on the listing
-    def bid_count(self):
-        return self.bids.count()
+        return self.winner_bid
 
     def get_average_rating(self):
-        ratings = self.ratings.all()
-        if ratings:
-            return sum([rating.rating for rating in ratings]) / len(ratings)
+        if self.rating_count:
+            return self.rating_sum / self.rating_count
         else:
             return 0
 
+    # Places a bid if the listing is active, has not ended and the bid is
+    # greater than the current bid. The check and the aggregate update are
+    # one conditional UPDATE, so concurrent bidders cannot both pass the
+    # check, and the cost does not depend on the number of earlier bids.
+    # Returns the new bid, or None if it was rejected.
+    def place_bid(self, user, amount):
+        using = router.db_for_write(Listing, instance=self)
+        with transaction.atomic(using=using):
+            placed = (
+                Listing.objects.filter(pk=self.pk, active=True)
+                .filter(
+                    Q(ends_at__isnull=True) | Q(ends_at__gt=timezone.now())
+                )
+                .filter(Q(bid_count=0) | Q(current_bid__lt=amount))
+                .update(
+                    current_bid=amount,
+                    bid_count=F("bid_count") + 1,
+                    updated_at=timezone.now(),
+                )
+            )
+            if not placed:
+                return None
+            bid = Bid.objects.create(bid=amount, listing=self, user=user)
+            self.refresh_from_db(fields=["current_bid", "bid_count"])
+            publish_listing_event(
+                self.pk, get_bid_event(self, bid), using=using
+            )
+            return bid
+
+    # Records a new rating in the stored aggregates
+    def record_rating(self, rating):
+        Listing.objects.filter(pk=self.pk).update(
+            rating_sum=F("rating_sum") + rating,
+            rating_count=F("rating_count") + 1,
+            rating_score=get_rating_score(
+                F("rating_sum") + rating, F("rating_count") + 1
+            ),
+            updated_at=timezone.now(),
+        )
+
+    # Records a user starting (1) or stopping (-1) to watch the listing
+    def record_watch(self, delta):
+        Listing.objects.filter(pk=self.pk).update(
+            watch_count=F("watch_count") + delta,
+            updated_at=timezone.now(),
+        )
+
+    # Marks the listing as changed without saving it. Every write that
+    # changes how the listing is serialized moves updated_at, which is what
+    # the ETag of listing responses is derived from.
+    def touch(self):
+        Listing.objects.filter(pk=self.pk).update(updated_at=timezone.now())
+
     class Meta:
         ordering = ["-created_at"]
+        # Finds the expired auctions in end time order without scanning
+        # the listing table, and only indexes the open ones
+        indexes = [
+            models.Index(
+                fields=["ends_at"],
+                condition=Q(active=True),
+                name="listing_expiry",
+            ),
+            # Reads the top rated listings in order, for sort=rating
+            models.Index(
+                models.F("rating_score").desc(),
+                models.F("created_at").desc(),
+                name="listing_rating_rank",
+            ),
+            # Read the listings in creation order, scanned backwards for the
+            # newest first feeds. The partial indexes hold the open or the
+            # closed listings only, for the active and closed filters.
+            models.Index(fields=["created_at"], name="listing_recent"),
+            models.Index(
+                fields=["created_at"],
+                condition=Q(active=True),
+                name="listing_active_recent",
+            ),
+            models.Index(
+                fields=["created_at"],
+                condition=Q(active=False),
+                name="listing_closed_recent",
+            ),
+            models.Index(
+                fields=["category", "created_at"],
+                condition=Q(active=True),
+                name="listing_category_recent",
+            ),
+            models.Index(
+                fields=["user", "created_at"], name="listing_user_recent"
+            ),
+        ]
+
+
+# Full-text search index over listings, maintained by SQLite triggers
+class ListingSearch(models.Model):
+    listing = models.OneToOneField(
+        Listing,
+        on_delete=models.DO_NOTHING,
+        primary_key=True,
+        db_column="rowid",
+        related_name="search",
+    )  # Listing the row indexes
+    title = models.TextField()  # Indexed listing title
+    description = models.TextField()  # Indexed listing description
+    document = SearchField(
+        db_column=SEARCH_TABLE
+    )  # Column match expressions are run against
+    rank = models.FloatField()  # Relevance of the match, lower is better
+
+    class Meta:
+        managed = False
+        db_table = SEARCH_TABLE
+
+
+# Spatial index over active listings, maintained by SQLite triggers
+class ListingLocation(models.Model):
+    listing = models.OneToOneField(
+        Listing,
+        on_delete=models.DO_NOTHING,
+        primary_key=True,
+        db_column="id",
+        related_name="location",
+    )  # Listing the row indexes
+    min_latitude = models.FloatField()  # Bounding box minimum latitude
+    max_latitude = models.FloatField()  # Bounding box maximum latitude
+    min_longitude = models.FloatField()  # Bounding box minimum longitude
+    max_longitude = models.FloatField()  # Bounding box maximum longitude
+
+    class Meta:
+        managed = False
+        db_table = SPATIAL_TABLE
 
 
 # Bid model
@@ -165,6 +536,58 @@ class Bid(models.Model):
     def __str__(self):
         return f"{self.user} bid {self.bid} on {self.listing}"
 
+    class Meta:
+        indexes = [
+            # Finds the highest bid of a listing without sorting its bids
+            models.Index(
+                "listing", models.F("bid").desc(), name="bid_listing_rank"
+            ),
+            # Finds the auctions a user won
+            models.Index(
+                fields=["user"],
+                condition=Q(winner=True),
+                name="bid_user_wins",
+            ),
+        ]
+
+
+# Proxy bid model, the maximum a user is willing to bid on a listing
+class ProxyBid(models.Model):
+    max_bid = models.IntegerField()  # Maximum bid amount
+    listing = models.ForeignKey(
+        Listing, on_delete=models.CASCADE, related_name="proxy_bids"
+    )  # Listing the proxy bids on
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="proxy_bids"
+    )  # User the proxy bids for
+    created_at = models.DateTimeField(
+        auto_now_add=True
+    )  # Proxy bid created timestamp
+    updated_at = models.DateTimeField(
+        auto_now=True
+    )  # Proxy bid updated timestamp
+
+    def __str__(self):
+        return f"{self.user} bids up to {self.max_bid} on {self.listing}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["listing", "user"], name="unique_proxy_bid"
+            )
+        ]
+        # Ranks the proxies of a listing, earliest first among equal maxima,
+        # so the highest two are read from the index without scanning the
+        # others
+        indexes = [
+            models.Index(
+                "listing",
+                models.F("max_bid").desc(),
+                "updated_at",
+                name="proxy_bid_rank",
+            )
+        ]
+
 
 # Comment model
 class Comment(models.Model):
@@ -182,6 +605,13 @@ class Comment(models.Model):
         blank=True,
         null=True,
     )  # Parent comment
+    thread = models.ForeignKey(
+        "self",
+        on_delete=models.CASCADE,
+        related_name="thread_replies",
+        blank=True,
+        null=True,
+    )  # Top level comment of the thread, empty for top level comments
     created_at = models.DateTimeField(
         auto_now_add=True
     )  # Comment created timestamp
@@ -192,6 +622,19 @@ class Comment(models.Model):
     def __str__(self):
         return f"{self.comment}"
 
+    def save(self, *args, **kwargs):
+        # A reply belongs to the thread of its parent
+        if self.parent_id is not None and self.thread_id is None:
+            self.thread_id = self.parent.thread_id or self.parent_id
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            publish_listing_event(
+                self.listing_id,
+                get_comment_event(self),
+                using=self._state.db,
+            )
+
     # Returns the time ago the comment was posted
     def posted_time_ago(self):
         return get_time_ago(self.created_at)
@@ -201,6 +644,14 @@ class Comment(models.Model):
 
     class Meta:
         ordering = ["-created_at"]
+        # Reads the top level comments of a listing newest first, without
+        # sorting them
+        indexes = [
+            models.Index(
+                fields=["listing", "parent", "created_at"],
+                name="comment_listing_roots",
+            )
+        ]
 
 
 # Watchlist model
@@ -220,3 +671,98 @@ class Watchlist(models.Model):
 
     def __str__(self):
         return f"{self.user} added {self.listing}({self.listing.id}) to their watchlist"
+
+    class Meta:
+        # A listing is in a watchlist at most once, which also lets bulk
+        # additions skip the rows that exist already
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "listing"], name="unique_watchlist"
+            )
+        ]
+
+
+# Map cluster model, aggregating active listings per grid cell and zoom level
+class MapCluster(models.Model):
+    zoom = models.IntegerField()  # Map zoom level
+    cell_x = models.IntegerField()  # Grid column of the cell
+    cell_y = models.IntegerField()  # Grid row of the cell
+    count = models.IntegerField(default=0)  # Number of listings in the cell
+    latitude_sum = models.FloatField(default=0)  # Sum of listing latitudes
+    longitude_sum = models.FloatField(default=0)  # Sum of listing longitudes
+    min_latitude = models.FloatField()  # Bounding box minimum latitude
+    max_latitude = models.FloatField()  # Bounding box maximum latitude
+    min_longitude = models.FloatField()  # Bounding box minimum longitude
+    max_longitude = models.FloatField()  # Bounding box maximum longitude
+    listing_ids = models.JSONField(default=list)  # Sample of listing ids
+    updated_at = models.DateTimeField(
+        auto_now=True
+    )  # Cluster updated timestamp
+
+    def __str__(self):
+        return (
+            f"{self.count} listings at "
+            f"{self.zoom}/{self.cell_x}/{self.cell_y}"
+        )
+
+    # Returns the average latitude of the listings in the cell
+    def latitude(self):
+        return self.latitude_sum / self.count
+
+    # Returns the average longitude of the listings in the cell
+    def longitude(self):
+        return self.longitude_sum / self.count
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["zoom", "cell_x", "cell_y"], name="unique_map_cell"
+            )
+        ]
+
+
+# Description generated for a listing title, so the same or a near-identical
+# title is not sent to OpenAI again
+class GeneratedDescription(models.Model):
+    normalized_title = models.CharField(
+        max_length=64
+    )  # Title lowercased, without punctuation and repeated spaces
+    category = models.ForeignKey(
+        Category,
+        on_delete=models.CASCADE,
+        related_name="generated_descriptions",
+        null=True,
+        blank=True,
+    )  # Category the description was generated for, if any
+    description = models.TextField()  # Generated description
+    model = models.CharField(max_length=64)  # Model that generated it
+    latency = models.FloatField()  # Seconds the generation took
+    prompt_tokens = models.IntegerField(default=0)  # Tokens of the prompt
+    completion_tokens = models.IntegerField(
+        default=0
+    )  # Tokens of the description
+    created_at = models.DateTimeField(
+        auto_now_add=True
+    )  # Description generated timestamp
+
+    def __str__(self):
+        return f"Description of {self.normalized_title}"
+
+    # Returns the number of tokens the generation was billed for
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["normalized_title", "category"],
+                name="unique_generated_description",
+            ),
+            # Titles generated without a category, since NULLs are distinct
+            # in the constraint above
+            models.UniqueConstraint(
+                fields=["normalized_title"],
+                condition=models.Q(category__isnull=True),
+                name="unique_uncategorized_description",
+            ),
+        ]
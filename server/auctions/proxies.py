@@ -0,0 +1,110 @@
+from django.db import OperationalError, router, transaction
+from django.utils import timezone
+
+from .database import immediate_atomic, is_database_locked
+from .models import Bid, Listing, ProxyBid
+
+# Amount a proxy bids over the bid it has to beat
+BID_INCREMENT = 1
+
+# Number of times resolving the proxies of a listing is retried when a
+# concurrent bid changes the current bid in the meantime, or the database
+# stays locked for longer than its busy timeout
+MAX_RESOLVE_ATTEMPTS = 5
+
+
+def get_resolved_bids(current_bid, bid_count, high_bidder_id, proxies):
+    """
+    Returns the visible bids that settle the competing proxies of a listing
+    as (user, amount) pairs in the order they have to be placed. The
+    proxies are the two highest, highest first.
+
+    Only the runner-up and the leader bid: the runner-up up to its maximum,
+    and the leader just over it, or just over the current bid when nobody
+    competes with it.
+    """
+    if not proxies:
+        return []
+    # Lowest amount the next bid can be
+    price = current_bid + BID_INCREMENT if bid_count else current_bid
+    leader = proxies[0]
+    runner_up = proxies[1] if len(proxies) > 1 else None
+    if runner_up is not None and runner_up.max_bid >= price:
+        if leader.max_bid == runner_up.max_bid:
+            # The earlier proxy wins a tie
+            return [(leader.user, leader.max_bid)]
+        return [
+            (runner_up.user, runner_up.max_bid),
+            (
+                leader.user,
+                min(leader.max_bid, runner_up.max_bid + BID_INCREMENT),
+            ),
+        ]
+    if leader.user_id == high_bidder_id or leader.max_bid < price:
+        return []
+    return [(leader.user, price)]
+
+
+def resolve_proxy_bids(listing):
+    """
+    Places the bids the proxies of a listing make in response to its current
+    bid and returns them. Only the two highest proxies are read, from the
+    proxy_bid_rank index, so the cost does not grow with the number of
+    proxies.
+
+    The transaction takes the write lock before reading the listing, so a
+    bid committed by another request in between cannot make its writes
+    fail. If the bids cannot be placed after MAX_RESOLVE_ATTEMPTS, nothing
+    is placed and the proxies respond to the next bid instead; the bid that
+    triggered them stands either way.
+    """
+    using = router.db_for_write(Listing, instance=listing)
+    for _ in range(MAX_RESOLVE_ATTEMPTS):
+        try:
+            bids = resolve_once(listing, using)
+        except OperationalError as e:
+            if not is_database_locked(e):
+                raise
+            continue
+        if bids is not None:
+            return bids
+    return []
+
+
+def resolve_once(listing, using):
+    """
+    Makes one attempt of resolve_proxy_bids, returning None if a concurrent
+    bid got in first and it has to start over
+    """
+    with immediate_atomic(using=using):
+        state = (
+            Listing.objects.filter(pk=listing.pk)
+            .values("active", "ends_at", "current_bid", "bid_count")
+            .get()
+        )
+        if not state["active"] or (
+            state["ends_at"] is not None and state["ends_at"] <= timezone.now()
+        ):
+            return []
+        # Accepted bids strictly increase, so the latest is the highest
+        high_bidder_id = (
+            Bid.objects.filter(listing=listing)
+            .order_by("-id")
+            .values_list("user_id", flat=True)
+            .first()
+        )
+        proxies = list(
+            ProxyBid.objects.filter(listing=listing)
+            .select_related("user")
+            .order_by("-max_bid", "updated_at")[:2]
+        )
+        bids = []
+        for user, amount in get_resolved_bids(
+            state["current_bid"], state["bid_count"], high_bidder_id, proxies
+        ):
+            bid = listing.place_bid(user, amount)
+            if bid is None:
+                transaction.set_rollback(True, using=using)
+                return None
+            bids.append(bid)
+        return bids
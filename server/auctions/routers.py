@@ -0,0 +1,265 @@
+import hashlib
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.urls import Resolver404, resolve
+from django.utils.decorators import sync_and_async_middleware
+
+from .shards import (
+    current_shard,
+    get_category_shard,
+    get_listing_shard,
+    get_shards,
+    is_sharded_model,
+)
+
+# Endpoints whose safe requests may read from a replica
+REPLICA_URL_NAMES = {
+    "listings",
+    "listing",
+    "categories",
+    "category_listings",
+    "user_listings",
+    "map_listings",
+    "comments",
+    "comment_replies",
+}
+
+# Endpoints about a single listing, whose pk is the listing id
+LISTING_URL_NAMES = {
+    "listing",
+    "ratings",
+    "watch",
+    "comments",
+    "comment_replies",
+    "bid",
+    "max_bid",
+    "listing_events",
+    "close",
+}
+
+# Endpoints about a single category, whose pk is the category id
+CATEGORY_URL_NAMES = {"category_listings"}
+
+# Apps whose models are always read from the primary, so that a token is
+# accepted as soon as it is created
+PRIMARY_APP_LABELS = {"authtoken"}
+
+# Number of seconds the requests of a client read from the primary after
+# it wrote, unless the REPLICA_PIN_SECONDS setting says otherwise
+DEFAULT_REPLICA_PIN_SECONDS = 10
+
+# Database alias reads of the current request are routed to, None for the
+# primary
+read_alias = ContextVar("read_alias", default=None)
+
+
+def get_replicas():
+    """
+    Returns the aliases of the read replicas of the default database
+    """
+    return getattr(settings, "DATABASE_REPLICAS", [])
+
+
+@contextmanager
+def use_primary():
+    """
+    Routes the reads inside the block to the primary. Data that is cached
+    once read is rebuilt inside it, so a lagging replica never ends up in
+    the cache for longer than the replica lags.
+    """
+    token = read_alias.set(None)
+    try:
+        yield
+    finally:
+        read_alias.reset(token)
+
+
+def get_pin_cache_key(request):
+    """
+    Returns the cache key pinning the client making request to the primary,
+    or None when the request carries no token to tell clients apart
+    """
+    header = request.headers.get("Authorization", "").split()
+    if len(header) != 2 or header[0] != "Token":
+        return None
+    return "replica_pin:" + hashlib.md5(header[1].encode()).hexdigest()
+
+
+def get_read_alias(request):
+    """
+    Returns the replica the reads of request go to, or None when they go to
+    the primary: for unsafe requests, endpoints outside REPLICA_URL_NAMES
+    and clients that wrote recently
+    """
+    replicas = get_replicas()
+    if not replicas or request.method not in ("GET", "HEAD", "OPTIONS"):
+        return None
+    try:
+        url_name = resolve(request.path_info).url_name
+    except Resolver404:
+        return None
+    if url_name not in REPLICA_URL_NAMES:
+        return None
+    key = get_pin_cache_key(request)
+    if key is not None and cache.get(key):
+        return None
+    return random.choice(replicas)
+
+
+def pin_after_write(request, response):
+    """
+    Keeps the client of a successful unsafe request on the primary for a
+    while, so it reads its own writes before the replicas catch up
+    """
+    if request.method in ("GET", "HEAD", "OPTIONS"):
+        return
+    if response.status_code >= 400 or not get_replicas():
+        return
+    key = get_pin_cache_key(request)
+    if key is not None:
+        cache.set(
+            key,
+            True,
+            getattr(
+                settings, "REPLICA_PIN_SECONDS", DEFAULT_REPLICA_PIN_SECONDS
+            ),
+        )
+
+
+@sync_and_async_middleware
+def replica_middleware(get_response):
+    """
+    Routes the reads of each request to a replica or the primary, see
+    get_read_alias
+    """
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            token = read_alias.set(get_read_alias(request))
+            try:
+                response = await get_response(request)
+            finally:
+                read_alias.reset(token)
+            pin_after_write(request, response)
+            return response
+
+    else:
+
+        def middleware(request):
+            token = read_alias.set(get_read_alias(request))
+            try:
+                response = get_response(request)
+            finally:
+                read_alias.reset(token)
+            pin_after_write(request, response)
+            return response
+
+    return middleware
+
+
+def get_request_shard(request):
+    """
+    Returns the shard holding everything request is about, or None when it
+    is not about a single listing or category, or listings are not sharded
+    """
+    if not get_shards():
+        return None
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return None
+    pk = match.kwargs.get("pk")
+    if pk is None:
+        return None
+    if match.url_name in LISTING_URL_NAMES:
+        return get_listing_shard(int(pk))
+    if match.url_name in CATEGORY_URL_NAMES:
+        return get_category_shard(int(pk))
+    return None
+
+
+@sync_and_async_middleware
+def shard_middleware(get_response):
+    """
+    Routes the listings, bids, comments, ratings and watches of each request
+    to its shard, see get_request_shard. Requests about several listings
+    run their queries on every shard instead, see auctions.shards.
+    """
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            token = current_shard.set(get_request_shard(request))
+            try:
+                return await get_response(request)
+            finally:
+                current_shard.reset(token)
+
+    else:
+
+        def middleware(request):
+            token = current_shard.set(get_request_shard(request))
+            try:
+                return get_response(request)
+            finally:
+                current_shard.reset(token)
+
+    return middleware
+
+
+class ShardRouter:
+    """
+    Sends the models of a listing to the shard it is stored in: the shard
+    of the instance at hand, or the one chosen for the current request or
+    task. Anything else is left to the next router.
+    """
+
+    def get_shard(self, model, **hints):
+        if not get_shards() or not is_sharded_model(model):
+            return None
+        instance = hints.get("instance")
+        if (
+            instance is not None
+            and is_sharded_model(type(instance))
+            and instance._state.db
+        ):
+            return instance._state.db
+        return current_shard.get()
+
+    def db_for_read(self, model, **hints):
+        return self.get_shard(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self.get_shard(model, **hints)
+
+
+class ReplicaRouter:
+    """
+    Sends reads to the replica chosen for the current request and every
+    write to the primary
+    """
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db:
+            # Follow relations from the database the instance came from
+            return instance._state.db
+        if model._meta.app_label in PRIMARY_APP_LABELS:
+            return DEFAULT_DB_ALIAS
+        return read_alias.get() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replicas get the schema from the primary by replication
+        return db not in get_replicas()
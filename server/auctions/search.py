@@ -0,0 +1,126 @@
+import re
+
+from django.db import connection, models
+from django.db.models import F, Lookup, Q
+
+# Name of the SQLite FTS5 table indexing listing titles and descriptions
+SEARCH_TABLE = "auctions_listing_fts"
+
+# Statements creating the full-text index and the triggers that keep it in
+# sync with the listing table. They are idempotent, so they can be re-run
+# after migrations that rebuild the listing table and drop its triggers.
+SEARCH_INDEX_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        title,
+        description,
+        content='auctions_listing',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    # Title matches weigh ten times more than description matches
+    f"""
+    INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rank)
+    VALUES ('rank', 'bm25(10.0, 1.0)')
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert
+    AFTER INSERT ON auctions_listing BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete
+    AFTER DELETE ON auctions_listing BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update
+    AFTER UPDATE OF title, description ON auctions_listing BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO {SEARCH_TABLE}(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END
+    """,
+]
+
+
+class SearchField(models.TextField):
+    """
+    Hidden FTS5 column named after its table, which match expressions are
+    run against
+    """
+
+
+@SearchField.register_lookup
+class Match(Lookup):
+    """
+    Full-text match lookup, e.g. search__document__match="camera*"
+    """
+
+    lookup_name = "match"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} MATCH {rhs}", lhs_params + rhs_params
+
+
+def search_index_available(using=connection):
+    """
+    Returns whether the database supports the full-text index
+    """
+    return using.vendor == "sqlite"
+
+
+def install_search_index(using=connection, rebuild=False):
+    """
+    Creates the full-text index and its triggers if they are missing, and
+    optionally rebuilds the index from the listing table
+    """
+    if not search_index_available(using):
+        return
+    with using.cursor() as cursor:
+        for statement in SEARCH_INDEX_SQL:
+            cursor.execute(statement)
+        if rebuild:
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')"
+            )
+
+
+def build_match_expression(query):
+    """
+    Converts a user search query into an FTS5 match expression where every
+    word must be present and may be a prefix
+    """
+    words = re.findall(r"\w+", query)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_listings(listings, query, rank=False):
+    """
+    Filters listings to those matching the search query, optionally
+    annotating them with a search_rank where lower values are more relevant
+    """
+    match = build_match_expression(query)
+    if not match or not search_index_available():
+        # Fall back to a substring search
+        listings = listings.filter(
+            Q(title__icontains=query) | Q(description__icontains=query)
+        )
+        if rank:
+            listings = listings.annotate(
+                search_rank=models.Value(0.0, output_field=models.FloatField())
+            )
+        return listings
+    # Joins the index on rowid, so SQLite drives the query from the match
+    listings = listings.filter(search__document__match=match)
+    if rank:
+        listings = listings.annotate(search_rank=F("search__rank"))
+    return listings
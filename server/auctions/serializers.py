@@ -1,19 +1,71 @@
+from django.core.cache import cache
+from django.db import models
 from rest_framework import serializers
-from .models import Listing, Category, Bid, Comment, Watchlist, User
-import decimal
-import random
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+from .models import (
+    Listing,
+    Category,
+    Bid,
+    Comment,
+    Watchlist,
+    User,
+    MapCluster,
+)
+from .viewers import get_request_viewer
+
+# Number of seconds the shared part of a serialized listing is cached for
+LISTING_CACHE_TIMEOUT = 10 * 60
+
+# Listing fields that depend on the user making the request
+LISTING_VIEWER_FIELDS = (
+    "user_rating",
+    "is_watched",
+    "is_owner",
+    "latitude",
+    "longitude",
+    "max_bid",
+)
+
+# Listing fields read from the rows the listing refers to, which can change
+# without the listing being written, so they are not cached with it either
+LISTING_RELATED_FIELDS = ("username", "winner_name", "category_name")
+
+# Listing fields serialized for each request and merged onto the cached ones
+LISTING_REQUEST_FIELDS = LISTING_VIEWER_FIELDS + LISTING_RELATED_FIELDS
+
+
+def get_listing_cache_key(listing):
+    """
+    Returns the cache key of the shared part of a serialized listing. Every
+    write to a listing moves its updated_at, so a write starts a new key and
+    the entries of older versions are never read again. The fields read
+    from the user, category and winner are not part of it, since they
+    change without the listing.
+    """
+    return f"listing:{listing.pk}:{listing.updated_at.isoformat()}"
 
 
-def get_map_coordinates_delta():
+class ListingListSerializer(serializers.ListSerializer):
     """
-    Get random delta for map coordinates
+    List serializer for listing, reading the shared parts of a page of
+    listings from the cache at once
     """
-    return decimal.Decimal(random.randrange(1, 300)) / 1000
+
+    def to_representation(self, data):
+        if isinstance(data, models.manager.BaseManager):
+            data = data.all()
+        listings = list(data)
+        self.child.load_public_representations(listings)
+        return [self.child.to_representation(listing) for listing in listings]
 
 
 class ListingSerializer(serializers.ModelSerializer):
     """
-    Serializer for listing
+    Serializer for listing. The fields stored on the listing that are the
+    same for every viewer are cached per listing version, and the viewer
+    fields and the names read from related rows are computed for each
+    request and merged on.
     """
 
     rating = serializers.SerializerMethodField("get_average_rating")
@@ -28,6 +80,15 @@ class ListingSerializer(serializers.ModelSerializer):
     latitude = serializers.SerializerMethodField("get_latitude")
     longitude = serializers.SerializerMethodField("get_longitude")
     username = serializers.SerializerMethodField("get_username")
+    max_bid = serializers.SerializerMethodField("get_max_bid")
+
+    def get_viewer(self):
+        """
+        Get the context of the user making the request
+        """
+        if "viewer" in self.context:
+            return self.context["viewer"]
+        return get_request_viewer(self.context["request"])
 
     def get_average_rating(self, listing):
         """
@@ -39,21 +100,13 @@ class ListingSerializer(serializers.ModelSerializer):
         """
         Get current bid for listing
         """
-        return listing.current_bid()
+        return listing.current_bid
 
     def get_user_rating(self, listing):
         """
         Get user rating for listing
         """
-        user = self.context["request"].user
-        # If user is authenticated
-        if user.is_authenticated:
-            # Get rating for listing and user
-            rating = listing.ratings.filter(user=user)
-            # If rating exists
-            if rating:
-                return rating[0].rating
-        return None
+        return self.get_viewer().get_rating(listing)
 
     def get_category_name(self, listing):
         """
@@ -65,31 +118,19 @@ class ListingSerializer(serializers.ModelSerializer):
         """
         Get if listing is watched by user
         """
-        user = self.context["request"].user
-        # If user is authenticated
-        if user.is_authenticated:
-            # If listing is watched by user
-            if Watchlist.objects.filter(listing=listing, user=user).exists():
-                return True
-        return False
+        return self.get_viewer().is_watching(listing)
 
     def get_is_owner(self, listing):
         """
         Get if listing is owned by user
         """
-        user = self.context["request"].user
-        # If user is authenticated
-        if user.is_authenticated:
-            # If listing is owned by user
-            if listing.user == user:
-                return True
-        return False
+        return self.get_viewer().is_owner(listing)
 
     def get_total_bids(self, listing):
         """
         Get total bids for listing
         """
-        return listing.bid_count()
+        return listing.bid_count
 
     def get_winner_id(self, listing):
         """
@@ -97,7 +138,7 @@ class ListingSerializer(serializers.ModelSerializer):
         """
         winner = listing.winner()
         if winner:
-            return winner.user.id
+            return winner.user_id
         return None
 
     def get_winner_name(self, listing):
@@ -111,61 +152,21 @@ class ListingSerializer(serializers.ModelSerializer):
 
     def get_latitude(self, listing):
         """
-        Get latitude for listing with delta if user is not authenticated or
-        not owner or winner of listing
-        """
-        try:
-            user = self.context["request"].user
-            # Get accurate latitude
-            accurate_latitude = listing.latitude
-            # Get inaccurate latitude
-            inaccurate_latitude = (
-                listing.latitude + get_map_coordinates_delta()
-            )
-            # If user is authenticated
-            if user.is_authenticated:
-                # Get winner
-                winner = listing.winner()
-                # Get owner
-                owner = listing.user
-                # If user is winner or owner
-                if (winner and winner.user == user) or owner == user:
-                    return accurate_latitude
-                else:
-                    return inaccurate_latitude
-            else:
-                return inaccurate_latitude
-        except Exception as e:
-            return 0
+        Get latitude for listing, obfuscated unless the user is the owner or
+        winner of listing
+        """
+        if self.get_viewer().can_see_location(listing):
+            return listing.latitude
+        return listing.public_latitude or 0
 
     def get_longitude(self, listing):
         """
-        Get longitude for listing with delta if user is not authenticated or
-        not owner or winner of listing
-        """
-        try:
-            user = self.context["request"].user
-            # Get accurate longitude
-            accurate_longitude = listing.longitude
-            # Get inaccurate longitude
-            inaccurate_longitude = (
-                listing.longitude + get_map_coordinates_delta()
-            )
-            # If user is authenticated
-            if user.is_authenticated:
-                # Get winner
-                winner = listing.winner()
-                # Get owner
-                owner = listing.user
-                # If user is winner or owner
-                if (winner and winner.user == user) or owner == user:
-                    return accurate_longitude
-                else:
-                    return inaccurate_longitude
-            else:
-                return inaccurate_longitude
-        except Exception as e:
-            return 0
+        Get longitude for listing, obfuscated unless the user is the owner or
+        winner of listing
+        """
+        if self.get_viewer().can_see_location(listing):
+            return listing.longitude
+        return listing.public_longitude or 0
 
     def get_username(self, listing):
         """
@@ -173,8 +174,101 @@ class ListingSerializer(serializers.ModelSerializer):
         """
         return listing.user.get_display_name()
 
+    def get_max_bid(self, listing):
+        """
+        Get maximum bid of user for listing
+        """
+        return self.get_viewer().get_max_bid(listing)
+
+    def load_public_representations(self, listings):
+        """
+        Reads the shared parts of listings from the cache, serializing and
+        caching the ones missing
+        """
+        keys = {
+            get_listing_cache_key(listing): listing for listing in listings
+        }
+        self._public = {
+            keys[key].pk: public
+            for key, public in cache.get_many(list(keys)).items()
+        }
+        missing = {}
+        for key, listing in keys.items():
+            if listing.pk not in self._public:
+                public = self.represent(listing, self.get_public_fields())
+                self._public[listing.pk] = missing[key] = public
+        if missing:
+            cache.set_many(missing, LISTING_CACHE_TIMEOUT)
+
+    def get_public_representation(self, listing):
+        """
+        Get the fields of listing that are the same for every viewer
+        """
+        public = getattr(self, "_public", {}).get(listing.pk)
+        if public is None:
+            key = get_listing_cache_key(listing)
+            public = cache.get(key)
+            if public is None:
+                public = self.represent(listing, self.get_public_fields())
+                cache.set(key, public, LISTING_CACHE_TIMEOUT)
+        return public
+
+    def get_public_fields(self):
+        """
+        Get the readable fields that are cached with the listing
+        """
+        return [
+            field
+            for field in self._readable_fields
+            if field.field_name not in LISTING_REQUEST_FIELDS
+        ]
+
+    def get_request_fields(self):
+        """
+        Get the readable fields serialized for each request: those that
+        depend on the viewer or on the related rows
+        """
+        return [
+            field
+            for field in self._readable_fields
+            if field.field_name in LISTING_REQUEST_FIELDS
+        ]
+
+    def represent(self, listing, fields):
+        """
+        Serializes the given fields of listing, the way to_representation of
+        ModelSerializer does for all of them
+        """
+        data = {}
+        for field in fields:
+            try:
+                attribute = field.get_attribute(listing)
+            except SkipField:
+                continue
+            if isinstance(attribute, PKOnlyObject):
+                check_for_none = attribute.pk
+            else:
+                check_for_none = attribute
+            if check_for_none is None:
+                data[field.field_name] = None
+            else:
+                data[field.field_name] = field.to_representation(attribute)
+        return data
+
+    def to_representation(self, listing):
+        """
+        Merges the request fields onto the cached shared fields, in the
+        order of Meta.fields
+        """
+        data = dict(self.get_public_representation(listing))
+        data.update(self.represent(listing, self.get_request_fields()))
+        return {
+            field: data[field] for field in self.Meta.fields if field in data
+        }
+
     class Meta:
         model = Listing
+        list_serializer_class = ListingListSerializer
         fields = [
             "id",
             "title",
@@ -197,6 +291,8 @@ class ListingSerializer(serializers.ModelSerializer):
             "longitude",
             "created_at",
             "username",
+            "max_bid",
+            "ends_at",
         ]
 
 
@@ -208,51 +304,31 @@ class ListingMapSerializer(serializers.ModelSerializer):
     latitude = serializers.SerializerMethodField("get_latitude")
     longitude = serializers.SerializerMethodField("get_longitude")
 
+    def get_viewer(self):
+        """
+        Get the context of the user making the request
+        """
+        if "viewer" in self.context:
+            return self.context["viewer"]
+        return get_request_viewer(self.context["request"])
+
     def get_latitude(self, listing):
         """
-        Get latitude for listing with delta if user is not authenticated or
-        not owner or winner of listing
-        """
-        try:
-            user = self.context["request"].user
-            accurate_latitude = listing.latitude
-            inaccurate_latitude = (
-                listing.latitude + get_map_coordinates_delta()
-            )
-            if user.is_authenticated:
-                winner = listing.winner()
-                owner = listing.user
-                if (winner and winner.user == user) or owner == user:
-                    return accurate_latitude
-                else:
-                    return inaccurate_latitude
-            else:
-                return inaccurate_latitude
-        except Exception as e:
-            return 0
+        Get latitude for listing, obfuscated unless the user is the owner or
+        winner of listing
+        """
+        if self.get_viewer().can_see_location(listing):
+            return listing.latitude
+        return listing.public_latitude or 0
 
     def get_longitude(self, listing):
         """
-        Get longitude for listing with delta if user is not authenticated or
-        not owner or winner of listing
-        """
-        try:
-            user = self.context["request"].user
-            accurate_longitude = listing.longitude
-            inaccurate_longitude = (
-                listing.longitude + get_map_coordinates_delta()
-            )
-            if user.is_authenticated:
-                winner = listing.winner()
-                owner = listing.user
-                if (winner and winner.user == user) or owner == user:
-                    return accurate_longitude
-                else:
-                    return inaccurate_longitude
-            else:
-                return inaccurate_longitude
-        except Exception as e:
-            return 0
+        Get longitude for listing, obfuscated unless the user is the owner or
+        winner of listing
+        """
+        if self.get_viewer().can_see_location(listing):
+            return listing.longitude
+        return listing.public_longitude or 0
 
     class Meta:
         model = Listing
@@ -266,6 +342,31 @@ class ListingMapSerializer(serializers.ModelSerializer):
         ]
 
 
+class MapClusterSerializer(serializers.ModelSerializer):
+    """
+    Serializer for map cluster
+    """
+
+    latitude = serializers.FloatField()
+    longitude = serializers.FloatField()
+    bbox = serializers.SerializerMethodField("get_bbox")
+
+    def get_bbox(self, cluster):
+        """
+        Get bounding box for cluster as minLng, minLat, maxLng, maxLat
+        """
+        return [
+            cluster.min_longitude,
+            cluster.min_latitude,
+            cluster.max_longitude,
+            cluster.max_latitude,
+        ]
+
+    class Meta:
+        model = MapCluster
+        fields = ["count", "latitude", "longitude", "bbox", "listing_ids"]
+
+
 class CategorySerializer(serializers.ModelSerializer):
     """
     Serializer for category
@@ -303,6 +404,7 @@ class CommentSerializer(serializers.ModelSerializer):
 
     name = serializers.SerializerMethodField("get_name")
     replies = serializers.SerializerMethodField("get_replies")
+    reply_count = serializers.SerializerMethodField("get_reply_count")
     rating = serializers.SerializerMethodField("get_rating")
 
     def get_name(self, comment):
@@ -313,16 +415,30 @@ class CommentSerializer(serializers.ModelSerializer):
 
     def get_replies(self, comment):
         """
-        Get replies for comment
+        Get replies for comment, limited to reply_limit when the tree was
+        loaded up front
+        """
+        if "replies" in self.context:
+            replies = self.context["replies"].get(comment.id, [])
+            replies = replies[: self.context["reply_limit"]]
+        else:
+            replies = comment.get_replies()
+        return CommentSerializer(replies, many=True, context=self.context).data
+
+    def get_reply_count(self, comment):
+        """
+        Get total number of direct replies for comment
         """
-        return CommentSerializer(
-            comment.get_replies(), many=True, context=self.context
-        ).data
+        if "reply_counts" in self.context:
+            return self.context["reply_counts"].get(comment.id, 0)
+        return comment.replies.count()
 
     def get_rating(self, comment):
         """
         Get rating for comment
         """
+        if "ratings" in self.context:
+            return self.context["ratings"].get(comment.user_id)
         listing = comment.listing
         user = comment.user
         if user.is_authenticated:
@@ -341,5 +457,6 @@ class CommentSerializer(serializers.ModelSerializer):
             "created_at",
             "name",
             "replies",
+            "reply_count",
             "rating",
         ]
@@ -0,0 +1,246 @@
+import heapq
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import cmp_to_key
+
+from django.conf import settings
+from django.db.models import Max
+
+# Models stored in the shard of their listing, by model name
+SHARDED_MODELS = {
+    "listing",
+    "listingsearch",
+    "listinglocation",
+    "bid",
+    "proxybid",
+    "comment",
+    "rating",
+    "watchlist",
+}
+
+# Models the sharded models refer to, by model name, copied into every
+# shard they are referred from so that the foreign keys and joins work
+# inside a shard, with the fields the serializers of the sharded models
+# read through the joins. Other fields, such as password hashes, keep their
+# defaults in the copies.
+MIRRORED_FIELDS = {
+    "user": ["username", "first_name", "last_name"],
+    "category": ["category"],
+}
+
+# Shard the sharded models of the current request or task are read from and
+# written to, None to use the default database
+current_shard = ContextVar("current_shard", default=None)
+
+
+def get_shards():
+    """
+    Returns the aliases of the listing shards, empty when listings are not
+    sharded
+    """
+    return getattr(settings, "LISTING_SHARDS", [])
+
+
+def is_sharded_model(model):
+    """
+    Returns if model is stored in the shard of its listing
+    """
+    return (
+        model._meta.app_label == "auctions"
+        and model._meta.model_name in SHARDED_MODELS
+    )
+
+
+def is_mirrored_model(model):
+    """
+    Returns if model is copied into the shards that refer to it
+    """
+    return (
+        model._meta.app_label == "auctions"
+        and model._meta.model_name in MIRRORED_FIELDS
+    )
+
+
+def get_category_shard(category_id):
+    """
+    Returns the shard new listings of a category are created in
+    """
+    shards = get_shards()
+    return shards[category_id % len(shards)]
+
+
+def get_listing_shard(listing_id):
+    """
+    Returns the shard a listing is stored in, which its id encodes
+    """
+    shards = get_shards()
+    return shards[listing_id % len(shards)]
+
+
+@contextmanager
+def use_shard(alias):
+    """
+    Routes the sharded models to the shard alias inside the block
+    """
+    token = current_shard.set(alias)
+    try:
+        yield
+    finally:
+        current_shard.reset(token)
+
+
+def is_scattered():
+    """
+    Returns if listing queries have to be run on every shard: when listings
+    are sharded and no shard was chosen for the current request
+    """
+    return bool(get_shards()) and current_shard.get() is None
+
+
+def scatter(queryset):
+    """
+    Returns queryset once per shard, or alone when listings are not sharded
+    """
+    shards = get_shards()
+    if not shards:
+        return [queryset]
+    return [queryset.using(alias) for alias in shards]
+
+
+def scatter_values(queryset):
+    """
+    Returns the rows of a values or values_list queryset from every shard
+    """
+    return list(itertools.chain.from_iterable(scatter(queryset)))
+
+
+def group_by_shard(listing_ids):
+    """
+    Returns the listing ids grouped by the shard they are stored in, or all
+    of them under None when listings are not sharded
+    """
+    groups = {}
+    for listing_id in listing_ids:
+        alias = get_listing_shard(listing_id) if get_shards() else None
+        groups.setdefault(alias, set()).add(listing_id)
+    return groups
+
+
+def get_sort_key(ordering):
+    """
+    Returns a key ordering model instances like the order_by fields of a
+    queryset
+    """
+
+    def compare(a, b):
+        for field in ordering:
+            descending = field.startswith("-")
+            name = field.lstrip("-")
+            x, y = getattr(a, name), getattr(b, name)
+            if x != y:
+                order = -1 if x < y else 1
+                return -order if descending else order
+        return 0
+
+    return cmp_to_key(compare)
+
+
+async def alist(queryset):
+    """
+    Returns the rows of a queryset as a list, read with the async ORM
+    """
+    return [row async for row in queryset]
+
+
+async def afetch_listings(listings, limit=None, offset=0):
+    """
+    Returns the listings of a queryset from offset on, at most limit of
+    them. When they are spread over the shards, every shard returns its
+    first offset + limit and the results are merged in the queryset order.
+    """
+    end = None if limit is None else offset + limit
+    if not is_scattered():
+        return await alist(listings[offset:end])
+    ordering = listings.query.order_by or listings.model._meta.ordering
+    merged = heapq.merge(
+        *[
+            await alist(shard_listings[:end])
+            for shard_listings in scatter(listings)
+        ],
+        key=get_sort_key(ordering),
+    )
+    return list(itertools.islice(merged, offset, end))
+
+
+async def acount_listings(listings):
+    """
+    Returns the number of listings of a queryset, summed over the shards
+    when they are spread over them
+    """
+    if not is_scattered():
+        return await listings.acount()
+    return sum(
+        [await shard_listings.acount() for shard_listings in scatter(listings)]
+    )
+
+
+def get_mirrored_fields(model):
+    """
+    Returns the names of the fields of a mirrored model copied into the
+    shards
+    """
+    return MIRRORED_FIELDS[model._meta.model_name]
+
+
+def mirror_references(instance, using):
+    """
+    Copies the users and categories a sharded instance refers to into the
+    shard alias using, when they are not there yet
+    """
+    for field in instance._meta.concrete_fields:
+        if not field.is_relation or not is_mirrored_model(field.related_model):
+            continue
+        pk = getattr(instance, field.attname)
+        if pk is None:
+            continue
+        model = field.related_model
+        if model.objects.using(using).filter(pk=pk).exists():
+            continue
+        related = getattr(instance, field.name)
+        mirrored = model(
+            pk=pk,
+            **{
+                name: getattr(related, name)
+                for name in get_mirrored_fields(model)
+            },
+        )
+        model.objects.using(using).bulk_create(
+            [mirrored], ignore_conflicts=True
+        )
+
+
+def update_mirrored_rows(instance):
+    """
+    Updates the copies of a user or category in the shards after it was
+    saved to the default database
+    """
+    model = type(instance)
+    fields = get_mirrored_fields(model)
+    for alias in get_shards():
+        model.objects.using(alias).filter(pk=instance.pk).update(
+            **{name: getattr(instance, name) for name in fields}
+        )
+
+
+def get_next_listing_id(listings, alias):
+    """
+    Returns the id of the next listing created in the shard alias: the
+    smallest id above those of the shard that maps to it, so listing ids are
+    unique across the shards and encode the shard
+    """
+    shards = get_shards()
+    last_id = (
+        listings.using(alias).aggregate(last_id=Max("id"))["last_id"] or 0
+    )
+    return (last_id // len(shards) + 1) * len(shards) + shards.index(alias)
@@ -0,0 +1,206 @@
+from django.db import connections, transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import (
+    post_delete,
+    post_migrate,
+    post_save,
+    pre_save,
+)
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import revoke_tokens
+from .catalog import invalidate_catalog, update_active_counts
+from .clusters import update_clusters
+from .database import apply_sqlite_pragmas
+from .models import Category, Listing, ProxyBid, Rating, User, Watchlist
+from .shards import (
+    get_mirrored_fields,
+    get_shards,
+    is_mirrored_model,
+    is_sharded_model,
+    mirror_references,
+    update_mirrored_rows,
+)
+from .search import SEARCH_TABLE, install_search_index
+from .spatial import SPATIAL_TABLE, install_spatial_index
+from .utils import invalidate_listing_collections
+from .viewers import invalidate_viewer_contexts
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    """
+    Applies the SQLITE_PRAGMAS setting to every new SQLite connection
+    """
+    apply_sqlite_pragmas(connection)
+
+
+@receiver(post_migrate)
+def restore_listing_indexes(sender, using, **kwargs):
+    """
+    Re-creates the full-text and spatial index triggers after migrations,
+    since SQLite drops them whenever a migration rebuilds the listing table
+    """
+    if sender.name != "auctions":
+        return
+    connection = connections[using]
+    table_names = connection.introspection.table_names()
+    if SEARCH_TABLE in table_names:
+        install_search_index(connection)
+    if SPATIAL_TABLE in table_names:
+        install_spatial_index(connection)
+
+
+@receiver(post_save, sender=Listing)
+def move_listing_cluster(sender, instance, raw, **kwargs):
+    """
+    Keeps the map clusters up to date when a listing is created, moved or
+    closed
+    """
+    if raw:
+        return
+    position = instance.map_position()
+    update_clusters(
+        instance.id, getattr(instance, "_map_position", None), position
+    )
+    instance._map_position = position
+
+
+@receiver(post_delete, sender=Listing)
+def remove_listing_cluster(sender, instance, **kwargs):
+    """
+    Removes a deleted listing from the map clusters
+    """
+    update_clusters(
+        instance.id, getattr(instance, "_map_position", None), None
+    )
+
+
+@receiver(post_save, sender=Listing)
+def move_listing_count(sender, instance, raw, **kwargs):
+    """
+    Keeps the active listing counts of the categories up to date when a
+    listing is created, recategorized or closed
+    """
+    if raw:
+        return
+    old_category = getattr(instance, "_counted_category", None)
+    new_category = instance.counted_category()
+    if old_category != new_category:
+        deltas = {}
+        if old_category is not None:
+            deltas[old_category] = -1
+        if new_category is not None:
+            deltas[new_category] = 1
+        update_active_counts(deltas)
+    instance._counted_category = new_category
+
+
+@receiver(post_delete, sender=Listing)
+def remove_listing_count(sender, instance, **kwargs):
+    """
+    Removes a deleted listing from the active listing count of its category
+    """
+    category = getattr(instance, "_counted_category", None)
+    if category is not None:
+        update_active_counts({category: -1})
+
+
+@receiver(post_save, sender=Listing)
+@receiver(post_delete, sender=Listing)
+def refresh_listing_collections(sender, instance, using, **kwargs):
+    """
+    Moves the listing collections to a new version when a listing is
+    created, saved or deleted, so feed revalidations see the change
+    """
+    invalidate_listing_collections(using=using)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def refresh_catalog(sender, **kwargs):
+    """
+    Rebuilds the cached category catalog after a category changes
+    """
+    invalidate_catalog()
+
+
+@receiver(post_delete, sender=Token)
+def revoke_deleted_token(sender, instance, **kwargs):
+    """
+    Stops accepting a deleted token from the token cache
+    """
+    key = instance.key
+    transaction.on_commit(lambda: revoke_tokens([key]))
+
+
+@receiver(post_save, sender=User)
+def revoke_user_tokens(sender, instance, raw, **kwargs):
+    """
+    Drops the cached tokens of a user when the user changes, so that a
+    deactivated user is rejected and the others see their new details
+    """
+    if raw:
+        return
+    keys = list(
+        Token.objects.filter(user=instance).values_list("pk", flat=True)
+    )
+    if keys:
+        transaction.on_commit(lambda: revoke_tokens(keys))
+
+
+@receiver(post_save, sender=Watchlist)
+@receiver(post_delete, sender=Watchlist)
+@receiver(post_save, sender=Rating)
+@receiver(post_delete, sender=Rating)
+@receiver(post_save, sender=ProxyBid)
+@receiver(post_delete, sender=ProxyBid)
+def refresh_viewer_context(sender, instance, using, **kwargs):
+    """
+    Drops the cached viewer context of a user who watched, rated or placed
+    a maximum bid on a listing
+    """
+    invalidate_viewer_contexts([instance.user_id], using=using)
+
+
+@receiver(post_save, sender=Listing)
+def refresh_winner_context(sender, instance, raw, using, **kwargs):
+    """
+    Drops the cached viewer context of the winner of a closed listing, who
+    can see its location from now on
+    """
+    if raw or instance.winner_bid_id is None:
+        return
+    invalidate_viewer_contexts([instance.winner_bid.user_id], using=using)
+
+
+@receiver(pre_save)
+def mirror_shard_references(sender, instance, raw, using, **kwargs):
+    """
+    Copies the user and category a new listing, bid, comment, rating or
+    watch refers to into the shard it is saved to, so its foreign keys hold
+    there. A listing may also change category when it is edited. Updates of
+    the other rows keep their references, so they copy nothing.
+    """
+    if raw or using not in get_shards() or not is_sharded_model(sender):
+        return
+    if instance._state.adding or sender is Listing:
+        mirror_references(instance, using)
+
+
+@receiver(post_save)
+def update_shard_references(
+    sender, instance, raw, using, update_fields, **kwargs
+):
+    """
+    Carries the changes of the names of a user or category over to its
+    copies in the shards
+    """
+    if raw or using in get_shards() or not is_mirrored_model(sender):
+        return
+    if update_fields is not None and not set(update_fields) & set(
+        get_mirrored_fields(sender)
+    ):
+        return
+    update_mirrored_rows(instance)
@@ -0,0 +1,132 @@
+from django.db import connection
+from django.db.models import Q
+
+# Name of the SQLite R*Tree table indexing the public (obfuscated) location
+# of active listings
+SPATIAL_TABLE = "auctions_listing_rtree"
+
+# Statements creating the spatial index and the triggers that keep it in
+# sync with the listing table. Only active listings with coordinates are
+# indexed. They are idempotent, so they can be re-run after migrations that
+# rebuild the listing table and drop its triggers.
+SPATIAL_INDEX_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SPATIAL_TABLE} USING rtree(
+        id,
+        min_latitude,
+        max_latitude,
+        min_longitude,
+        max_longitude
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SPATIAL_TABLE}_insert
+    AFTER INSERT ON auctions_listing
+    WHEN new.active AND new.public_latitude IS NOT NULL
+        AND new.public_longitude IS NOT NULL
+    BEGIN
+        INSERT INTO {SPATIAL_TABLE}
+        VALUES (
+            new.id, new.public_latitude, new.public_latitude,
+            new.public_longitude, new.public_longitude
+        );
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SPATIAL_TABLE}_delete
+    AFTER DELETE ON auctions_listing BEGIN
+        DELETE FROM {SPATIAL_TABLE} WHERE id = old.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SPATIAL_TABLE}_update
+    AFTER UPDATE OF active, public_latitude, public_longitude
+    ON auctions_listing BEGIN
+        DELETE FROM {SPATIAL_TABLE} WHERE id = old.id;
+        INSERT INTO {SPATIAL_TABLE}
+        SELECT
+            new.id, new.public_latitude, new.public_latitude,
+            new.public_longitude, new.public_longitude
+        WHERE new.active AND new.public_latitude IS NOT NULL
+            AND new.public_longitude IS NOT NULL;
+    END
+    """,
+]
+
+
+def spatial_index_available(using=connection):
+    """
+    Returns whether the database supports the spatial index
+    """
+    return using.vendor == "sqlite"
+
+
+def install_spatial_index(using=connection, rebuild=False):
+    """
+    Creates the spatial index and its triggers if they are missing, and
+    optionally rebuilds the index from the listing table
+    """
+    if not spatial_index_available(using):
+        return
+    with using.cursor() as cursor:
+        for statement in SPATIAL_INDEX_SQL:
+            cursor.execute(statement)
+        if rebuild:
+            cursor.execute(f"DELETE FROM {SPATIAL_TABLE}")
+            cursor.execute(f"""
+                INSERT INTO {SPATIAL_TABLE}
+                SELECT
+                    id, public_latitude, public_latitude,
+                    public_longitude, public_longitude
+                FROM auctions_listing
+                WHERE active AND public_latitude IS NOT NULL
+                    AND public_longitude IS NOT NULL
+                """)
+
+
+def parse_bbox(bbox):
+    """
+    Parses a minLng,minLat,maxLng,maxLat bounding box, raising ValueError
+    if it is malformed
+    """
+    min_lng, min_lat, max_lng, max_lat = (float(v) for v in bbox.split(","))
+    if not (-90 <= min_lat <= max_lat <= 90):
+        raise ValueError(bbox)
+    if not (-180 <= min_lng <= 180 and -180 <= max_lng <= 180):
+        raise ValueError(bbox)
+    return min_lng, min_lat, max_lng, max_lat
+
+
+def within_bbox(listings, bbox):
+    """
+    Filters active listings to those whose public location is inside the
+    bounding box. A box whose minimum longitude is greater than its maximum
+    crosses the antimeridian.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    if spatial_index_available():
+        # Joins the index on id, so SQLite drives the query from the R*Tree
+        prefix = "location__"
+        lat_min, lat_max = "min_latitude", "max_latitude"
+        lng_min, lng_max = "min_longitude", "max_longitude"
+    else:
+        prefix = ""
+        lat_min = lat_max = "public_latitude"
+        lng_min = lng_max = "public_longitude"
+    listings = listings.filter(
+        **{
+            f"{prefix}{lat_max}__gte": min_lat,
+            f"{prefix}{lat_min}__lte": max_lat,
+        }
+    )
+    if min_lng <= max_lng:
+        return listings.filter(
+            **{
+                f"{prefix}{lng_max}__gte": min_lng,
+                f"{prefix}{lng_min}__lte": max_lng,
+            }
+        )
+    return listings.filter(
+        Q(**{f"{prefix}{lng_max}__gte": min_lng})
+        | Q(**{f"{prefix}{lng_min}__lte": max_lng})
+    )
@@ -1,3 +1,1859 @@
-from django.test import TestCase
+import asyncio
+import re
+import threading
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    IntegrityError,
+    connection,
+    connections,
+    transaction,
+)
+from django.test import (
+    AsyncClient,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from .authentication import token_cache
+from .clusters import CLUSTER_MAX_ZOOM, rebuild_clusters
+from .comments import aload_comment_tree
+from .descriptions import (
+    description_cache,
+    get_description_client,
+    get_generated_description,
+)
+from .events import get_broker
+from .expiry import close_expired_listings
+from .models import (
+    RATING_PRIOR_MEAN,
+    Bid,
+    Category,
+    Comment,
+    GeneratedDescription,
+    Listing,
+    MapCluster,
+    ProxyBid,
+    Rating,
+    User,
+    Watchlist,
+)
+from .proxies import resolve_proxy_bids
+from .serializers import ListingSerializer, get_listing_cache_key
+from .shards import (
+    get_category_shard,
+    get_listing_shard,
+    get_next_listing_id,
+    use_shard,
+)
+from .threads import PooledASGIHandler
+from .watchlists import MAX_WATCHLIST_UPDATE
+from .viewers import get_viewer_context
+
+# Tables that are read whole on purpose
+SCANNED_TABLES = {"auctions_category"}
+
+
+# A step of a query plan reading a table, an index or a subquery, named
+# "SCAN TABLE" and "SEARCH TABLE" before SQLite 3.36
+PLAN_STEP = re.compile(r"(SCAN|SEARCH) (?:TABLE )?(\w+)(.*)")
+
+
+def get_table_scans(sql):
+    """
+    Returns the number of steps parsed from the plan SQLite chooses for a
+    query, and the tables it reads with a full table scan
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+        plan = cursor.fetchall()
+    tables = set(connection.introspection.table_names())
+    steps = 0
+    scans = []
+    for row in plan:
+        match = PLAN_STEP.fullmatch(row[-1])
+        if not match:
+            continue
+        steps += 1
+        operation, name, rest = match.groups()
+        # A scan of a table, not of an index, a virtual table or a subquery,
+        # which SQLite names after its alias
+        if (
+            operation == "SCAN"
+            and not rest
+            and name in tables
+            and name not in SCANNED_TABLES
+        ):
+            scans.append(name)
+    return steps, scans
+
+
+class QueryPlanTests(TestCase):
+    """
+    Runs EXPLAIN QUERY PLAN on the queries of every endpoint and fails if
+    any of them reads a whole table instead of using an index
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.viewer = User.objects.create_user("viewer", password="x")
+        cls.category = Category.objects.create(category="Books")
+        Category.objects.create(category="Music")
+        cls.listings = [
+            Listing.objects.create(
+                user=cls.seller,
+                category=cls.category,
+                title=f"Book {i}",
+                description="old paperback novel",
+                starting_bid=10,
+                latitude="42.1",
+                longitude="-71.2",
+            )
+            for i in range(20)
+        ]
+        cls.listing = cls.listings[0]
+        cls.listing.place_bid(cls.viewer, 20)
+        cls.listings[1].place_bid(cls.viewer, 20)
+        cls.listings[1].close_listing()
+        Rating.objects.create(listing=cls.listing, user=cls.viewer, rating=4)
+        cls.listing.record_rating(4)
+        Watchlist.objects.create(listing=cls.listing, user=cls.viewer)
+        cls.listing.record_watch(1)
+        cls.comment = Comment.objects.create(
+            listing=cls.listing, user=cls.viewer, comment="Is it signed?"
+        )
+        Comment.objects.create(
+            listing=cls.listing,
+            user=cls.seller,
+            comment="Yes",
+            parent=cls.comment,
+        )
+
+    def setUp(self):
+        # Requests answered from a cache run no queries to check
+        cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        token = Token.objects.create(user=self.viewer)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+
+    def assertNoTableScans(self, method, url, data=None):
+        """
+        Requests url and checks the plans of the queries it ran
+        """
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url, data, format="json")
+        self.assertLess(response.status_code, 400, response.content)
+        self.assertPlansUseIndexes(context.captured_queries)
+
+    def assertPlansUseIndexes(self, queries):
+        """
+        Checks that none of the reads, updates and deletes in queries scans
+        a whole table
+        """
+        for query in queries:
+            sql = query["sql"]
+            if sql.startswith(("SELECT", "UPDATE", "DELETE")):
+                steps, scans = get_table_scans(sql)
+                # Otherwise no scans would be found in a plan not understood
+                self.assertGreater(steps, 0, sql)
+                self.assertEqual(scans, [], sql)
+
+    def test_listing_feeds(self):
+        pk = self.listing.pk
+        urls = [
+            "/api/listings",
+            "/api/listings?filter=all",
+            "/api/listings?filter=closed",
+            "/api/listings?filter=my",
+            "/api/listings?filter=winner",
+            "/api/listings?filter=watchlist",
+            "/api/listings?sort=rating",
+            "/api/listings?query=paperback",
+            "/api/listings?query=paperback&sort=relevance",
+            "/api/listings?cursor=&count=true",
+            f"/api/categories/{self.category.pk}/listings",
+            f"/api/categories/{self.category.pk}/listings?filter=all",
+            f"/api/users/{self.seller.pk}/listings",
+            "/api/watchlist",
+            f"/api/listings/{pk}",
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertNoTableScans("get", url)
+
+    def test_other_reads(self):
+        pk = self.listing.pk
+        urls = [
+            "/api/categories",
+            "/api/me",
+            f"/api/listings/{pk}/comments",
+            f"/api/listings/{pk}/comments/{self.comment.pk}/replies",
+            "/api/map_listings?bbox=-72,41,-70,43",
+            "/api/map_listings?zoom=3",
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertNoTableScans("get", url)
+
+    def test_writes(self):
+        pk = self.listings[2].pk
+        requests = [
+            (f"/api/listings/{pk}/bids", {"bid": 30}),
+            (f"/api/listings/{pk}/max_bid", {"max_bid": 50}),
+            (f"/api/listings/{pk}/watch", None),
+            ("/api/watchlist", {"add": [pk], "remove": [self.listing.pk]}),
+            (f"/api/listings/{pk}/ratings", {"rating": 5}),
+            (f"/api/listings/{pk}/comments", {"comment": "Any stains?"}),
+        ]
+        for url, data in requests:
+            with self.subTest(url=url):
+                self.assertNoTableScans("post", url, data)
+
+    def test_close(self):
+        token = Token.objects.create(user=self.seller)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        self.assertNoTableScans(
+            "post", f"/api/listings/{self.listings[3].pk}/close"
+        )
+
+    def test_expired_listings(self):
+        Listing.objects.filter(pk=self.listings[4].pk).update(
+            ends_at=timezone.now()
+        )
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(close_expired_listings(), 1)
+        self.assertPlansUseIndexes(context.captured_queries)
+        self.assertFalse(Listing.objects.get(pk=self.listings[4].pk).active)
+
+
+class QueryCountTests(TestCase):
+    """
+    Checks that the listing feed and detail run a fixed number of queries,
+    whatever the number of listings, bids, watchers and comments
+    """
+
+    # Token, count, page of listings, and the viewer context
+    FEED_QUERIES = 7
+    # Token, listing version, listing, and the viewer context
+    DETAIL_QUERIES = 7
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.viewer = User.objects.create_user("viewer", password="x")
+        cls.category = Category.objects.create(category="Books")
+        cls.listing = cls.create_listing(0)
+
+    @classmethod
+    def create_listing(cls, i):
+        listing = Listing.objects.create(
+            user=cls.seller,
+            category=cls.category,
+            title=f"Book {i}",
+            description="old paperback novel",
+            starting_bid=10,
+        )
+        bidder = User.objects.create_user(f"bidder{i}", password="x")
+        listing.place_bid(bidder, 20)
+        listing.place_bid(cls.viewer, 30)
+        Watchlist.objects.create(listing=listing, user=bidder)
+        listing.record_watch(1)
+        Rating.objects.create(listing=listing, user=bidder, rating=4)
+        listing.record_rating(4)
+        Comment.objects.create(listing=listing, user=bidder, comment="Hi")
+        return listing
+
+    def setUp(self):
+        self.client = APIClient()
+        token = Token.objects.create(user=self.viewer)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+
+    def assertQueries(self, number, url):
+        """
+        Requests url with cold caches and checks it ran number queries
+        """
+        cache.clear()
+        token_cache.clear()
+        with self.assertNumQueries(number):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_feed(self):
+        self.assertQueries(self.FEED_QUERIES, "/api/listings")
+        for i in range(1, 10):
+            self.create_listing(i)
+        self.assertQueries(self.FEED_QUERIES, "/api/listings")
+
+    def test_feed_revalidation(self):
+        response = self.client.get("/api/listings")
+        etag = response["ETag"]
+        # Answered from the cached version, without reading the listings
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                "/api/listings", HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, 304)
+        # Any write to a listing changes the version once it commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.listing.place_bid(self.seller, 100)
+        response = self.client.get("/api/listings", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_detail_revalidation(self):
+        url = f"/api/listings/{self.listing.pk}"
+        response = self.client.get(url)
+        etag = response["ETag"]
+        self.assertNotIn("Last-Modified", response)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # A bid within the same second as the fetch is not hidden, and a
+        # date is not enough to validate a listing
+        self.listing.place_bid(self.seller, 100)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["current_bid"], 100)
+        response = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60)
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_detail(self):
+        url = f"/api/listings/{self.listing.pk}"
+        self.assertQueries(self.DETAIL_QUERIES, url)
+        for i in range(1, 10):
+            self.create_listing(i)
+        self.assertQueries(self.DETAIL_QUERIES, url)
+
+
+class PlaceBidTests(TestCase):
+    """
+    Checks that Listing.place_bid only accepts bids above the current one on
+    open listings, and keeps current_bid and bid_count in line with the bids
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.bidders = [
+            User.objects.create_user(f"bidder{i}", password="x")
+            for i in range(2)
+        ]
+        cls.category = Category.objects.create(category="Books")
+
+    def setUp(self):
+        self.listing = Listing.objects.create(
+            user=self.seller,
+            category=self.category,
+            title="Book",
+            description="old paperback novel",
+            starting_bid=10,
+        )
+
+    def assertMatchesBids(self, listing):
+        """
+        Checks current_bid and bid_count against the stored bids
+        """
+        listing.refresh_from_db()
+        bids = listing.bids.order_by("-bid")
+        self.assertEqual(listing.bid_count, bids.count())
+        self.assertEqual(listing.current_bid, bids[0].bid)
+
+    def test_lower_or_equal_bid_rejected(self):
+        first, second = self.bidders
+        self.assertIsNotNone(self.listing.place_bid(first, 20))
+        self.assertIsNotNone(self.listing.place_bid(second, 30))
+        # A stale copy of the listing still sees the first bid as current
+        stale = Listing.objects.get(pk=self.listing.pk)
+        stale.current_bid = 20
+        for amount in (25, 30):
+            with self.subTest(amount=amount):
+                self.assertIsNone(stale.place_bid(first, amount))
+        self.assertMatchesBids(self.listing)
+        self.assertEqual(self.listing.current_bid, 30)
+        self.assertEqual(self.listing.bid_count, 2)
+
+    def test_closed_listing_rejected(self):
+        self.listing.place_bid(self.bidders[0], 20)
+        self.listing.close_listing()
+        self.assertIsNone(self.listing.place_bid(self.bidders[1], 30))
+        self.assertMatchesBids(self.listing)
+        self.assertEqual(self.listing.bid_count, 1)
+
+    def test_expired_listing_rejected(self):
+        Listing.objects.filter(pk=self.listing.pk).update(
+            ends_at=timezone.now()
+        )
+        self.assertIsNone(self.listing.place_bid(self.bidders[0], 20))
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.bid_count, 0)
+        self.assertFalse(self.listing.bids.exists())
+
+    def test_aggregates_match_bids(self):
+        for i, amount in enumerate((15, 20, 35, 50)):
+            bid = self.listing.place_bid(self.bidders[i % 2], amount)
+            self.assertEqual(bid.bid, amount)
+            self.assertEqual(self.listing.current_bid, amount)
+            self.assertEqual(self.listing.bid_count, i + 1)
+            self.assertMatchesBids(self.listing)
+
+
+class ListingAggregateTests(TestCase):
+    """
+    Checks the rating, watch and winner aggregates stored on listings by the
+    endpoints that write them, and their reconciliation from the rows
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.users = [
+            User.objects.create_user(f"user{i}", password="x")
+            for i in range(2)
+        ]
+        cls.category = Category.objects.create(category="Books")
+
+    def setUp(self):
+        cache.clear()
+        self.listing = Listing.objects.create(
+            user=self.seller,
+            category=self.category,
+            title="Book",
+            description="old paperback novel",
+            starting_bid=10,
+        )
+
+    def post(self, user, name, data=None):
+        client = APIClient()
+        client.force_authenticate(user)
+        # Runs the cache invalidations that follow the commit
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                reverse(name, args=[self.listing.pk]), data, format="json"
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    def test_ratings(self):
+        for user, rating in zip(self.users, (5, 2)):
+            self.post(user, "ratings", {"rating": rating})
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.rating_sum, 7)
+        self.assertEqual(self.listing.rating_count, 2)
+        self.assertEqual(self.listing.get_average_rating(), 3.5)
+
+    def test_watches(self):
+        first, second = self.users
+        self.post(first, "watch")
+        self.post(second, "watch")
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.watch_count, 2)
+        # Watching again stops watching
+        response = self.post(first, "watch")
+        self.assertFalse(response.data["is_watched"])
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.watch_count, 1)
+
+    def test_close_sets_winner(self):
+        first, second = self.users
+        self.listing.place_bid(first, 20)
+        winning = self.listing.place_bid(second, 30)
+        self.post(self.seller, "close")
+        self.listing.refresh_from_db()
+        self.assertFalse(self.listing.active)
+        self.assertEqual(self.listing.winner_bid, winning)
+        self.assertEqual(
+            list(self.listing.bids.filter(winner=True)), [winning]
+        )
+
+    def test_reconcile(self):
+        first, second = self.users
+        self.listing.place_bid(first, 20)
+        Rating.objects.create(listing=self.listing, user=first, rating=4)
+        Watchlist.objects.create(listing=self.listing, user=second)
+        # Rows written without the aggregates, as before the backfill
+        Listing.objects.filter(pk=self.listing.pk).update(
+            current_bid=10, bid_count=0, rating_sum=0, watch_count=5
+        )
+        call_command("reconcile_listing_aggregates", stdout=StringIO())
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.current_bid, 20)
+        self.assertEqual(self.listing.bid_count, 1)
+        self.assertEqual(self.listing.rating_sum, 4)
+        self.assertEqual(self.listing.rating_count, 1)
+        self.assertEqual(self.listing.watch_count, 1)
+
+
+class SearchTests(TestCase):
+    """
+    Searches listings through the full-text index and checks its matching,
+    ranking and that it follows the listing table
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("seller", password="x")
+        cls.category = Category.objects.create(category="Sports")
+        cls.mountain_bike = cls.create_listing(
+            "Mountain bike", "Carbon frame, barely ridden"
+        )
+        cls.road_bike = cls.create_listing(
+            "Road bike", "Light enough for mountain passes"
+        )
+        cls.table = cls.create_listing("Café table", "Folding, two chairs")
+
+    @classmethod
+    def create_listing(cls, title, description):
+        return Listing.objects.create(
+            user=cls.user,
+            category=cls.category,
+            title=title,
+            description=description,
+            starting_bid=10,
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, query, sort=None):
+        params = {"query": query}
+        if sort:
+            params["sort"] = sort
+        response = self.client.get(reverse("listings"), params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [listing["title"] for listing in response.data["results"]]
+
+    def test_prefix_match_on_title_and_description(self):
+        self.assertCountEqual(
+            self.search("mount"), ["Mountain bike", "Road bike"]
+        )
+        self.assertEqual(self.search("carbon"), ["Mountain bike"])
+        self.assertEqual(self.search("cafe"), ["Café table"])
+        # Every word must match
+        self.assertEqual(self.search("bike carbon"), ["Mountain bike"])
+
+    def test_relevance_ranks_title_matches_first(self):
+        # The road bike is newer, so it comes first by date
+        self.assertEqual(
+            self.search("mountain"), ["Road bike", "Mountain bike"]
+        )
+        self.assertEqual(
+            self.search("mountain", sort="relevance"),
+            ["Mountain bike", "Road bike"],
+        )
+
+    def test_index_follows_edits(self):
+        self.table.title = "Oak desk"
+        self.table.save()
+        self.assertEqual(self.search("oak"), ["Oak desk"])
+        self.assertEqual(self.search("cafe"), [])
+        self.road_bike.delete()
+        self.assertEqual(self.search("mountain"), ["Mountain bike"])
+
+
+class MapViewportTests(TestCase):
+    """
+    Requests the map markers of a viewport and checks that only the active
+    listings inside it are returned, as the spatial index follows them
+    """
+
+    # Zoomed in enough for markers rather than clusters
+    ZOOM = 12
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("seller", password="x")
+        cls.category = Category.objects.create(category="Travel")
+        cls.listings = {
+            title: Listing.objects.create(
+                user=cls.user,
+                category=cls.category,
+                title=title,
+                description="souvenir",
+                starting_bid=10,
+                latitude=latitude,
+                longitude=longitude,
+            )
+            for title, latitude, longitude in [
+                ("Paris", 48.85, 2.35),
+                ("Berlin", 52.52, 13.4),
+                ("Tokyo", 35.68, 139.69),
+                ("Fiji", -17.7, 178.0),
+                ("Samoa", -13.8, -171.8),
+            ]
+        }
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user("viewer", password="x")
+        )
+
+    def get_markers(self, bbox):
+        response = self.client.get(
+            reverse("map_listings"), {"bbox": bbox, "zoom": self.ZOOM}
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        return {marker["title"] for marker in response.data}
+
+    def test_viewport(self):
+        self.assertEqual(self.get_markers("-10,35,30,60"), {"Paris", "Berlin"})
+        self.assertEqual(self.get_markers("100,0,150,60"), {"Tokyo"})
+        self.assertEqual(self.get_markers("-60,-60,-30,-30"), set())
+
+    def test_viewport_across_antimeridian(self):
+        self.assertEqual(self.get_markers("170,-30,-160,0"), {"Fiji", "Samoa"})
+
+    def test_index_follows_listings(self):
+        self.listings["Berlin"].close_listing()
+        paris = self.listings["Paris"]
+        paris.latitude, paris.longitude = 35.0, 139.0
+        paris.save()
+        self.assertEqual(self.get_markers("-10,35,30,60"), set())
+        self.assertEqual(self.get_markers("100,0,150,60"), {"Paris", "Tokyo"})
+
+    def test_malformed_bbox(self):
+        response = self.client.get(reverse("map_listings"), {"bbox": "1,2,3"})
+        self.assertEqual(response.status_code, 400)
+
+
+class MapClusterTests(TestCase):
+    """
+    Checks the clusters served to zoomed-out maps, as maintained when
+    listings are created, closed and moved, against a rebuild
+    """
+
+    ZOOM = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("seller", password="x")
+        cls.category = Category.objects.create(category="Travel")
+        cls.paris = [cls.create_listing(48.85, 2.35) for _ in range(3)]
+        cls.tokyo = cls.create_listing(35.68, 139.69)
+
+    @classmethod
+    def create_listing(cls, latitude, longitude):
+        return Listing.objects.create(
+            user=cls.user,
+            category=cls.category,
+            title="Souvenir",
+            description="fridge magnet",
+            starting_bid=10,
+            latitude=latitude,
+            longitude=longitude,
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_clusters(self, bbox=None):
+        params = {"zoom": self.ZOOM}
+        if bbox is not None:
+            params["bbox"] = bbox
+        response = self.client.get(reverse("map_listings"), params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return sorted(response.data, key=lambda cluster: -cluster["count"])
+
+    def get_stored_clusters(self):
+        return set(
+            MapCluster.objects.values_list("zoom", "cell_x", "cell_y", "count")
+        )
+
+    def test_clusters(self):
+        paris, tokyo = self.get_clusters()
+        self.assertEqual(paris["count"], 3)
+        self.assertCountEqual(
+            paris["listing_ids"], [listing.pk for listing in self.paris]
+        )
+        self.assertAlmostEqual(paris["latitude"], 48.85, delta=0.3)
+        self.assertAlmostEqual(paris["longitude"], 2.35, delta=0.3)
+        self.assertEqual(tokyo["count"], 1)
+        self.assertEqual(tokyo["listing_ids"], [self.tokyo.pk])
+
+    def test_clusters_in_viewport(self):
+        (paris,) = self.get_clusters("-10,35,30,60")
+        self.assertEqual(paris["count"], 3)
+
+    def test_clusters_follow_listings(self):
+        self.paris[0].close_listing()
+        self.tokyo.latitude, self.tokyo.longitude = 48.85, 2.35
+        self.tokyo.save()
+        (paris,) = self.get_clusters()
+        self.assertEqual(paris["count"], 3)
+        self.assertNotIn(self.paris[0].pk, paris["listing_ids"])
+
+    def test_maintained_clusters_match_rebuild(self):
+        self.paris[0].close_listing()
+        self.create_listing(-33.87, 151.21)
+        maintained = self.get_stored_clusters()
+        rebuild_clusters()
+        self.assertEqual(self.get_stored_clusters(), maintained)
+
+
+class ExpiryTests(TestCase):
+    """
+    Closes expired listings in batches and checks the winners, counters,
+    clusters and events they leave, and that open listings are untouched
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.bidders = [
+            User.objects.create_user(f"bidder{i}", password="x")
+            for i in range(2)
+        ]
+        cls.category = Category.objects.create(category="Books")
+
+    def setUp(self):
+        self.now = timezone.now()
+
+    def create_listing(self, ends_in, **fields):
+        return Listing.objects.create(
+            user=self.seller,
+            category=self.category,
+            title="Book",
+            description="old paperback novel",
+            starting_bid=10,
+            ends_at=self.now + timezone.timedelta(minutes=ends_in),
+            **fields,
+        )
+
+    def test_closes_expired_listings_in_batches(self):
+        expired = [self.create_listing(i + 1) for i in range(5)]
+        first, second = self.bidders
+        expired[0].place_bid(first, 20)
+        winning = expired[0].place_bid(second, 30)
+        open_listing = self.create_listing(10)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        subscription = loop.run_until_complete(
+            get_broker().subscribe(expired[0].pk)
+        )
+        self.addCleanup(loop.run_until_complete, subscription.close())
+        with self.captureOnCommitCallbacks(execute=True):
+            closed = close_expired_listings(
+                self.now + timezone.timedelta(minutes=5), batch_size=2
+            )
+        self.assertEqual(closed, len(expired))
+        self.assertEqual(
+            Listing.objects.filter(active=False).count(), len(expired)
+        )
+        open_listing.refresh_from_db()
+        self.assertTrue(open_listing.active)
+        expired[0].refresh_from_db()
+        self.assertEqual(expired[0].winner_bid, winning)
+        self.assertEqual(list(Bid.objects.filter(winner=True)), [winning])
+        self.assertIsNone(Listing.objects.get(pk=expired[1].pk).winner_bid)
+        self.category.refresh_from_db()
+        self.assertEqual(self.category.active_count, 1)
+        event = loop.run_until_complete(subscription.get(1))
+        self.assertEqual(event["type"], "close")
+        self.assertEqual(event["winner_id"], second.pk)
+        self.assertEqual(event["winning_bid"], 30)
+        # Nothing is left to close
+        self.assertEqual(
+            close_expired_listings(self.now + timezone.timedelta(minutes=5)),
+            0,
+        )
+
+    def test_expired_listings_leave_map(self):
+        listing = self.create_listing(-1, latitude=48.85, longitude=2.35)
+        # One cluster per zoom level
+        self.assertEqual(
+            MapCluster.objects.filter(count=1).count(), CLUSTER_MAX_ZOOM + 1
+        )
+        close_expired_listings(self.now)
+        listing.refresh_from_db()
+        self.assertFalse(listing.active)
+        self.assertFalse(MapCluster.objects.exists())
+
+
+class CategoryCatalogTests(TestCase):
+    """
+    Checks that the category list is served from the cache, with active
+    counts kept up to date as listings are created, recategorized and
+    closed, and an ETag that changes with them
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("seller", password="x")
+        cls.books = Category.objects.create(category="Books")
+        cls.games = Category.objects.create(category="Games")
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_listing(self, category):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Listing.objects.create(
+                user=self.user,
+                category=category,
+                title="Item",
+                description="as new",
+                starting_bid=10,
+            )
+
+    def get_counts(self, **headers):
+        response = self.client.get(reverse("categories"), **headers)
+        counts = None
+        if response.status_code == 200:
+            counts = {
+                category["category"]: category["active_listing_count"]
+                for category in response.data
+            }
+        return response, counts
+
+    def test_counts_follow_listings(self):
+        book = self.create_listing(self.books)
+        self.create_listing(self.books)
+        self.assertEqual(self.get_counts()[1], {"Books": 2, "Games": 0})
+        with self.captureOnCommitCallbacks(execute=True):
+            book.category = self.games
+            book.save()
+        self.assertEqual(self.get_counts()[1], {"Books": 1, "Games": 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            book.close_listing()
+        self.assertEqual(self.get_counts()[1], {"Books": 1, "Games": 0})
+
+    def test_served_from_cache(self):
+        self.get_counts()
+        with self.assertNumQueries(0):
+            self.get_counts()
+
+    def test_revalidation(self):
+        response, _ = self.get_counts()
+        etag = response["ETag"]
+        response, _ = self.get_counts(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.create_listing(self.games)
+        response, counts = self.get_counts(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(counts["Games"], 1)
+
+
+class TokenCacheTests(TestCase):
+    """
+    Checks that cached tokens authenticate without queries, and are revoked
+    when they are deleted, as on logout, or their user is deactivated
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("viewer", password="x")
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+    def get_status(self):
+        # The category catalog is cached as well, so this costs no queries
+        # once the caches are warm
+        return self.client.get(reverse("categories")).status_code
+
+    def test_cached_token_costs_no_query(self):
+        self.assertEqual(self.get_status(), 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_status(), 200)
+
+    def test_deactivated_user_rejected(self):
+        self.assertEqual(self.get_status(), 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.get_status(), 401)
+
+    def test_deleted_token_rejected(self):
+        self.assertEqual(self.get_status(), 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+        self.assertEqual(self.get_status(), 401)
+
+    @override_settings(AUTH_TOKEN_SHARED_CACHE="default")
+    def test_shared_cache(self):
+        self.assertEqual(self.get_status(), 200)
+        # Another worker, with nothing in its own cache
+        token_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_status(), 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+        token_cache.clear()
+        self.assertEqual(self.get_status(), 401)
+
+
+class BulkWatchlistTests(TestCase):
+    """
+    Adds and removes many listings from a watchlist at once and checks the
+    ids reported, the stored rows and the watch counts
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.viewer = User.objects.create_user("viewer", password="x")
+        category = Category.objects.create(category="Books")
+        cls.listings = [
+            Listing.objects.create(
+                user=cls.seller,
+                category=category,
+                title=f"Book {i}",
+                description="old paperback novel",
+                starting_bid=10,
+            )
+            for i in range(4)
+        ]
+        cls.own = Listing.objects.create(
+            user=cls.viewer,
+            category=category,
+            title="My book",
+            description="signed copy",
+            starting_bid=10,
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def post(self, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse("watchlist"), data, format="json")
+
+    def get_watched_ids(self):
+        return set(
+            Watchlist.objects.filter(user=self.viewer).values_list(
+                "listing_id", flat=True
+            )
+        )
+
+    def test_add_and_remove(self):
+        first, second, third, _ = [listing.pk for listing in self.listings]
+        response = self.post({"add": [first, second, self.own.pk, 999]})
+        self.assertEqual(response.status_code, 200)
+        # Missing and owned listings are skipped
+        self.assertEqual(response.data["added"], [first, second])
+        response = self.post({"add": [second, third], "remove": [first]})
+        self.assertEqual(response.data, {"added": [third], "removed": [first]})
+        self.assertEqual(self.get_watched_ids(), {second, third})
+        counts = dict(
+            Listing.objects.values_list("pk", "watch_count").filter(
+                pk__in=[first, second, third]
+            )
+        )
+        self.assertEqual(counts, {first: 0, second: 1, third: 1})
+
+    def test_watchlist_feed(self):
+        first = self.listings[0].pk
+        self.post({"add": [first]})
+        response = self.client.get(reverse("watchlist"))
+        self.assertEqual(
+            [listing["id"] for listing in response.data["results"]], [first]
+        )
+        self.assertTrue(response.data["results"][0]["is_watched"])
+
+    def test_invalid_requests(self):
+        first = self.listings[0].pk
+        for data in (
+            {"add": [first], "remove": [first]},
+            {"add": ["one"]},
+            {"add": [True]},
+            {"add": list(range(1, MAX_WATCHLIST_UPDATE + 2))},
+        ):
+            with self.subTest(data=data):
+                self.assertEqual(self.post(data).status_code, 400)
+        self.assertEqual(self.get_watched_ids(), set())
+
+    def test_unique_watch(self):
+        Watchlist.objects.create(user=self.viewer, listing=self.listings[0])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Watchlist.objects.create(
+                user=self.viewer, listing=self.listings[0]
+            )
+
+
+class RatingScoreTests(TestCase):
+    """
+    Checks the Bayesian rating score stored with each rating and the top
+    rated ordering read from it
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.raters = [
+            User.objects.create_user(f"rater{i}", password="x")
+            for i in range(10)
+        ]
+        cls.category = Category.objects.create(category="Books")
+        cls.unrated = cls.create_listing("Unrated")
+        cls.few = cls.create_listing("One perfect rating")
+        cls.many = cls.create_listing("Many good ratings")
+
+    @classmethod
+    def create_listing(cls, title):
+        return Listing.objects.create(
+            user=cls.seller,
+            category=cls.category,
+            title=title,
+            description="old paperback novel",
+            starting_bid=10,
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def rate(self, listing, user, rating):
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post(
+            reverse("ratings", args=[listing.pk]),
+            {"rating": rating},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def get_score(self, listing):
+        listing.refresh_from_db()
+        return listing.rating_score
+
+    def test_score(self):
+        self.assertEqual(self.get_score(self.unrated), RATING_PRIOR_MEAN)
+        self.rate(self.few, self.raters[0], 5)
+        # (5 + 3 * 5) / (1 + 5)
+        self.assertAlmostEqual(self.get_score(self.few), 20 / 6)
+        for rater in self.raters:
+            self.rate(self.many, rater, 4)
+        # (40 + 3 * 5) / (10 + 5)
+        self.assertAlmostEqual(self.get_score(self.many), 55 / 15)
+
+    def test_top_rated_order(self):
+        self.rate(self.few, self.raters[0], 5)
+        for rater in self.raters:
+            self.rate(self.many, rater, 4)
+        client = APIClient()
+        client.force_authenticate(self.seller)
+        response = client.get(reverse("listings"), {"sort": "rating"})
+        self.assertEqual(
+            [listing["title"] for listing in response.data["results"]],
+            ["Many good ratings", "One perfect rating", "Unrated"],
+        )
+
+    def test_reconciled_score(self):
+        Rating.objects.create(listing=self.few, user=self.raters[0], rating=5)
+        call_command("reconcile_listing_aggregates", stdout=StringIO())
+        self.assertAlmostEqual(self.get_score(self.few), 20 / 6)
+
+
+class ProxyBidTests(TestCase):
+    """
+    Checks the bids the proxy engine places for the maximum bids of a
+    listing
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.bidders = [
+            User.objects.create_user(f"bidder{i}", password="x")
+            for i in range(3)
+        ]
+        cls.category = Category.objects.create(category="Books")
+
+    def setUp(self):
+        cache.clear()
+        self.listing = Listing.objects.create(
+            user=self.seller,
+            category=self.category,
+            title="Book",
+            description="old paperback novel",
+            starting_bid=10,
+        )
+
+    def set_max_bid(self, user, max_bid):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post(
+            reverse("max_bid", args=[self.listing.pk]),
+            {"max_bid": max_bid},
+            format="json",
+        )
+
+    def get_bids(self):
+        return [
+            (bid.user, bid.bid) for bid in self.listing.bids.order_by("id")
+        ]
+
+    def test_leader_pays_runner_up_price(self):
+        first, second, _ = self.bidders
+        ProxyBid.objects.create(listing=self.listing, user=first, max_bid=50)
+        ProxyBid.objects.create(listing=self.listing, user=second, max_bid=40)
+        resolve_proxy_bids(self.listing)
+        self.assertEqual(self.get_bids(), [(second, 40), (first, 41)])
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.current_bid, 41)
+        # The leader does not bid against itself
+        self.assertEqual(resolve_proxy_bids(self.listing), [])
+
+    def test_tie_won_by_earliest_proxy(self):
+        first, second, _ = self.bidders
+        ProxyBid.objects.create(listing=self.listing, user=first, max_bid=50)
+        ProxyBid.objects.create(listing=self.listing, user=second, max_bid=50)
+        resolve_proxy_bids(self.listing)
+        self.assertEqual(self.get_bids(), [(first, 50)])
+
+    def test_capped_at_max_bid(self):
+        first, second, _ = self.bidders
+        ProxyBid.objects.create(listing=self.listing, user=first, max_bid=50)
+        ProxyBid.objects.create(listing=self.listing, user=second, max_bid=49)
+        resolve_proxy_bids(self.listing)
+        self.assertEqual(self.get_bids(), [(second, 49), (first, 50)])
+        # Nobody bids over a maximum, however high the competing bid
+        self.listing.place_bid(self.bidders[2], 60)
+        self.assertEqual(resolve_proxy_bids(self.listing), [])
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.current_bid, 60)
+
+    def test_outbid_proxy_owner(self):
+        owner, challenger, bidder = self.bidders
+        response = self.set_max_bid(owner, 30)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["max_bid"], 30)
+        self.assertEqual(self.get_bids(), [(owner, 10)])
+        # A higher maximum outbids the owner at one increment over theirs
+        response = self.set_max_bid(challenger, 45)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_bids()[-2:], [(owner, 30), (challenger, 31)])
+        # The owner keeps their maximum, and the challenger's proxy answers
+        # a manual bid
+        client = APIClient()
+        client.force_authenticate(bidder)
+        response = client.post(
+            reverse("bid", args=[self.listing.pk]), {"bid": 40}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["current_bid"], 41)
+        self.assertEqual(self.get_bids()[-1], (challenger, 41))
+        response = self.set_max_bid(owner, 30)
+        self.assertEqual(response.status_code, 400)
+
+
+class CommentTreeTests(TestCase):
+    """
+    Checks that the comment list loads only the replies it shows, however
+    many a thread has, and still counts all of them
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("seller", password="x")
+        cls.listing = Listing.objects.create(
+            user=cls.user,
+            category=Category.objects.create(category="Books"),
+            title="Book",
+            description="old paperback novel",
+            starting_bid=10,
+        )
+        cls.root = cls.comment("Still available?")
+        # Oldest first
+        cls.replies = [cls.comment(f"Reply {i}", cls.root) for i in range(8)]
+        for i in range(3):
+            cls.comment(f"Nested {i}", cls.replies[-1])
+
+    @classmethod
+    def comment(cls, text, parent=None):
+        return Comment.objects.create(
+            listing=cls.listing, user=cls.user, comment=text, parent=parent
+        )
+
+    def load(self, reply_limit):
+        """
+        Returns the replies loaded for the tree and the reply counts
+        """
+        context = async_to_sync(aload_comment_tree)(
+            self.listing, [self.root], reply_limit
+        )
+        loaded = [
+            reply.comment
+            for replies in context["replies"].values()
+            for reply in replies
+        ]
+        return loaded, context["reply_counts"]
+
+    def test_replies_capped_per_comment(self):
+        loaded, reply_counts = self.load(2)
+        self.assertCountEqual(
+            loaded, ["Reply 7", "Reply 6", "Nested 2", "Nested 1"]
+        )
+        self.assertEqual(reply_counts[self.root.id], 8)
+        self.assertEqual(reply_counts[self.replies[-1].id], 3)
+
+    def test_replies_capped_per_thread(self):
+        with mock.patch("auctions.comments.MAX_THREAD_REPLIES", 4):
+            loaded, reply_counts = self.load(10)
+        # The oldest replies of the thread, with the parents they need
+        self.assertCountEqual(loaded, [f"Reply {i}" for i in range(4)])
+        self.assertEqual(reply_counts[self.root.id], 8)
+
+    def test_no_replies(self):
+        loaded, reply_counts = self.load(0)
+        self.assertEqual(loaded, [])
+        self.assertEqual(reply_counts[self.root.id], 8)
+
+    def test_comment_list(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(
+            reverse("comments", args=[self.listing.pk]), {"reply_limit": 1}
+        )
+        self.assertEqual(response.status_code, 200)
+        (root,) = response.data["results"]
+        self.assertEqual(root["reply_count"], 8)
+        (reply,) = root["replies"]
+        self.assertEqual(reply["comment"], "Reply 7")
+        self.assertEqual(reply["reply_count"], 3)
+        self.assertEqual(len(reply["replies"]), 1)
+
+
+class ListingEventTests(TestCase):
+    """
+    Checks that writes publish their events once committed, and that the
+    event stream of a listing sends its snapshot and then those events
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.buyer = User.objects.create_user("buyer", password="x")
+        cls.token = Token.objects.create(user=cls.buyer)
+        cls.listing = Listing.objects.create(
+            user=cls.seller,
+            category=Category.objects.create(category="Books"),
+            title="Book",
+            description="old paperback novel",
+            starting_bid=10,
+        )
+
+    def setUp(self):
+        token_cache.clear()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def subscribe(self, listing_id):
+        """
+        Subscribes to the events of a listing from the test's event loop
+        """
+        subscription = self.loop.run_until_complete(
+            get_broker().subscribe(listing_id)
+        )
+        self.addCleanup(self.loop.run_until_complete, subscription.close())
+        return subscription
+
+    def get_event(self, subscription, timeout=1):
+        return self.loop.run_until_complete(subscription.get(timeout))
+
+    def test_published_on_commit(self):
+        subscription = self.subscribe(self.listing.pk)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.listing.place_bid(self.buyer, 20)
+        self.assertIsNone(self.get_event(subscription, timeout=0))
+        for callback in callbacks:
+            callback()
+        event = self.get_event(subscription)
+        self.assertEqual(event["type"], "bid")
+        self.assertEqual(event["current_bid"], 20)
+        self.assertEqual(event["bid_count"], 1)
+        self.assertEqual(event["bid"]["user_id"], self.buyer.pk)
+
+    def test_published_to_listing_subscribers_only(self):
+        subscription = self.subscribe(self.listing.pk)
+        other = self.subscribe(self.listing.pk + 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.listing.close_listing()
+        self.assertEqual(self.get_event(subscription)["type"], "close")
+        self.assertIsNone(self.get_event(other, timeout=0))
+
+    def test_stream(self):
+        async def read_stream():
+            response = await AsyncClient().get(
+                reverse("listing_events", args=[self.listing.pk]),
+                {"token": self.token.key},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            chunks = aiter(response.streaming_content)
+            messages = [await anext(chunks), await anext(chunks)]
+            get_broker().publish(
+                self.listing.pk, {"type": "close", "listing_id": 1}
+            )
+            messages.append(await anext(chunks))
+            await chunks.aclose()
+            return [message.decode() for message in messages]
+
+        retry, snapshot, close = async_to_sync(read_stream)()
+        self.assertTrue(retry.startswith("retry: "))
+        self.assertTrue(snapshot.startswith("event: snapshot\n"))
+        self.assertIn('"current_bid": 10', snapshot)
+        self.assertTrue(close.startswith("event: close\n"))
+
+    def test_stream_requires_token(self):
+        response = self.client.get(
+            reverse("listing_events", args=[self.listing.pk])
+        )
+        self.assertEqual(response.status_code, 401)
+
+
+class ViewerContextTests(TestCase):
+    """
+    Checks that the viewer context is cached between requests, and dropped
+    by the writes that change it so the per-viewer fields stay current
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.viewer = User.objects.create_user("viewer", password="x")
+        cls.listing = Listing.objects.create(
+            user=cls.seller,
+            category=Category.objects.create(category="Books"),
+            title="Book",
+            description="old paperback novel",
+            starting_bid=10,
+            latitude=48.85,
+            longitude=2.35,
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def request(self, method, name, data=None):
+        # Runs the invalidations that follow the commit
+        with self.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(
+                reverse(name, args=[self.listing.pk]), data, format="json"
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data
+
+    def test_cached_between_requests(self):
+        get_viewer_context(self.viewer)
+        with self.assertNumQueries(0):
+            viewer = get_viewer_context(self.viewer)
+        self.assertEqual(viewer.user_id, self.viewer.pk)
+
+    def test_fields_follow_writes(self):
+        listing = self.request("get", "listing")
+        self.assertFalse(listing["is_watched"])
+        self.assertIsNone(listing["user_rating"])
+        self.assertIsNone(listing["max_bid"])
+        self.request("post", "watch")
+        self.request("post", "ratings", {"rating": 4})
+        self.request("post", "max_bid", {"max_bid": 50})
+        listing = self.request("get", "listing")
+        self.assertTrue(listing["is_watched"])
+        self.assertEqual(listing["user_rating"], 4)
+        self.assertEqual(listing["max_bid"], 50)
+
+    def test_winner_sees_location(self):
+        self.listing.refresh_from_db()
+        listing = self.request("get", "listing")
+        self.assertNotEqual(listing["latitude"], self.listing.latitude)
+        self.request("post", "bid", {"bid": 20})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.listing.close_listing()
+        listing = self.request("get", "listing")
+        self.assertEqual(listing["latitude"], self.listing.latitude)
+        self.assertEqual(listing["longitude"], self.listing.longitude)
+
+
+class ListingCacheTests(TestCase):
+    """
+    Checks that serialized listings are read from the cache until the
+    listing changes, with the viewer and related fields merged on for each
+    request
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", password="x")
+        cls.viewer = User.objects.create_user("viewer", password="x")
+        cls.category = Category.objects.create(category="Books")
+        cls.listing = Listing.objects.create(
+            user=cls.seller,
+            category=cls.category,
+            title="Book",
+            description="old paperback novel",
+            starting_bid=10,
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+        self.url = f"/api/listings/{self.listing.pk}"
+
+    def get(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_cache_hit(self):
+        self.assertEqual(self.get()["title"], "Book")
+        self.listing.refresh_from_db()
+        self.assertIsNotNone(cache.get(get_listing_cache_key(self.listing)))
+        # A change that keeps updated_at is not seen, so the cache was read
+        Listing.objects.filter(pk=self.listing.pk).update(
+            title="Changed", updated_at=self.listing.updated_at
+        )
+        self.assertEqual(self.get()["title"], "Book")
+
+    def test_key_changes_after_write(self):
+        self.get()
+        self.listing.refresh_from_db()
+        key = get_listing_cache_key(self.listing)
+        self.listing.place_bid(self.viewer, 20)
+        self.listing.refresh_from_db()
+        self.assertNotEqual(get_listing_cache_key(self.listing), key)
+        data = self.get()
+        self.assertEqual(data["current_bid"], 20)
+        self.assertEqual(data["total_bids"], 1)
+
+    def test_related_fields_not_cached(self):
+        self.assertEqual(self.get()["username"], "seller")
+        # Neither rename writes the listing
+        self.seller.first_name = "ada"
+        self.seller.save()
+        self.category.category = "Old books"
+        self.category.save()
+        data = self.get()
+        self.assertEqual(data["username"], "Ada")
+        self.assertEqual(data["category_name"], "Old books")
+
+    def test_field_order(self):
+        # On a miss and on a hit
+        for _ in range(2):
+            data = self.get()
+            self.assertEqual(list(data), ListingSerializer.Meta.fields)
+            self.assertIs(data["is_owner"], False)
+            self.assertIs(data["is_watched"], False)
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    Checks which requests read from the replica, a mirror of the default
+    test database, and that clients read from the primary after they wrote
+    and whenever a cache is rebuilt
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The replica alias only exists for these tests: a second
+        # connection to the default test database, marked as its mirror so
+        # that it is not flushed separately. It is added after the test
+        # runner set up the databases, which does not know about it.
+        default = connections["default"].settings_dict
+        connections.settings["replica"] = {
+            **default,
+            "TEST": {**default["TEST"], "MIRROR": "default"},
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        connections["replica"].close()
+        del connections["replica"]
+        del connections.settings["replica"]
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.seller = User.objects.create_user("seller", password="x")
+        self.viewer = User.objects.create_user("viewer", password="x")
+        self.category = Category.objects.create(category="Books")
+        self.listing = Listing.objects.create(
+            user=self.seller,
+            category=self.category,
+            title="Book",
+            description="old paperback novel",
+            starting_bid=10,
+        )
+        self.client = self.client_for(self.viewer)
+
+    def client_for(self, user):
+        client = APIClient()
+        token = Token.objects.create(user=user)
+        client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        return client
+
+    def request(self, client, method, url, data=None):
+        """
+        Requests url and returns the response and the tables read from the
+        primary and from the replica
+        """
+        with CaptureQueriesContext(
+            connections["default"]
+        ) as primary, CaptureQueriesContext(connections["replica"]) as replica:
+            response = getattr(client, method)(url, data, format="json")
+        self.assertLess(response.status_code, 400, response.content)
+        return response, self.get_tables(primary), self.get_tables(replica)
+
+    def get_tables(self, context):
+        """
+        Returns the tables the reads captured in context selected from
+        """
+        return {
+            match
+            for query in context.captured_queries
+            if query["sql"].startswith("SELECT")
+            for match in re.findall(r'FROM "(\w+)"', query["sql"])
+        }
+
+    def test_browse_reads_replica(self):
+        _, primary, replica = self.request(self.client, "get", "/api/listings")
+        self.assertIn("auctions_listing", replica)
+        # Tokens and the cached viewer context come from the primary
+        self.assertIn("authtoken_token", primary)
+        self.assertIn("auctions_watchlist", primary)
+        self.assertNotIn("authtoken_token", replica)
+        self.assertNotIn("auctions_watchlist", replica)
+
+    def test_catalog_rebuilt_from_primary(self):
+        _, primary, replica = self.request(
+            self.client, "get", "/api/categories"
+        )
+        self.assertIn("auctions_category", primary)
+        self.assertNotIn("auctions_category", replica)
+
+    def test_other_endpoints_read_primary(self):
+        _, _, replica = self.request(self.client, "get", "/api/me")
+        self.assertEqual(replica, set())
+
+    def test_reads_own_writes(self):
+        url = f"/api/listings/{self.listing.pk}"
+        _, _, replica = self.request(
+            self.client, "post", f"{url}/bids", {"bid": 20}
+        )
+        self.assertEqual(replica, set())
+        # The client that bid is pinned to the primary for a while
+        response, primary, replica = self.request(self.client, "get", url)
+        self.assertEqual(response.data["current_bid"], 20)
+        self.assertIn("auctions_listing", primary)
+        self.assertEqual(replica, set())
+        # Other clients still read from the replica
+        other = self.client_for(User.objects.create_user("other"))
+        _, _, replica = self.request(other, "get", url)
+        self.assertIn("auctions_listing", replica)
+
+
+@override_settings(LISTING_SHARDS=["shard_a", "shard_b"])
+class ShardingTests(TransactionTestCase):
+    """
+    Checks that listings and their rows are stored in the shard of their
+    category, that the feed merges the shards and that the move command
+    brings listings of the default database over to their shards
+    """
+
+    SHARDS = ["shard_a", "shard_b"]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Like the replica alias, the shards only exist for these tests: an
+        # in-memory database each, migrated here since the test runner does
+        # not know about them
+        default = connections["default"].settings_dict
+        for alias in cls.SHARDS:
+            connections.settings[alias] = {
+                **default,
+                "NAME": f"file:memorydb_{alias}?mode=memory&cache=shared",
+            }
+            call_command("migrate", database=alias, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        for alias in cls.SHARDS:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.seller = User.objects.create_user("seller", password="x")
+        self.buyer = User.objects.create_user("buyer", password="x")
+        # Consecutive ids, so one category per shard
+        self.categories = [
+            Category.objects.create(category="Books"),
+            Category.objects.create(category="Games"),
+        ]
+        self.client = APIClient()
+        token = Token.objects.create(user=self.buyer)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+
+    def tearDown(self):
+        for alias in self.SHARDS:
+            call_command(
+                "flush", database=alias, interactive=False, verbosity=0
+            )
+
+    def create_listing(self, i, **fields):
+        return Listing.objects.create_in_shard(
+            user=self.seller,
+            category=self.categories[i % 2],
+            title=f"Book {i}",
+            description="old paperback novel",
+            starting_bid=10,
+            **fields,
+        )
+
+    def test_listing_stored_in_category_shard(self):
+        for i in range(4):
+            listing = self.create_listing(i)
+            alias = get_category_shard(listing.category_id)
+            self.assertEqual(listing._state.db, alias)
+            # The id encodes the shard, so a listing is found from its URL
+            self.assertEqual(get_listing_shard(listing.pk), alias)
+        self.assertFalse(Listing.objects.using(DEFAULT_DB_ALIAS).exists())
+        for alias in self.SHARDS:
+            self.assertEqual(Listing.objects.using(alias).count(), 2)
+
+    def test_next_listing_id(self):
+        self.assertEqual(get_next_listing_id(Listing.objects, "shard_a"), 2)
+        self.assertEqual(get_next_listing_id(Listing.objects, "shard_b"), 3)
+        listing = self.create_listing(0)
+        other = self.create_listing(0)
+        self.assertEqual(other.pk, listing.pk + len(self.SHARDS))
+
+    def test_requests_routed_to_listing_shard(self):
+        listing = self.create_listing(0)
+        alias = listing._state.db
+        other = next(shard for shard in self.SHARDS if shard != alias)
+        url = reverse("listing", args=[listing.pk])
+        with CaptureQueriesContext(connections[other]) as queries:
+            response = self.client.post(
+                reverse("bid", args=[listing.pk]), {"bid": 20}, format="json"
+            )
+            self.assertEqual(response.status_code, 200, response.content)
+            response = self.client.get(url)
+        self.assertEqual(response.data["current_bid"], 20)
+        # Only the viewer context reads the rows of the user from every shard
+        self.assertFalse(
+            any(
+                "auctions_listing" in query["sql"] or "INSERT" in query["sql"]
+                for query in queries.captured_queries
+            )
+        )
+        self.assertEqual(Bid.objects.using(alias).get().bid, 20)
+
+    def test_feed_merged_across_shards(self):
+        for i in range(5):
+            self.create_listing(i)
+        titles = []
+        for page in (1, 2, 3):
+            response = self.client.get(
+                reverse("listings"), {"limit": 2, "page": page}
+            )
+            self.assertEqual(response.data["count"], 5)
+            titles += [
+                listing["title"] for listing in response.data["results"]
+            ]
+        self.assertEqual(titles, [f"Book {i}" for i in range(4, -1, -1)])
+
+    def test_references_mirrored(self):
+        listing = self.create_listing(0)
+        alias = listing._state.db
+        with use_shard(alias):
+            listing.place_bid(self.buyer, 20)
+        mirrored = User.objects.using(alias).get(pk=self.buyer.pk)
+        self.assertEqual(mirrored.username, "buyer")
+        # Only the names are copied, never the password hash
+        self.assertEqual(mirrored.password, "")
+        self.assertTrue(
+            Category.objects.using(alias)
+            .filter(pk=listing.category_id)
+            .exists()
+        )
+        # Later bids find the user in the shard and copy nothing
+        with use_shard(alias), CaptureQueriesContext(
+            connections[alias]
+        ) as queries:
+            listing.place_bid(self.buyer, 30)
+        self.assertFalse(
+            any(
+                query["sql"].startswith("INSERT")
+                and "auctions_user" in query["sql"]
+                for query in queries.captured_queries
+            )
+        )
+        # Renames are carried over
+        self.buyer.first_name = "ann"
+        self.buyer.save()
+        self.assertEqual(
+            User.objects.using(alias).get(pk=self.buyer.pk).first_name, "ann"
+        )
+
+    def test_move_listings_to_shards(self):
+        with self.settings(LISTING_SHARDS=[]):
+            listings = [self.create_listing(i) for i in range(3)]
+            listings[0].place_bid(self.buyer, 20)
+        call_command("move_listings_to_shards", stdout=StringIO())
+        self.assertFalse(Listing.objects.using(DEFAULT_DB_ALIAS).exists())
+        for listing in listings:
+            alias = get_category_shard(listing.category_id)
+            moved = Listing.objects.using(alias).get(title=listing.title)
+            self.assertEqual(get_listing_shard(moved.pk), alias)
+        moved = Listing.objects.using(
+            get_category_shard(listings[0].category_id)
+        ).get(title=listings[0].title)
+        self.assertEqual(moved.current_bid, 20)
+        self.assertEqual(moved.bids.get().user_id, self.buyer.pk)
+
+
+class PooledASGIHandlerTests(TransactionTestCase):
+    """
+    Serves requests through the ASGI application and checks that their sync
+    code runs on a pooled thread that keeps its database connection
+    """
+
+    def setUp(self):
+        token_cache.clear()
+        self.handler = PooledASGIHandler()
+        user = User.objects.create_user("viewer", password="x")
+        self.token = Token.objects.create(user=user).key
+
+    def tearDown(self):
+        for executor in self.handler.thread_pool.idle:
+            executor.submit(connections.close_all).result()
+            executor.shutdown()
+
+    def request(self, path):
+        """
+        Sends a GET request for path to the handler and returns its status
+        """
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "query_string": b"",
+            "headers": [(b"authorization", f"Token {self.token}".encode())],
+        }
+        asyncio.run(self.handler(scope, receive, send))
+        return messages[0]["status"]
+
+    def test_connection_reused(self):
+        served = []
+
+        def record(**kwargs):
+            served.append((threading.get_ident(), connection.connection))
+
+        request_finished.connect(record)
+        try:
+            for _ in range(3):
+                token_cache.clear()
+                self.assertEqual(self.request(reverse("categories")), 200)
+        finally:
+            request_finished.disconnect(record)
+        self.assertEqual(len(served), 3)
+        self.assertEqual(len(set(served)), 1)
+        self.assertIsNotNone(served[0][1])
+        self.assertNotEqual(served[0][0], threading.get_ident())
+
+
+@override_settings(
+    DESCRIPTION_CLIENT="auctions.descriptions.StubClient",
+    DESCRIPTION_CLIENT_OPTIONS={"delay": 0.05},
+)
+class DescriptionTests(TestCase):
+    """
+    Generates descriptions with the stub client and checks that every title
+    reaches it only once
+    """
+
+    def setUp(self):
+        get_description_client.cache_clear()
+        description_cache.clear()
+        self.stub = get_description_client()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("seller"))
+
+    def tearDown(self):
+        get_description_client.cache_clear()
+        description_cache.clear()
+
+    def generate(self, title, category=None):
+        data = {"title": title}
+        if category is not None:
+            data["category"] = category.id
+        response = self.client.post(
+            reverse("generate_description"), data, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.data["description"]
+
+    def test_cached_by_normalized_title(self):
+        for title in ("Mountain bike", "  mountain BIKE!", "Mountain-bike"):
+            self.assertEqual(self.generate(title), self.stub.description)
+        self.assertEqual(self.stub.calls, 1)
+        generated = GeneratedDescription.objects.get()
+        self.assertEqual(generated.normalized_title, "mountain bike")
+        self.assertEqual(generated.model, "stub")
+        self.assertGreater(generated.latency, 0)
+        self.assertGreater(generated.total_tokens(), 0)
+        # A worker with an empty in-process cache reads the database
+        description_cache.clear()
+        self.generate("Mountain bike")
+        self.assertEqual(self.stub.calls, 1)
+        # The same title in a category is generated again
+        category = Category.objects.create(category="Bikes")
+        self.generate("Mountain bike", category)
+        self.assertEqual(self.stub.calls, 2)
+
+    def test_concurrent_requests_coalesced(self):
+        async def generate():
+            return await asyncio.gather(
+                *(get_generated_description("Road bike") for _ in range(5))
+            )
+
+        generated = async_to_sync(generate)()
+        self.assertEqual(self.stub.calls, 1)
+        self.assertEqual({g.pk for g in generated}, {generated[0].pk})
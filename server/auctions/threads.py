@@ -0,0 +1,93 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync, ThreadSensitiveContext
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connections
+
+
+class ThreadPool:
+    """
+    Single thread executors lent to ASGI requests for their sync code. A
+    thread keeps its database connections between the requests it serves,
+    so they persist for CONN_MAX_AGE as in a WSGI worker thread and the
+    SQLite pragmas are applied once per connection. At most max_idle
+    threads are kept while no request uses them.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Returns an idle executor, or a new one if none is idle
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return ThreadPoolExecutor(max_workers=1)
+
+    def release(self, executor):
+        """
+        Takes back an executor a request is done with, or stops its thread
+        after closing its connections if enough are idle already
+        """
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(executor)
+                return
+        executor.submit(connections.close_all)
+        executor.shutdown(wait=False)
+
+
+class PooledThreadContext(ThreadSensitiveContext):
+    """
+    ThreadSensitiveContext that runs the sync code of a request (the ORM,
+    DRF and the request signals) on a thread borrowed from a ThreadPool,
+    instead of a new thread that exits with the request and leaves its
+    connections behind
+    """
+
+    def __init__(self, thread_pool):
+        super().__init__()
+        self.thread_pool = thread_pool
+        self.executor = None
+
+    async def __aenter__(self):
+        await super().__aenter__()
+        # Only the outermost context picks the thread
+        if self.token is not None:
+            self.executor = self.thread_pool.acquire()
+            SyncToAsync.context_to_thread_executor[self] = self.executor
+        return self
+
+    async def __aexit__(self, exc, value, tb):
+        if self.executor is not None:
+            # Taken back before ThreadSensitiveContext shuts it down
+            SyncToAsync.context_to_thread_executor.pop(self, None)
+            self.thread_pool.release(self.executor)
+            self.executor = None
+        await super().__aexit__(exc, value, tb)
+
+
+class PooledASGIHandler(ASGIHandler):
+    """
+    Django's ASGI handler, serving every request from a pooled thread, see
+    PooledThreadContext. The pool keeps up to ASGI_IDLE_THREADS threads.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.thread_pool = ThreadPool(settings.ASGI_IDLE_THREADS)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            raise ValueError(
+                "Django can only handle ASGI/HTTP connections, not %s."
+                % scope["type"]
+            )
+        async with PooledThreadContext(self.thread_pool):
+            await self.handle(scope, receive, send)
@@ -48,11 +48,26 @@ urlpatterns = [
         views.CommentViewSet.as_view(),
         name="comments",
     ),  # endpoint for comments
+    path(
+        "listings/<int:pk>/comments/<int:comment_pk>/replies",
+        views.CommentReplyViewSet.as_view(),
+        name="comment_replies",
+    ),  # endpoint for comment replies
     path(
         "listings/<int:pk>/bids",
         views.BidViewSet.as_view(),
         name="bid",
     ),  # endpoint for bids
+    path(
+        "listings/<int:pk>/max_bid",
+        views.ProxyBidViewSet.as_view(),
+        name="max_bid",
+    ),  # endpoint for maximum bids
+    path(
+        "listings/<int:pk>/events",
+        views.ListingEventViewSet.as_view(),
+        name="listing_events",
+    ),  # endpoint for listing events
     path(
         "listings/<int:pk>/close",
         views.CloseListingViewSet.as_view(),
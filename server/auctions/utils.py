@@ -1,5 +1,31 @@
+import base64
+import decimal
+import hashlib
+import json
+import random
+import uuid
 from datetime import datetime, timezone
 
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Q
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive
+from rest_framework.exceptions import ParseError
+
+from .routers import use_primary
+from .search import search_listings
+from .shards import acount_listings, afetch_listings
+
+# Number of seconds the exact count of a cursor paginated listing query is
+# cached for
+LISTING_COUNT_CACHE_TIMEOUT = 30
+
+# Cache key holding the current version of the listing collections
+LISTING_COLLECTION_VERSION_KEY = "listing_collection:version"
+
 
 # Returns the time ago the listing was posted
 def get_time_ago(time):
@@ -15,8 +41,55 @@ def get_time_ago(time):
         return f"{time_elapsed.seconds} seconds ago"
 
 
-# Filters listings based on the filter and query
-def filter_objects(request, listings, listing_filter, query):
+# Returns a random delta between -0.3 and 0.3 degrees used to obfuscate map
+# coordinates
+def get_map_coordinates_delta():
+    delta = decimal.Decimal(random.randrange(1, 300)) / 1000
+    return delta if random.random() < 0.5 else -delta
+
+
+# Converts a coordinate to a Decimal, keeping None
+def to_decimal(value):
+    if value is None:
+        return None
+    return decimal.Decimal(str(value))
+
+
+# Parses an auction end time given as an ISO 8601 string, raising
+# ValueError if it is invalid or not in the future
+def parse_end_time(value):
+    if value in (None, ""):
+        return None
+    ends_at = parse_datetime(str(value))
+    if ends_at is None:
+        raise ValueError("Invalid end time")
+    if is_naive(ends_at):
+        ends_at = ends_at.replace(tzinfo=timezone.utc)
+    if ends_at <= datetime.now(timezone.utc):
+        raise ValueError("End time must be in the future")
+    return ends_at
+
+
+# Parses a list of listing ids from a request body, raising ValueError if it
+# is not a list of integers
+def parse_listing_ids(value):
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ValueError("Listing ids must be a list")
+    ids = []
+    for listing_id in value:
+        if isinstance(listing_id, bool):
+            raise ValueError("Listing ids must be integers")
+        try:
+            ids.append(int(listing_id))
+        except (TypeError, ValueError):
+            raise ValueError("Listing ids must be integers")
+    return ids
+
+
+# Filters listings based on the filter and query, and orders them by sort
+def filter_objects(request, listings, listing_filter, query, sort=None):
     if listing_filter == "active":
         listings = listings.filter(active=True)
     elif listing_filter == "closed":
@@ -30,5 +103,180 @@ def filter_objects(request, listings, listing_filter, query):
     else:
         listings = listings.all()
     if query:
-        listings = listings.filter(title__icontains=query)
+        listings = search_listings(
+            listings, query, rank=(sort == "relevance")
+        )
+        if sort == "relevance":
+            listings = listings.order_by("search_rank", "-created_at")
+    if sort == "rating":
+        # In the order of the listing_rating_rank index, so a page is read
+        # from the index without sorting the listings
+        listings = listings.order_by("-rating_score", "-created_at")
     return listings
+
+
+# Encodes a keyset position as an opaque cursor
+def encode_cursor(listing, direction):
+    position = {
+        "c": listing.created_at.isoformat(),
+        "i": listing.id,
+        "d": direction,
+    }
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+# Decodes a cursor into its created_at, id and direction
+def decode_cursor(cursor):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        created_at = datetime.fromisoformat(position["c"])
+        direction = position["d"]
+        if direction not in ("next", "previous"):
+            raise ValueError(direction)
+        return created_at, int(position["i"]), direction
+    except (ValueError, TypeError, KeyError):
+        raise ParseError("Invalid cursor")
+
+
+# Returns the exact number of listings, cached for a short time per query
+# and counted on the primary
+async def aget_cached_count(request, listings):
+    params = sorted(
+        (key, value)
+        for key, value in request.query_params.items()
+        if key not in ("cursor", "page")
+    )
+    key = "listing_count:" + hashlib.md5(
+        json.dumps([request.path, request.user.pk, params]).encode()
+    ).hexdigest()
+    count = await cache.aget(key)
+    if count is None:
+        with use_primary():
+            count = await acount_listings(listings)
+        await cache.aset(key, count, LISTING_COUNT_CACHE_TIMEOUT)
+    return count
+
+
+# Returns the validator headers of a listing response for the viewer: an
+# ETag derived from the version of the listings it shows. There is no
+# Last-Modified, since its one second precision would answer 304 to a
+# client that fetched in the same second as a later write.
+def get_listing_validators(request, version):
+    key = hashlib.md5(
+        json.dumps(
+            [request.get_full_path(), request.user.pk, version]
+        ).encode()
+    ).hexdigest()
+    return {"ETag": f'"{key}"', "Cache-Control": "private, no-cache"}
+
+
+# Returns a new random version of the listing collections
+def new_collection_version():
+    return uuid.uuid4().hex
+
+
+# Returns the current version of the listing collections. A new random
+# version is set when the cache has none, so that responses validated by an
+# evicted version are never matched again.
+async def aget_collection_version():
+    version = await cache.aget(LISTING_COLLECTION_VERSION_KEY)
+    if version is None:
+        version = new_collection_version()
+        await cache.aadd(LISTING_COLLECTION_VERSION_KEY, version, None)
+        version = await cache.aget(LISTING_COLLECTION_VERSION_KEY, version)
+    return version
+
+
+# Moves the listing collections to a new version once the current
+# transaction of the database using commits. Every write to a listing does,
+# through the post_save and post_delete signals and ListingQuerySet.update.
+def invalidate_listing_collections(using=None):
+    transaction.on_commit(
+        lambda: cache.set(
+            LISTING_COLLECTION_VERSION_KEY, new_collection_version(), None
+        ),
+        using=using,
+    )
+
+
+# Returns the validator headers of a listing collection response from the
+# version of the listing collections, which changes whenever the response
+# might, so revalidating a feed reads the cache instead of the listings
+async def aget_collection_validators(request):
+    return get_listing_validators(request, await aget_collection_version())
+
+
+# Returns an empty 304 response if the client already has the response
+# described by the validator headers, otherwise None
+def get_not_modified_response(request, headers):
+    response = get_conditional_response(request, etag=headers["ETag"])
+    if response is not None:
+        for key, value in headers.items():
+            response[key] = value
+    return response
+
+
+# Returns a Paginator over objects that already knows their count, so it
+# does not count them synchronously, and the offset of the page number
+def get_paginator(objects, limit, count, page):
+    paginator = Paginator(objects, limit)
+    paginator.count = count
+    number = paginator.validate_number(page)
+    return paginator, (number - 1) * paginator.per_page
+
+
+# Paginates listings using the page or cursor query parameters, reading
+# them with the async ORM
+async def apaginate_listings(request, listings):
+    limit = int(request.query_params.get("limit", 8))
+    cursor = request.query_params.get("cursor", None)
+    if cursor is None:
+        # Page mode, with the exact count and number of pages
+        page = request.query_params.get("page", 1)
+        paginator, offset = get_paginator(
+            listings, limit, await acount_listings(listings), page
+        )
+        listings = await afetch_listings(listings, limit, offset)
+        return listings, {
+            "count": paginator.count,
+            "num_pages": paginator.num_pages,
+        }
+    # Cursor mode, keyed on (created_at, id) so every page costs the same
+    meta = {}
+    if request.query_params.get("count") == "true":
+        count = await aget_cached_count(request, listings)
+        meta["count"] = count
+        meta["num_pages"] = max(1, -(-count // limit))
+    if cursor:
+        created_at, listing_id, direction = decode_cursor(cursor)
+    else:
+        created_at, listing_id, direction = None, None, "next"
+    if direction == "next":
+        if created_at is not None:
+            listings = listings.filter(
+                Q(created_at__lt=created_at)
+                | Q(created_at=created_at, id__lt=listing_id)
+            )
+        listings = listings.order_by("-created_at", "-id")
+    else:
+        listings = listings.filter(
+            Q(created_at__gt=created_at)
+            | Q(created_at=created_at, id__gt=listing_id)
+        ).order_by("created_at", "id")
+    # Fetch one extra row to know whether there is another page
+    listings = await afetch_listings(listings, limit + 1)
+    has_more = len(listings) > limit
+    listings = listings[:limit]
+    if direction == "previous":
+        listings.reverse()
+    has_next = has_more if direction == "next" else True
+    has_previous = created_at is not None if direction == "next" else has_more
+    meta["next"] = (
+        encode_cursor(listings[-1], "next") if listings and has_next else None
+    )
+    meta["previous"] = (
+        encode_cursor(listings[0], "previous")
+        if listings and has_previous
+        else None
+    )
+    return listings, meta
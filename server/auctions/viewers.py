@@ -0,0 +1,142 @@
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Bid, ProxyBid, Rating, Watchlist
+from .routers import use_primary
+from .shards import scatter_values
+
+# Number of seconds the context of a viewer is cached for
+VIEWER_CONTEXT_TIMEOUT = 10 * 60
+
+
+class ViewerContext:
+    """
+    Everything about the user making a request that the listing serializers
+    need, loaded with one query per kind instead of one per listing
+    """
+
+    def __init__(
+        self,
+        user_id=None,
+        watched_ids=(),
+        ratings=None,
+        max_bids=None,
+        won_ids=(),
+    ):
+        self.user_id = user_id
+        self.watched_ids = set(watched_ids)
+        self.ratings = ratings or {}
+        self.max_bids = max_bids or {}
+        self.won_ids = set(won_ids)
+
+    @classmethod
+    def load(cls, user):
+        """
+        Loads the context of user from the database, from every shard when
+        listings are sharded
+        """
+        if user is None or not user.is_authenticated:
+            return cls()
+        return cls(
+            user_id=user.pk,
+            watched_ids=scatter_values(
+                Watchlist.objects.filter(user=user).values_list(
+                    "listing_id", flat=True
+                )
+            ),
+            ratings=dict(
+                scatter_values(
+                    Rating.objects.filter(user=user).values_list(
+                        "listing_id", "rating"
+                    )
+                )
+            ),
+            max_bids=dict(
+                scatter_values(
+                    ProxyBid.objects.filter(user=user).values_list(
+                        "listing_id", "max_bid"
+                    )
+                )
+            ),
+            won_ids=scatter_values(
+                Bid.objects.filter(user=user, winner=True).values_list(
+                    "listing_id", flat=True
+                )
+            ),
+        )
+
+    def is_watching(self, listing):
+        """
+        Returns if the viewer watches listing
+        """
+        return listing.pk in self.watched_ids
+
+    def get_rating(self, listing):
+        """
+        Returns the rating the viewer gave listing, or None
+        """
+        return self.ratings.get(listing.pk)
+
+    def get_max_bid(self, listing):
+        """
+        Returns the maximum bid of the viewer for listing, or None
+        """
+        return self.max_bids.get(listing.pk)
+
+    def is_owner(self, listing):
+        """
+        Returns if the viewer owns listing
+        """
+        return self.user_id is not None and listing.user_id == self.user_id
+
+    def can_see_location(self, listing):
+        """
+        Returns if the viewer may see the precise location of listing, as
+        its owner or winner
+        """
+        return self.is_owner(listing) or listing.pk in self.won_ids
+
+
+def get_viewer_cache_key(user_id):
+    """
+    Returns the cache key of the context of a user
+    """
+    return f"viewer_context:{user_id}"
+
+
+def get_viewer_context(user):
+    """
+    Returns the context of user, from the cache when it was loaded already,
+    otherwise loaded from the primary
+    """
+    if user is None or not user.is_authenticated:
+        return ViewerContext()
+    key = get_viewer_cache_key(user.pk)
+    viewer = cache.get(key)
+    if viewer is None:
+        with use_primary():
+            viewer = ViewerContext.load(user)
+        cache.set(key, viewer, VIEWER_CONTEXT_TIMEOUT)
+    return viewer
+
+
+def get_request_viewer(request):
+    """
+    Returns the context of the user making request, built once per request
+    """
+    viewer = getattr(request, "_viewer_context", None)
+    if viewer is None:
+        viewer = get_viewer_context(request.user)
+        request._viewer_context = viewer
+    return viewer
+
+
+def invalidate_viewer_contexts(user_ids, using=None):
+    """
+    Drops the cached contexts of users once the current transaction of the
+    database using commits, so their next request loads them from the
+    committed data
+    """
+    keys = [get_viewer_cache_key(user_id) for user_id in set(user_ids)]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys), using=using)
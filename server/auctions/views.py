@@ -1,26 +1,76 @@
 from django.contrib.auth import logout
-from .models import Listing, Category, Bid, Comment, Watchlist, User, Rating
+from .models import (
+    Listing,
+    Category,
+    Bid,
+    Comment,
+    Watchlist,
+    User,
+    Rating,
+    ProxyBid,
+)
 from .serializers import (
     ListingSerializer,
     CategorySerializer,
     CommentSerializer,
     ListingMapSerializer,
+    MapClusterSerializer,
 )
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 
+from asgiref.sync import sync_to_async
+
 from django.core.paginator import Paginator
-import openai
+from django.db import router, transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import parse_etags
+from django.views import View
+import time
+
+from .async_views import AsyncAPIView, get_serializer_data
+from .authentication import get_token
+from .catalog import get_catalog
+from .clusters import CLUSTER_MAX_ZOOM, get_clusters
+from .comments import aload_comment_tree, load_thread, parse_reply_limit
+from .database import immediate_atomic
+from .descriptions import (
+    DescriptionError,
+    DescriptionTimeout,
+    get_generated_description,
+)
+from .events import format_event, get_broker
+from .proxies import BID_INCREMENT, resolve_proxy_bids
+from .shards import afetch_listings, get_category_shard, get_shards
+from .spatial import parse_bbox, within_bbox
+from .utils import (
+    aget_collection_validators,
+    apaginate_listings,
+    filter_objects,
+    get_listing_validators,
+    get_not_modified_response,
+    get_paginator,
+    parse_end_time,
+    parse_listing_ids,
+)
+from .viewers import invalidate_viewer_contexts
+from .watchlists import MAX_WATCHLIST_UPDATE, update_watchlist
 
-from django.conf import settings
+# Seconds between keepalive messages on an idle event stream
+EVENT_STREAM_KEEPALIVE = 15
 
-from .utils import filter_objects
+# Seconds an event stream stays open before the client has to reconnect
+EVENT_STREAM_DURATION = 300
+
+# Seconds a client waits before reconnecting to an event stream
+EVENT_STREAM_RETRY = 3
 
 # Create your views here.
 
 
-class ListingViewSet(APIView):
+class ListingViewSet(AsyncAPIView):
     """
     This viewset handles the following endpoints:
 
@@ -34,9 +84,20 @@ class ListingViewSet(APIView):
     the following query parameters:
 
     - filter: active, closed, all (default: active)
-    - query: search query (default: None)
+    - query: full-text search over title and description, matching word
+      prefixes (default: None)
+    - sort: relevance to order search results by relevance, or rating to
+      order by rating score, top rated first, in page mode (default: newest
+      first)
     - page: page number (default: 1)
     - limit: number of listings per page (default: 8)
+    - cursor: opaque cursor from a previous response's next/previous, or
+      empty for the first page. Switches to cursor pagination, which
+      returns next/previous cursors instead of count/num_pages
+    - count: true to include count/num_pages in cursor mode (cached briefly)
+
+    Responses carry an ETag header, and a request with a matching
+    If-None-Match header gets an empty 304 response.
 
 
     POST /listings
@@ -51,33 +112,41 @@ class ListingViewSet(APIView):
     - category
     - latitude
     - longitude
+    - ends_at (optional): ISO 8601 time at which the auction closes by
+      itself, otherwise it stays open until the owner closes it
     """
 
     permission_classes = [IsAuthenticated]
 
-    def get(self, request):
+    async def get(self, request):
         """
         This method handles the GET /listings endpoint.
 
         Returns a list of listings.
         """
-        listings = Listing.objects.all()
+        listings = Listing.objects.with_details()
         listing_filter = request.query_params.get("filter", "active")
         query = request.query_params.get("query", None)
-        listings = filter_objects(request, listings, listing_filter, query)
-        page = request.query_params.get("page", 1)
-        limit = request.query_params.get("limit", 8)
-        paginator = Paginator(listings, limit)
-        listings = paginator.page(page)
+        sort = request.query_params.get("sort", None)
+        # Answer revalidations from the cached collection version, without
+        # loading or serializing the page
+        headers = await aget_collection_validators(request)
+        not_modified = get_not_modified_response(request, headers)
+        if not_modified is not None:
+            return not_modified
+        listings = filter_objects(
+            request, listings, listing_filter, query, sort
+        )
+        listings, meta = await apaginate_listings(request, listings)
         serializer = ListingSerializer(
             listings, many=True, context={"request": request}
         )
         return Response(
             {
-                "count": paginator.count,
-                "num_pages": paginator.num_pages,
-                "results": serializer.data,
-            }
+                **meta,
+                "results": await get_serializer_data(serializer),
+            },
+            headers=headers,
         )
 
     def post(self, request):
@@ -110,8 +179,13 @@ class ListingViewSet(APIView):
                 {"error": "Please provide all the required fields"},
                 status=400,
             )
-        # Create a new listing
-        listing = Listing.objects.create(
+        try:
+            ends_at = parse_end_time(request.data.get("ends_at"))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+        # Create a new listing, in the shard of its category when listings
+        # are sharded
+        listing = Listing.objects.create_in_shard(
             title=title,
             description=description,
             starting_bid=starting_bid,
@@ -120,13 +194,14 @@ class ListingViewSet(APIView):
             user=user,
             latitude=latitude,
             longitude=longitude,
+            ends_at=ends_at,
         )
         return Response(
             {"success": "Listing created successfully"}, status=201
         )
 
 
-class ListingDetailViewSet(APIView):
+class ListingDetailViewSet(AsyncAPIView):
     """
     This viewset handles the following endpoints:
 
@@ -136,7 +211,9 @@ class ListingDetailViewSet(APIView):
     GET /listings/<int:pk>
     ----------------------
 
-    This endpoint returns a single listing.
+    This endpoint returns a single listing. The response carries an ETag
+    header, and a request with a matching If-None-Match header gets an
+    empty 304 response.
 
     PUT /listings/<int:pk>
     ----------------------
@@ -149,20 +226,34 @@ class ListingDetailViewSet(APIView):
     - category
     - latitude
     - longitude
+    - ends_at (optional): left unchanged if omitted, empty to remove it
     """
 
     # Only authenticated users can access this endpoint
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, pk):
+    async def get(self, request, pk):
         """
         This method handles the GET /listings/<int:pk> endpoint.
 
         Returns a single listing.
         """
-        listing = Listing.objects.get(id=pk)
+        # Answer revalidations from the time the listing last changed,
+        # without loading or serializing it
+        updated_at = (
+            await Listing.objects.filter(id=pk)
+            .values_list("updated_at", flat=True)
+            .aget()
+        )
+        headers = get_listing_validators(request, updated_at.isoformat())
+        not_modified = get_not_modified_response(request, headers)
+        if not_modified is not None:
+            return not_modified
+        listing = await Listing.objects.with_details().aget(id=pk)
         serializer = ListingSerializer(listing, context={"request": request})
-        return Response(serializer.data)
+        return Response(
+            await get_serializer_data(serializer), headers=headers
+        )
 
     def put(self, request, pk):
         """
@@ -197,6 +288,21 @@ class ListingDetailViewSet(APIView):
                 {"error": "Please provide all the required fields"},
                 status=400,
             )
+        # A listing stays in the shard it was created in
+        if (
+            get_shards()
+            and get_category_shard(category.id) != listing._state.db
+        ):
+            return Response(
+                {"error": "The listing cannot be moved to this category"},
+                status=400,
+            )
+        # The end time is only changed when it is provided
+        if "ends_at" in request.data:
+            try:
+                listing.ends_at = parse_end_time(request.data["ends_at"])
+            except ValueError as e:
+                return Response({"error": str(e)}, status=400)
         # Update the listing
         listing.title = title
         listing.description = description
@@ -206,6 +312,7 @@ class ListingDetailViewSet(APIView):
         listing.longitude = longitude
         listing.save()
         # Return the updated listing
+        listing = Listing.objects.with_details().get(id=pk)
         serializer = ListingSerializer(listing, context={"request": request})
         return Response(serializer.data, status=201)
 
@@ -257,18 +364,23 @@ class RatingViewSet(APIView):
         # Check if the user has already rated the listing
         if Rating.objects.filter(listing=listing, user=user).exists():
             return Response({"error": "Rating already exists"}, status=400)
-        # Create a new rating
-        rating = Rating.objects.create(
-            rating=rating,
-            listing=listing,
-            user=user,
-        )
+        # Create a new rating and update the listing aggregates
+        with transaction.atomic(
+            using=router.db_for_write(Listing, instance=listing)
+        ):
+            rating = Rating.objects.create(
+                rating=rating,
+                listing=listing,
+                user=user,
+            )
+            listing.record_rating(rating.rating)
         # Return the listing
+        listing = Listing.objects.with_details().get(id=pk)
         serializer = ListingSerializer(listing, context={"request": request})
         return Response(serializer.data)
 
 
-class CategoryViewSet(APIView):
+class CategoryViewSet(AsyncAPIView):
     """
     This viewset handles the following endpoints:
 
@@ -278,7 +390,10 @@ class CategoryViewSet(APIView):
     GET /categories
     ---------------
 
-    This endpoint returns a list of categories.
+    This endpoint returns a list of categories with their number of active
+    listings. The list is served from a cache with an ETag header, and a
+    request with a matching If-None-Match header gets an empty 304
+    response.
 
     POST /categories
     ----------------
@@ -291,17 +406,21 @@ class CategoryViewSet(APIView):
     # Only authenticated users can access this endpoint
     permission_classes = [IsAuthenticated]
 
-    def get(self, request):
+    async def get(self, request):
         """
         This method handles the GET /categories endpoint.
 
         Returns a list of categories.
         """
-        # Get all the categories
-        categories = Category.objects.all()
+        # Get the categories from the cache
+        catalog = await sync_to_async(get_catalog)()
+        headers = {"ETag": catalog["etag"]}
+        # Return nothing if the client has the current categories already
+        etags = parse_etags(request.headers.get("If-None-Match", ""))
+        if catalog["etag"] in etags or "*" in etags:
+            return Response(status=304, headers=headers)
         # Return the categories
-        serializer = CategorySerializer(categories, many=True)
-        return Response(serializer.data)
+        return Response(catalog["data"], headers=headers)
 
     def post(self, request):
         """
@@ -326,7 +445,7 @@ class CategoryViewSet(APIView):
         return Response(serializer.data, status=201)
 
 
-class CommentViewSet(APIView):
+class CommentViewSet(AsyncAPIView):
     """
     This viewset handles the following endpoints:
 
@@ -336,7 +455,16 @@ class CommentViewSet(APIView):
     GET /listings/<int:pk>/comments
     --------------------------------
 
-    This endpoint returns a list of comments on a listing.
+    This endpoint returns a list of top level comments on a listing with
+    their replies. The comments can be paginated by the following query
+    parameters:
+
+    - page: page number (default: 1)
+    - limit: number of comments per page (default: 10)
+    - reply_limit: number of replies returned per comment (default: 10,
+      at most 50).
+      Each comment has a reply_count, and further replies can be fetched
+      from GET /listings/<int:pk>/comments/<int:comment_pk>/replies
 
     POST /listings/<int:pk>/comments
     ---------------------------------
@@ -351,27 +479,39 @@ class CommentViewSet(APIView):
     # Only authenticated users can access this endpoint
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, pk):
+    async def get(self, request, pk):
         """
         This method handles the GET /listings/<int:pk>/comments endpoint.
 
         Returns a list of comments on a listing.
         """
         # Get the listing
-        listing = Listing.objects.get(id=pk)
+        listing = await Listing.objects.aget(id=pk)
         page = request.query_params.get("page", 1)
         limit = request.query_params.get("limit", 10)
-        comments = Comment.objects.filter(listing=listing, parent=None)
-        paginator = Paginator(comments, limit)
-        comments = paginator.page(page)
+        reply_limit = parse_reply_limit(
+            request.query_params.get("reply_limit")
+        )
+        comments = Comment.objects.filter(
+            listing=listing, parent=None
+        ).select_related("user")
+        paginator, offset = get_paginator(
+            comments, limit, await comments.acount(), page
+        )
+        comments = [
+            comment
+            async for comment in comments[offset : offset + paginator.per_page]
+        ]
+        # Load the replies and ratings of the whole page up front
+        context = await aload_comment_tree(listing, comments, reply_limit)
         serializer = CommentSerializer(
-            comments, many=True, context={"request": request}
+            comments, many=True, context={"request": request, **context}
         )
         return Response(
             {
                 "count": paginator.count,
                 "num_pages": paginator.num_pages,
-                "results": serializer.data,
+                "results": await get_serializer_data(serializer),
             }
         )
 
@@ -408,6 +548,57 @@ class CommentViewSet(APIView):
         return Response(serializer.data, status=201)
 
 
+class CommentReplyViewSet(APIView):
+    """
+    This viewset handles the following endpoint:
+
+    - GET /listings/<int:pk>/comments/<int:comment_pk>/replies
+
+    GET /listings/<int:pk>/comments/<int:comment_pk>/replies
+    --------------------------------------------------------
+
+    This endpoint returns a list of replies to a comment with their own
+    replies. The replies can be paginated by the following query parameters:
+
+    - page: page number (default: 1)
+    - limit: number of replies per page (default: 10)
+    - reply_limit: number of replies returned per reply (default: 10, at
+      most 50)
+    """
+
+    # Only authenticated users can access this endpoint
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk, comment_pk):
+        """
+        This method handles the
+        GET /listings/<int:pk>/comments/<int:comment_pk>/replies endpoint.
+
+        Returns a list of replies to a comment.
+        """
+        listing = Listing.objects.get(id=pk)
+        comment = Comment.objects.get(id=comment_pk, listing=listing)
+        page = request.query_params.get("page", 1)
+        limit = request.query_params.get("limit", 10)
+        reply_limit = parse_reply_limit(
+            request.query_params.get("reply_limit")
+        )
+        # Load the whole thread once and page through the direct replies
+        context = load_thread(listing, comment, reply_limit)
+        paginator = Paginator(context["replies"].get(comment.id, []), limit)
+        replies = paginator.page(page)
+        serializer = CommentSerializer(
+            replies, many=True, context={"request": request, **context}
+        )
+        return Response(
+            {
+                "count": paginator.count,
+                "num_pages": paginator.num_pages,
+                "results": serializer.data,
+            }
+        )
+
+
 class RegisterViewSet(APIView):
     """
     This viewset handles the following endpoint:
@@ -543,16 +734,28 @@ class WatchlistViewSet(APIView):
             return Response(
                 {"error": "You cannot watch your own listing"}, status=400
             )
-        # Check if the listing is already in the user's watchlist
-        if Watchlist.objects.filter(listing=listing, user=user).exists():
-            Watchlist.objects.filter(listing=listing, user=user).delete()
-        else:
-            Watchlist.objects.create(listing=listing, user=user)
+        # Remove the listing if it is in the user's watchlist, otherwise add
+        # it. A concurrent toggle that added it first is not added again.
+        with transaction.atomic(
+            using=router.db_for_write(Listing, instance=listing)
+        ):
+            deleted, _ = Watchlist.objects.filter(
+                listing=listing, user=user
+            ).delete()
+            if deleted:
+                listing.record_watch(-1)
+            else:
+                _, created = Watchlist.objects.get_or_create(
+                    listing=listing, user=user
+                )
+                if created:
+                    listing.record_watch(1)
+        listing = Listing.objects.with_details().get(id=pk)
         serializer = ListingSerializer(listing, context={"request": request})
         return Response(serializer.data)
 
 
-class CategoryListingViewSet(APIView):
+class CategoryListingViewSet(AsyncAPIView):
     """
     This viewset handles the following endpoint:
 
@@ -565,46 +768,64 @@ class CategoryListingViewSet(APIView):
     filtered by the following query parameters:
 
     - filter: active, closed, all (default: active)
-    - query: search query (default: None)
+    - query: full-text search over title and description, matching word
+      prefixes (default: None)
+    - sort: relevance to order search results by relevance, or rating to
+      order by rating score, top rated first, in page mode (default: newest
+      first)
     - page: page number (default: 1)
     - limit: number of listings per page (default: 8)
+    - cursor: opaque cursor from a previous response's next/previous, or
+      empty for the first page. Switches to cursor pagination, which
+      returns next/previous cursors instead of count/num_pages
+    - count: true to include count/num_pages in cursor mode (cached briefly)
+
+    Responses carry an ETag header, and a request with a matching
+    If-None-Match header gets an empty 304 response.
     """
 
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, pk):
+    async def get(self, request, pk):
         """
         This method handles the GET /categories/<int:pk>/listings endpoint.
 
         Returns a list of listings in a category.
         """
-        category = Category.objects.get(id=pk)
-        listings = Listing.objects.filter(category=category)
+        category = await Category.objects.aget(id=pk)
+        listings = Listing.objects.filter(category=category).with_details()
         listing_filter = request.query_params.get("filter", "active")
         query = request.query_params.get("query", None)
-        listings = filter_objects(request, listings, listing_filter, query)
-        page = request.query_params.get("page", 1)
-        limit = request.query_params.get("limit", 8)
-        paginator = Paginator(listings, limit)
-        listings = paginator.page(page)
+        sort = request.query_params.get("sort", None)
+        # Answer revalidations from the cached collection version, without
+        # loading or serializing the page
+        headers = await aget_collection_validators(request)
+        not_modified = get_not_modified_response(request, headers)
+        if not_modified is not None:
+            return not_modified
+        listings = filter_objects(
+            request, listings, listing_filter, query, sort
+        )
+        listings, meta = await apaginate_listings(request, listings)
         serializer = ListingSerializer(
             listings, many=True, context={"request": request}
         )
         return Response(
             {
-                "count": paginator.count,
-                "num_pages": paginator.num_pages,
-                "results": serializer.data,
+                **meta,
+                "results": await get_serializer_data(serializer),
                 "category": category.category,
-            }
+            },
+            headers=headers,
         )
 
 
-class WatchlistListingViewSet(APIView):
+class WatchlistListingViewSet(AsyncAPIView):
     """
     This viewset handles the following endpoint:
 
     - GET /watchlist
+    - POST /watchlist
 
     GET /watchlist
     --------------
@@ -613,40 +834,99 @@ class WatchlistListingViewSet(APIView):
     listings can be filtered by the following query parameters:
 
     - filter: active, closed, all (default: active)
-    - query: search query (default: None)
+    - query: full-text search over title and description, matching word
+      prefixes (default: None)
+    - sort: relevance to order search results by relevance, or rating to
+      order by rating score, top rated first, in page mode (default: newest
+      first)
     - page: page number (default: 1)
     - limit: number of listings per page (default: 8)
+    - cursor: opaque cursor from a previous response's next/previous, or
+      empty for the first page. Switches to cursor pagination, which
+      returns next/previous cursors instead of count/num_pages
+    - count: true to include count/num_pages in cursor mode (cached briefly)
+
+    Responses carry an ETag header, and a request with a matching
+    If-None-Match header gets an empty 304 response.
+
+    POST /watchlist
+    ---------------
+
+    This endpoint adds and removes many listings from the user's watchlist
+    at once. The following fields are expected in the request body:
+
+    - add: ids of the listings to add (default: [])
+    - remove: ids of the listings to remove (default: [])
+
+    Listings that do not exist, are owned by the user or are in the
+    watchlist already are not added. The response contains the ids that
+    were actually added and removed.
     """
 
     permission_classes = [IsAuthenticated]
 
-    def get(self, request):
+    async def get(self, request):
         """
         This method handles the GET /watchlist endpoint.
 
         Returns a list of listings in the user's watchlist.
         """
-        listings = Listing.objects.filter(watchlists__user=request.user)
+        listings = Listing.objects.filter(
+            watchlists__user=request.user
+        ).with_details()
         listing_filter = request.query_params.get("filter", "active")
         query = request.query_params.get("query", None)
-        listings = filter_objects(request, listings, listing_filter, query)
-        page = request.query_params.get("page", 1)
-        limit = request.query_params.get("limit", 8)
-        paginator = Paginator(listings, limit)
-        listings = paginator.page(page)
+        sort = request.query_params.get("sort", None)
+        # Answer revalidations from the cached collection version, without
+        # loading or serializing the page
+        headers = await aget_collection_validators(request)
+        not_modified = get_not_modified_response(request, headers)
+        if not_modified is not None:
+            return not_modified
+        listings = filter_objects(
+            request, listings, listing_filter, query, sort
+        )
+        listings, meta = await apaginate_listings(request, listings)
         serializer = ListingSerializer(
             listings, many=True, context={"request": request}
         )
         return Response(
             {
-                "count": paginator.count,
-                "num_pages": paginator.num_pages,
-                "results": serializer.data,
-            }
+                **meta,
+                "results": await get_serializer_data(serializer),
+            },
+            headers=headers,
         )
 
+    def post(self, request):
+        """
+        This method handles the POST /watchlist endpoint.
+
+        Adds and removes listings from the user's watchlist.
+        """
+        try:
+            add_ids = parse_listing_ids(request.data.get("add"))
+            remove_ids = parse_listing_ids(request.data.get("remove"))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+        if set(add_ids) & set(remove_ids):
+            return Response(
+                {"error": "A listing cannot be both added and removed"},
+                status=400,
+            )
+        if len(add_ids) + len(remove_ids) > MAX_WATCHLIST_UPDATE:
+            return Response(
+                {
+                    "error": f"At most {MAX_WATCHLIST_UPDATE} listings can "
+                    "be changed at once"
+                },
+                status=400,
+            )
+        added, removed = update_watchlist(request.user, add_ids, remove_ids)
+        return Response({"added": added, "removed": removed})
+
 
-class GenerateDescriptionViewSet(APIView):
+class GenerateDescriptionViewSet(AsyncAPIView):
     """
     This viewset handles the following endpoint:
 
@@ -658,12 +938,21 @@ class GenerateDescriptionViewSet(APIView):
     This endpoint generates a description for a listing title. The following
     fields are required:
 
-    - title: listing title
+    - title: listing title, at most 64 characters
+    - category (optional): id of the listing category
+
+    Descriptions are stored by title, ignoring case, punctuation and extra
+    spaces, and category, so the same title is generated once. Concurrent
+    requests for the same title wait for a single generation. OpenAI is
+    called asynchronously, so under ASGI the worker keeps serving other
+    requests while it waits. It gives up after OPENAI_REQUEST_TIMEOUT
+    seconds with a 504 response, and answers 502 when OpenAI returns an
+    error.
     """
 
     permission_classes = [IsAuthenticated]
 
-    def post(self, request):
+    async def post(self, request):
         """
         This method handles the POST /ai/generate_description endpoint.
 
@@ -677,22 +966,31 @@ class GenerateDescriptionViewSet(APIView):
                 {"error": "Please provide a title to generate description"},
                 status=400,
             )
-        # Generate a description using OpenAI's GPT-3 API
-        openai.api_key = settings.OPENAI_API_KEY
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "user",
-                    "content": "I want to sell a "
-                    + title
-                    + ". What should I write in the description with in 50 words?",
-                }
-            ],
-        )
-        return Response(
-            {"description": response["choices"][0]["message"]["content"]}
-        )
+        if len(title) > 64:
+            return Response(
+                {"error": "Title must be at most 64 characters"}, status=400
+            )
+        category = request.data.get("category")
+        if category is not None:
+            try:
+                category = await Category.objects.aget(id=int(category))
+            except (TypeError, ValueError, Category.DoesNotExist):
+                return Response({"error": "Category not found"}, status=400)
+        # Generate a description using OpenAI's GPT-3 API, unless it was
+        # generated already
+        try:
+            generated = await get_generated_description(title, category)
+        except DescriptionTimeout:
+            return Response(
+                {"error": "The description took too long to generate"},
+                status=504,
+            )
+        except DescriptionError:
+            return Response(
+                {"error": "The description could not be generated"},
+                status=502,
+            )
+        return Response({"description": generated.description})
 
 
 class BidViewSet(APIView):
@@ -720,12 +1018,12 @@ class BidViewSet(APIView):
         """
         listing = Listing.objects.get(id=pk)
         # Check if the listing is closed
-        if not listing.active:
+        if not listing.active or listing.has_ended():
             return Response(
                 {"error": "You cannot bid on a closed listing"}, status=400
             )
         # Get the bid from the request body
-        bid = int(request.data.get("bid"))
+        bid = request.data.get("bid")
         user = request.user
         # Check if all the required fields are provided
         if bid is None:
@@ -733,24 +1031,113 @@ class BidViewSet(APIView):
                 {"error": "Please provide all the required fields"},
                 status=400,
             )
-        # Check if the bid is greater than the current bid
-        if listing.bids.all().count() > 0:
-            if listing.bids.all().order_by("-bid")[0].bid >= bid:
-                return Response(
-                    {"error": "Bid must be greater than the current bid"},
-                    status=400,
-                )
+        bid = int(bid)
         # Check if the user is authorized to bid on the listing
-        if listing.user == user:
+        if listing.user_id == user.id:
             return Response(
                 {"error": "You cannot bid on your own listing"}, status=400
             )
-        # Create a new bid
-        bid = Bid.objects.create(
-            bid=bid,
-            listing=listing,
-            user=user,
-        )
+        # Place the bid only if it is still greater than the current bid,
+        # which also rejects bids that lost a race with a concurrent bid
+        if listing.place_bid(user, bid) is None:
+            return Response(
+                {"error": "Bid must be greater than the current bid"},
+                status=400,
+            )
+        # Let the proxy bids of other users respond to the new bid
+        resolve_proxy_bids(listing)
+        listing = Listing.objects.with_details().get(id=pk)
+        serializer = ListingSerializer(listing, context={"request": request})
+        return Response(serializer.data)
+
+
+class ProxyBidViewSet(APIView):
+    """
+    This viewset handles the following endpoint:
+
+    - POST /listings/<int:pk>/max_bid
+
+    POST /listings/<int:pk>/max_bid
+    -------------------------------
+
+    This endpoint sets the maximum bid of the user on a listing. The server
+    then bids on behalf of the user, just enough to stay the highest bidder,
+    until the maximum is reached. The following fields are required:
+
+    - max_bid
+
+    A maximum can only be raised. The listing is returned with the current
+    bid after the proxy bids were resolved, and max_bid set to the maximum
+    of the user.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk):
+        """
+        This method handles the POST /listings/<int:pk>/max_bid endpoint.
+
+        Sets the maximum bid of the user on a listing.
+        """
+        listing = Listing.objects.get(id=pk)
+        # Check if the listing is closed
+        if not listing.active or listing.has_ended():
+            return Response(
+                {"error": "You cannot bid on a closed listing"}, status=400
+            )
+        max_bid = request.data.get("max_bid")
+        user = request.user
+        # Check if all the required fields are provided
+        if max_bid is None:
+            return Response(
+                {"error": "Please provide all the required fields"},
+                status=400,
+            )
+        try:
+            max_bid = int(max_bid)
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "Maximum bid must be an integer"}, status=400
+            )
+        # Check if the user is authorized to bid on the listing
+        if listing.user_id == user.id:
+            return Response(
+                {"error": "You cannot bid on your own listing"}, status=400
+            )
+        # Check if the maximum can still win the listing
+        if listing.bid_count:
+            minimum = listing.current_bid + BID_INCREMENT
+        else:
+            minimum = listing.current_bid
+        if max_bid < minimum:
+            return Response(
+                {"error": "Maximum bid must be greater than the current bid"},
+                status=400,
+            )
+        using = router.db_for_write(Listing, instance=listing)
+        with immediate_atomic(using=using):
+            # get_or_create falls back to reading the proxy when a
+            # concurrent request of the user created it first
+            proxy_bid, created = ProxyBid.objects.get_or_create(
+                listing=listing, user=user, defaults={"max_bid": max_bid}
+            )
+            if not created:
+                # Raise the maximum only if it is still lower, which also
+                # rejects a request that lost a race with a higher one
+                raised = ProxyBid.objects.filter(
+                    pk=proxy_bid.pk, max_bid__lt=max_bid
+                ).update(max_bid=max_bid, updated_at=timezone.now())
+                if not raised:
+                    return Response(
+                        {"error": "Maximum bid can only be raised"},
+                        status=400,
+                    )
+                # The update skips the signal refreshing the viewer context
+                invalidate_viewer_contexts([user.id], using=using)
+        # The maximum is part of the listing as this user sees it
+        listing.touch()
+        resolve_proxy_bids(listing)
+        listing = Listing.objects.with_details().get(id=pk)
         serializer = ListingSerializer(listing, context={"request": request})
         return Response(serializer.data)
 
@@ -786,11 +1173,12 @@ class CloseListingViewSet(APIView):
             )
         # Close the listing
         listing.close_listing()
+        listing = Listing.objects.with_details().get(id=pk)
         serializer = ListingSerializer(listing, context={"request": request})
         return Response(serializer.data)
 
 
-class MapListingViewSet(APIView):
+class MapListingViewSet(AsyncAPIView):
     """
     This viewset handles the following endpoint:
 
@@ -799,25 +1187,60 @@ class MapListingViewSet(APIView):
     GET /map_listings
     -----------------
 
-    This endpoint returns a list of listings for the map.
+    This endpoint returns a list of active listings for the map. The listings
+    can be limited to the visible viewport by the following query parameters:
+
+    - bbox: minLng,minLat,maxLng,maxLat (default: None, all listings)
+    - zoom: map zoom level (default: None). At zoom levels up to
+      CLUSTER_MAX_ZOOM a list of clusters is returned instead, each with
+      its count, centroid, bbox and a sample of listing_ids
     """
 
     permission_classes = [IsAuthenticated]
 
-    def get(self, request):
+    async def get(self, request):
         """
         This method handles the GET /map_listings endpoint.
 
         Returns a list of listings for the map.
         """
-        listings = Listing.objects.filter(active=True)
+        listings = Listing.objects.filter(active=True).with_winner()
+        bbox = request.query_params.get("bbox", None)
+        zoom = request.query_params.get("zoom", None)
+        if bbox is not None:
+            try:
+                bbox = parse_bbox(bbox)
+            except ValueError:
+                return Response(
+                    {"error": "bbox must be minLng,minLat,maxLng,maxLat"},
+                    status=400,
+                )
+        if zoom is not None:
+            try:
+                zoom = int(zoom)
+            except ValueError:
+                return Response(
+                    {"error": "zoom must be an integer"}, status=400
+                )
+            # Return precomputed clusters when zoomed out
+            if zoom <= CLUSTER_MAX_ZOOM:
+                clusters = get_clusters(max(zoom, 0), bbox)
+                serializer = MapClusterSerializer(
+                    [cluster async for cluster in clusters], many=True
+                )
+                return Response(serializer.data)
+        if bbox is not None:
+            # Only return the listings inside the viewport
+            listings = within_bbox(listings, bbox)
         serializer = ListingMapSerializer(
-            listings, many=True, context={"request": request}
+            await afetch_listings(listings),
+            many=True,
+            context={"request": request},
         )
-        return Response(serializer.data)
+        return Response(await get_serializer_data(serializer))
 
 
-class UserListingViewSet(APIView):
+class UserListingViewSet(AsyncAPIView):
     """
     This viewset handles the following endpoint:
 
@@ -830,36 +1253,151 @@ class UserListingViewSet(APIView):
     filtered by the following query parameters:
 
     - filter: active, closed, all (default: active)
-    - query: search query (default: None)
+    - query: full-text search over title and description, matching word
+      prefixes (default: None)
+    - sort: relevance to order search results by relevance, or rating to
+      order by rating score, top rated first, in page mode (default: newest
+      first)
     - page: page number (default: 1)
     - limit: number of listings per page (default: 8)
+    - cursor: opaque cursor from a previous response's next/previous, or
+      empty for the first page. Switches to cursor pagination, which
+      returns next/previous cursors instead of count/num_pages
+    - count: true to include count/num_pages in cursor mode (cached briefly)
+
+    Responses carry an ETag header, and a request with a matching
+    If-None-Match header gets an empty 304 response.
     """
 
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, pk):
+    async def get(self, request, pk):
         """
         This method handles the GET /users/<int:pk>/listings endpoint.
 
         Returns a list of listings for a user.
         """
-        user = User.objects.get(id=pk)
-        listings = Listing.objects.filter(user=user)
+        user = await User.objects.aget(id=pk)
+        listings = Listing.objects.filter(user=user).with_details()
         listing_filter = request.query_params.get("filter", "active")
         query = request.query_params.get("query", None)
-        listings = filter_objects(request, listings, listing_filter, query)
-        page = request.query_params.get("page", 1)
-        limit = request.query_params.get("limit", 8)
-        paginator = Paginator(listings, limit)
-        listings = paginator.page(page)
+        sort = request.query_params.get("sort", None)
+        # Answer revalidations from the cached collection version, without
+        # loading or serializing the page
+        headers = await aget_collection_validators(request)
+        not_modified = get_not_modified_response(request, headers)
+        if not_modified is not None:
+            return not_modified
+        listings = filter_objects(
+            request, listings, listing_filter, query, sort
+        )
+        listings, meta = await apaginate_listings(request, listings)
         serializer = ListingSerializer(
             listings, many=True, context={"request": request}
         )
         return Response(
             {
-                "count": paginator.count,
-                "num_pages": paginator.num_pages,
-                "results": serializer.data,
+                **meta,
+                "results": await get_serializer_data(serializer),
                 "user": user.get_display_name(),
-            }
+            },
+            headers=headers,
         )
+
+
+class ListingEventViewSet(View):
+    """
+    This viewset handles the following endpoint:
+
+    - GET /listings/<int:pk>/events
+
+    GET /listings/<int:pk>/events
+    -----------------------------
+
+    This endpoint streams the changes to a listing as Server-Sent Events,
+    so clients do not need to re-fetch the listing to see them. It must be
+    served by the ASGI application (bidster.asgi). Since EventSource cannot
+    send headers, the token can also be passed as a query parameter:
+
+    - token: authentication token
+
+    The stream starts with a snapshot event and then sends the following
+    events as they happen:
+
+    - snapshot: active, current_bid and bid_count of the listing
+    - bid: new current_bid and bid_count, and the bid that was placed
+    - close: winner_id and winning_bid of the closed listing
+    - comment: the comment that was posted
+
+    The stream ends after a few minutes and the client reconnects, which
+    also sends a fresh snapshot.
+    """
+
+    async def get(self, request, pk):
+        """
+        This method handles the GET /listings/<int:pk>/events endpoint.
+
+        Streams the changes to a listing.
+        """
+        if await self.get_user(request) is None:
+            return JsonResponse(
+                {"detail": "Authentication credentials were not provided."},
+                status=401,
+            )
+        # Subscribe before reading the snapshot, so that no change falls
+        # between the two
+        subscription = await get_broker().subscribe(pk)
+        try:
+            listing = await Listing.objects.aget(id=pk)
+        except Listing.DoesNotExist:
+            await subscription.close()
+            return JsonResponse({"error": "Listing not found"}, status=404)
+        response = StreamingHttpResponse(
+            self.stream(listing, subscription),
+            content_type="text/event-stream",
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    async def get_user(self, request):
+        """
+        Returns the user authenticated by the Authorization header or the
+        token query parameter
+        """
+        key = request.GET.get("token")
+        header = request.headers.get("Authorization", "").split()
+        if len(header) == 2 and header[0] == "Token":
+            key = header[1]
+        if not key:
+            return None
+        token = await sync_to_async(get_token)(key)
+        if token is None:
+            return None
+        return token.user if token.user.is_active else None
+
+    async def stream(self, listing, subscription):
+        """
+        Yields the snapshot of the listing and then its events
+        """
+        try:
+            yield f"retry: {EVENT_STREAM_RETRY * 1000}\n\n"
+            yield format_event(
+                {
+                    "type": "snapshot",
+                    "listing_id": listing.id,
+                    "active": listing.active,
+                    "current_bid": listing.current_bid,
+                    "bid_count": listing.bid_count,
+                }
+            )
+            deadline = time.monotonic() + EVENT_STREAM_DURATION
+            while time.monotonic() < deadline:
+                event = await subscription.get(EVENT_STREAM_KEEPALIVE)
+                if event is None:
+                    # Comment lines keep proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+                else:
+                    yield format_event(event)
+        finally:
+            await subscription.close()
@@ -0,0 +1,106 @@
+from django.db import router
+from django.db.models import Count, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .database import immediate_atomic
+from .models import Listing, Watchlist
+from .shards import get_shards, group_by_shard, mirror_references, use_shard
+from .viewers import invalidate_viewer_contexts
+
+# Maximum number of listing ids a single watchlist update may change
+MAX_WATCHLIST_UPDATE = 500
+
+
+def update_watchlist(user, add_ids, remove_ids):
+    """
+    Adds and removes listings from the watchlist of user and returns the
+    ids actually added and removed. The rows are inserted and deleted in
+    one statement each (per shard when listings are sharded), and listings
+    that do not exist, are owned by the user or are in the watchlist
+    already are skipped.
+    """
+    add_ids = set(add_ids)
+    remove_ids = set(remove_ids)
+    added, removed = set(), set()
+    for alias, listing_ids in group_by_shard(add_ids | remove_ids).items():
+        with use_shard(alias):
+            shard_added, shard_removed = update_shard_watchlist(
+                user, add_ids & listing_ids, remove_ids & listing_ids
+            )
+        added |= shard_added
+        removed |= shard_removed
+    return sorted(added), sorted(removed)
+
+
+def update_shard_watchlist(user, add_ids, remove_ids):
+    """
+    Updates the watchlist of user with listings of the current shard, see
+    update_watchlist, and returns the sets of ids added and removed
+    """
+    using = router.db_for_write(Watchlist)
+    with immediate_atomic(using=using):
+        watched = set(
+            Watchlist.objects.filter(
+                user=user, listing_id__in=add_ids | remove_ids
+            ).values_list("listing_id", flat=True)
+        )
+        added = set(
+            Listing.objects.filter(pk__in=add_ids - watched)
+            .exclude(user=user)
+            .values_list("pk", flat=True)
+        )
+        removed = remove_ids & watched
+        if added and using in get_shards():
+            # bulk_create skips the signal copying the user into the shard
+            mirror_references(Watchlist(user=user), using)
+        # Another request may add the same rows in the meantime, so rely on
+        # the unique constraint and recount the watches below
+        Watchlist.objects.bulk_create(
+            [Watchlist(user=user, listing_id=pk) for pk in added],
+            ignore_conflicts=True,
+        )
+        Watchlist.objects.filter(user=user, listing_id__in=removed).delete()
+        recount_watches(added | removed)
+        invalidate_viewer_contexts([user.pk], using=using)
+    return added, removed
+
+
+def recount_watches(
+    listing_ids=None, listing_model=Listing, watchlist_model=Watchlist
+):
+    """
+    Recomputes the watch counts of listings, or of all listings when no ids
+    are given, and marks them as changed. Migrations pass their historical
+    models.
+    """
+    counts = (
+        watchlist_model.objects.filter(listing=OuterRef("pk"))
+        .order_by()
+        .values("listing")
+        .annotate(c=Count("pk"))
+        .values("c")
+    )
+    listings = listing_model.objects.all()
+    if listing_ids is not None:
+        if not listing_ids:
+            return 0
+        listings = listings.filter(pk__in=listing_ids)
+    return listings.update(
+        watch_count=Coalesce(Subquery(counts), 0), updated_at=timezone.now()
+    )
+
+
+def remove_duplicate_watches(watchlist_model=Watchlist):
+    """
+    Deletes all but the first row of every listing watched more than once by
+    the same user and returns the number deleted
+    """
+    first_ids = (
+        watchlist_model.objects.order_by()
+        .values("user", "listing")
+        .annotate(first_id=Min("pk"))
+        .values("first_id")
+    )
+    deleted, _ = watchlist_model.objects.exclude(pk__in=first_ids).delete()
+    return deleted
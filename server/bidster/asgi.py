@@ -9,8 +9,16 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "bidster.settings")
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# Serves each request from a pooled thread, so database connections are
+# reused between requests
+from auctions.threads import PooledASGIHandler  # noqa: E402
+
+application = PooledASGIHandler()
+
+app = application
@@ -19,6 +19,19 @@ env.read_env()
 
 OPENAI_API_KEY = env("OPENAI_API_KEY")
 
+# Number of seconds a description generation waits for OpenAI
+OPENAI_REQUEST_TIMEOUT = 20
+
+# Client generating listing descriptions. Set it to
+# "auctions.descriptions.StubClient" (with {"delay": 1} as options, say) to
+# develop or test without calling OpenAI. Generated descriptions are stored
+# in the database and the most recent DESCRIPTION_CACHE_SIZE are also kept
+# in each worker for DESCRIPTION_CACHE_TIMEOUT seconds.
+DESCRIPTION_CLIENT = "auctions.descriptions.OpenAIClient"
+DESCRIPTION_CLIENT_OPTIONS = {}
+DESCRIPTION_CACHE_SIZE = 1024
+DESCRIPTION_CACHE_TIMEOUT = 60 * 60
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -64,6 +77,8 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "auctions.routers.replica_middleware",
+    "auctions.routers.shard_middleware",
 ]
 
 ROOT_URLCONF = "bidster.urls"
@@ -94,9 +109,56 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Keep connections open between requests, so the pragmas below are
+        # applied once per connection rather than once per request. Under
+        # ASGI, bidster.asgi serves requests from pooled threads so that
+        # their connections are reused as well.
+        "CONN_MAX_AGE": 600,
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
+# Number of idle threads, each with its own database connections, kept by
+# the ASGI application for the sync code of the requests it serves
+ASGI_IDLE_THREADS = 16
+
+# Aliases in DATABASES of read replicas of the default database. Safe
+# requests to the browse endpoints read from one of them, except for the
+# REPLICA_PIN_SECONDS after a client wrote, so it reads its own writes.
+# Every write goes to the default database.
+DATABASE_REPLICAS = []
+REPLICA_PIN_SECONDS = 10
+
+# Aliases in DATABASES of the shards listings are stored in, by category:
+# a new listing goes to the shard of its category, and its bids, comments,
+# ratings and watches go with it. Empty to keep every listing in the
+# default database. Users, categories and tokens stay in the default
+# database. The ids and names of the users and categories are copied into
+# the shards that refer to them, see auctions.shards.MIRRORED_FIELDS.
+LISTING_SHARDS = []
+DATABASE_ROUTERS = [
+    "auctions.routers.ShardRouter",
+    "auctions.routers.ReplicaRouter",
+]
+
+# Pragmas applied to every new SQLite connection. WAL lets readers run
+# alongside the writer, writers wait up to busy_timeout milliseconds for
+# the lock instead of failing with "database is locked", and NORMAL
+# synchronous is durable in WAL mode except for the last transactions on
+# power loss. busy_timeout only covers a transaction that waits for the
+# lock before it reads, so transactions that read and then write begin with
+# auctions.database.immediate_atomic (BEGIN IMMEDIATE). Run
+# "manage.py optimize_database" regularly to keep the query planner
+# statistics current.
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+    "temp_store": "memory",
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -145,9 +207,33 @@ AUTH_USER_MODEL = "auctions.User"
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
+        "auctions.authentication.CachedTokenAuthentication",
     ],
 }
 
+# Tokens are cached in each worker for AUTH_TOKEN_CACHE_TIMEOUT seconds, so
+# a token deleted or a user deactivated through another worker is rejected
+# by this one at most that long after. Set AUTH_TOKEN_SHARED_CACHE to the
+# alias of a shared cache to also share the cached tokens between workers.
+AUTH_TOKEN_CACHE_SIZE = 1024
+AUTH_TOKEN_CACHE_TIMEOUT = 60
+AUTH_TOKEN_SHARED_CACHE = None
+
+# Cache holding the category catalog and the listing counts. Use a shared
+# cache such as Redis or Memcached when running several workers, so that
+# they see each other's invalidations.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+# Broker fanning listing events out to the event streams. The in-memory
+# broker only reaches the streams served by the same process, so use
+# "auctions.events.RedisBroker" (with {"url": "redis://..."} as options)
+# when running several workers.
+AUCTION_EVENT_BROKER = "auctions.events.InMemoryBroker"
+AUCTION_EVENT_BROKER_OPTIONS = {}
+
 CORS_ORIGIN_ALLOW_ALL = True
 ALLOWED_HOSTS = ["*"]